@@ -0,0 +1,162 @@
+import math
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+
+class TokenizedDataset(torch.utils.data.Dataset):
+    """Sentences tokenized once into one flat array of token ids, without any padding.
+
+    Sentence i consists of input_ids[offsets[i]:offsets[i + 1]]. Labels are either one per
+    sentence, or one per token (`per_token=True`) and then sliced like the token ids.
+    """
+
+    def __init__(self, input_ids: np.ndarray, offsets: np.ndarray, labels: np.ndarray, per_token: bool = False):
+        self.input_ids = input_ids
+        self.offsets = offsets
+        self.labels = labels
+        self.per_token = per_token
+
+    @classmethod
+    def from_sentences(cls, tokenizer, sentences: Sequence[str], labels: Sequence[int], max_length: Optional[int] = None):
+        encodings = tokenizer(list(sentences), is_split_into_words=False, truncation=True, max_length=max_length)
+        return cls.from_token_ids(encodings['input_ids'], np.asarray(labels, dtype=np.int64))
+
+    @classmethod
+    def from_token_ids(cls, token_ids: List[List[int]], labels: np.ndarray, per_token: bool = False):
+        lengths = np.fromiter((len(ids) for ids in token_ids), dtype=np.int64, count=len(token_ids))
+        offsets = np.zeros(len(token_ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        input_ids = np.fromiter((i for ids in token_ids for i in ids), dtype=np.int32, count=int(offsets[-1]))
+        return cls(input_ids, offsets, labels, per_token=per_token)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def subset(self, indices: Sequence[int]) -> 'TokenizedDataset':
+        """A copy holding only the given sentences, in the given order"""
+        indices = np.asarray(indices, dtype=np.int64)
+        starts, ends = self.offsets[indices], self.offsets[indices + 1]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=offsets[1:])
+        tokens = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)]) if len(indices) else np.empty(0, np.int64)
+        labels = self.labels[tokens] if self.per_token else self.labels[indices]
+        return TokenizedDataset(np.asarray(self.input_ids[tokens]), offsets, np.asarray(labels), per_token=self.per_token)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        labels = self.labels[start:end] if self.per_token else self.labels[idx]
+        return self.input_ids[start:end], labels
+
+
+def align_word_labels(tokenizer, sentences: Sequence[Sequence[str]], word_labels: Sequence[Sequence[int]],
+                      continuation: Optional[np.ndarray] = None, max_length: Optional[int] = None,
+                      ignore_index: int = -100) -> TokenizedDataset:
+    """Tokenize sentences that are split into words and give every subword token the label of its word.
+
+    Special tokens get ignore_index. Continuation subwords get the label continuation[label]
+    of their word (e.g. I-X for a B-X word), or ignore_index if continuation is None, so that
+    only the first subword of every word is labelled.
+    """
+    encodings = tokenizer(list(sentences), is_split_into_words=True, truncation=True, max_length=max_length)
+    token_labels = []
+    for i, labels in enumerate(word_labels):
+        previous_word = None
+        for word in encodings.word_ids(i):
+            if word is None:
+                token_labels.append(ignore_index)
+            elif word != previous_word:
+                token_labels.append(labels[word])
+            else:
+                token_labels.append(int(continuation[labels[word]]) if continuation is not None else ignore_index)
+            previous_word = word
+    return TokenizedDataset.from_token_ids(encodings['input_ids'], np.asarray(token_labels, dtype=np.int64), per_token=True)
+
+
+def continuation_tags(tag_names: Sequence[str]) -> np.ndarray:
+    """The tag of the continuation subwords of a word with each tag: I-X for B-X, the tag itself otherwise"""
+    continuation = np.arange(len(tag_names))
+    for i, tag in enumerate(tag_names):
+        if tag.startswith('B-') and f'I-{tag[2:]}' in tag_names:
+            continuation[i] = list(tag_names).index(f'I-{tag[2:]}')
+    return continuation
+
+
+def stratified_split(labels: np.ndarray, test_fraction: float, seed: int = 42) -> Tuple[np.ndarray, np.ndarray]:
+    """Split sentence indices in two, keeping the share of every label in both parts"""
+    rng = np.random.default_rng(seed)
+    train, test = [], []
+    for label in np.unique(labels):
+        members = rng.permutation(np.flatnonzero(labels == label))
+        count = int(round(len(members) * test_fraction))
+        test.append(members[:count])
+        train.append(members[count:])
+    return np.sort(np.concatenate(train)), np.sort(np.concatenate(test))
+
+
+class DynamicPaddingCollator:
+    """Pads a batch only to its own longest sentence"""
+
+    def __init__(self, pad_token_id: int, label_pad_id: int = -100):
+        self.pad_token_id = pad_token_id
+        self.label_pad_id = label_pad_id
+
+    def __call__(self, items: List[Tuple[np.ndarray, np.ndarray]]) -> dict:
+        longest = max(len(ids) for ids, _ in items)
+        input_ids = torch.full((len(items), longest), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(items), longest), dtype=torch.long)
+        per_token = np.ndim(items[0][1]) > 0
+        if per_token:
+            labels = torch.full((len(items), longest), self.label_pad_id, dtype=torch.long)
+        else:
+            labels = torch.tensor([int(label) for _, label in items], dtype=torch.long)
+
+        for row, (ids, item_labels) in enumerate(items):
+            input_ids[row, :len(ids)] = torch.from_numpy(ids.astype(np.int64))
+            attention_mask[row, :len(ids)] = 1
+            if per_token:
+                labels[row, :len(ids)] = torch.from_numpy(np.asarray(item_labels, dtype=np.int64))
+        return {'input_ids': input_ids, 'attention_mask': attention_mask, 'labels': labels}
+
+
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    """Yields batches of sentences of similar length, so little compute goes to padding.
+
+    The sentences are shuffled, cut into buckets of `bucket_batches` batches, sorted by
+    length within each bucket and then batched. The order of the batches is shuffled
+    again, so the model does not see the lengths in order.
+    """
+
+    def __init__(self, lengths: np.ndarray, batch_size: int, shuffle: bool = True, bucket_batches: int = 50, seed: int = 0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(bucket[i:i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size))
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return sum(math.ceil(len(self.lengths[start:start + self.bucket_size]) / self.batch_size)
+                   for start in range(0, len(self.lengths), self.bucket_size))
@@ -0,0 +1,260 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from tqdm.auto import tqdm
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils import data
+from transformers import AutoModelForSequenceClassification, AutoModelForTokenClassification, AutoTokenizer, AdamW, get_scheduler
+from datasets import load_dataset
+
+from autorecorderbot.intelligence import SentenceClassPredictor, TokenClassPredictor
+from batching import DynamicPaddingCollator, LengthBucketBatchSampler, TokenizedDataset, align_word_labels, continuation_tags
+from evaluation import IGNORE_INDEX, entity_scores, evaluate
+
+# Distills the sentence and token models of the bot into smaller students, trained on the
+# soft predictions of the current models on the TexPrax data and on the unlabeled messages
+# the bot recorded. The students are written in the layouts SentenceClassPredictor and
+# TokenClassPredictor load, together with a report comparing latency and F1 of teachers and
+# students. Requires the recorder-bot package (pip install -e ../recorder-bot).
+#
+# The label ids of the teachers must be the ids of the dataset labels, as is the case for
+# models trained with training.py and token_training.py.
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+parser = argparse.ArgumentParser(description='Distill the bot models into smaller students.')
+parser.add_argument('--sequence-teacher', default='models/sequence_classification_model', help='Bot sentence model directory')
+parser.add_argument('--token-teacher', default='models/token_classification_model', help='Bot token model directory')
+parser.add_argument('--student', default='distilbert-base-german-cased', help='Pretrained student model (e.g. 6 layers)')
+parser.add_argument('--output-dir', default='models/student', help='Directory for the students and the report')
+parser.add_argument('--tasks', nargs='+', default=['sequence', 'token'], choices=['sequence', 'token'])
+parser.add_argument('--messages-db', nargs='*', default=[],
+                    help='SQLite databases of the bot, their recorded messages are used as unlabeled data')
+parser.add_argument('--ner-config', default='ner', help='Configuration of the TexPrax dataset with token labels')
+parser.add_argument('--temperature', type=float, default=2.0, help='Softmax temperature of the soft targets')
+parser.add_argument('--alpha', type=float, default=0.5, help='Weight of the soft targets, the gold labels get 1 - alpha')
+parser.add_argument('--epochs', type=int, default=5, help='Number of epochs')
+parser.add_argument('--batch-size', type=int, default=32, help='Sentences per batch')
+parser.add_argument('--eval-batch-size', type=int, default=64, help='Sentences per batch during evaluation')
+parser.add_argument('--bf16', action='store_true', help='Train with bfloat16 autocast')
+parser.add_argument('--latency-runs', type=int, default=100, help='Single messages timed per model for the report')
+args = parser.parse_args()
+
+device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+logging.info(f"Using {device}")
+# The bot runs the models on the CPU, teachers and students are evaluated and timed there
+report_device = torch.device('cpu')
+
+
+def load_messages(paths):
+    """The distinct messages recorded by the bot"""
+    messages = set()
+    for path in paths:
+        with sqlite3.connect(path) as db:
+            messages.update(row[0] for row in db.execute("SELECT message FROM messages") if row[0] and row[0].strip())
+    logging.info(f"Loaded {len(messages)} unlabeled messages")
+    return sorted(messages)
+
+
+def row_dataset(tokenizer, sentences=None, words=None):
+    """Tokenize sentences, labelling each with its row in the target arrays.
+
+    Sentences are labelled as a whole. Sentences split into words are labelled on every subword,
+    as the bot predicts them: the first subword of the n-th word of all sentences gets row n, its
+    continuation subwords row num_words + n.
+    """
+    if words is None:
+        return TokenizedDataset.from_sentences(tokenizer, sentences, np.arange(len(sentences)))
+    rows, first = [], 0
+    for sentence in words:
+        rows.append(list(range(first, first + len(sentence))))
+        first += len(sentence)
+    return align_word_labels(tokenizer, words, rows, continuation=np.arange(first) + first)
+
+
+def continuation_logits(logits, continuation):
+    """Logits of the continuation subwords of a word from those of its first subword: the
+    probability of every B- tag moves to its I- tag"""
+    merged = torch.full_like(logits, float('-inf'))
+    for tag, target in enumerate(continuation):
+        merged[:, target] = torch.logaddexp(merged[:, target], logits[:, tag])
+    return merged
+
+
+def teacher_logits(model, dataset, num_rows, num_classes, pad_token_id):
+    """Predict the logits of every row of a row_dataset with a teacher.
+
+    Returns:
+        The logits, and which rows occurred in the dataset.
+    """
+    logits = np.zeros((num_rows, num_classes), dtype=np.float32)
+    seen = np.zeros(num_rows, dtype=bool)
+    loader = data.DataLoader(dataset, batch_sampler=LengthBucketBatchSampler(dataset.lengths, args.eval_batch_size, shuffle=False),
+                             collate_fn=DynamicPaddingCollator(pad_token_id))
+    model.to(device).eval()
+    with torch.inference_mode():
+        for batch in tqdm(loader, desc='teacher'):
+            rows = batch.pop('labels')
+            output = model(**{k: v.to(device) for k, v in batch.items()}).logits.float().cpu()
+            scored = rows != IGNORE_INDEX
+            logits[rows[scored].numpy()] = output[scored].numpy()
+            seen[rows[scored].numpy()] = True
+    # Back to where the report runs it
+    model.to(report_device)
+    return torch.from_numpy(logits), torch.from_numpy(seen)
+
+
+def distill(student, dataset, soft_targets, hard_labels, pad_token_id):
+    """Train the student on the soft targets of the teacher and the gold labels, where there are any"""
+    student.to(device).train()
+    sampler = LengthBucketBatchSampler(dataset.lengths, args.batch_size, shuffle=True)
+    loader = data.DataLoader(dataset, batch_sampler=sampler, collate_fn=DynamicPaddingCollator(pad_token_id))
+    optimizer = AdamW(student.parameters(), lr=5e-5)
+    lr_scheduler = get_scheduler(name="linear", optimizer=optimizer, num_warmup_steps=0,
+                                 num_training_steps=args.epochs * len(loader))
+    temperature = args.temperature
+
+    for epoch in range(args.epochs):
+        sampler.set_epoch(epoch)
+        epoch_start = time.perf_counter()
+        for batch in tqdm(loader, desc=f'epoch {epoch + 1}'):
+            rows = batch.pop('labels')
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.bf16):
+                logits = student(**{k: v.to(device) for k, v in batch.items()}).logits
+            scored = rows != IGNORE_INDEX
+            logits = logits[scored.to(device)].float()
+            rows = rows[scored]
+
+            soft = F.softmax(soft_targets[rows].to(device) / temperature, dim=-1)
+            loss = args.alpha * F.kl_div(F.log_softmax(logits / temperature, dim=-1), soft,
+                                         reduction='batchmean') * temperature ** 2
+            gold = hard_labels[rows].to(device)
+            labelled = gold != IGNORE_INDEX
+            if labelled.any():
+                loss = loss + (1 - args.alpha) * F.cross_entropy(logits[labelled], gold[labelled])
+
+            loss.backward()
+            optimizer.step()
+            lr_scheduler.step()
+            optimizer.zero_grad()
+        logging.info(f"Epoch {epoch + 1}: {time.perf_counter() - epoch_start:.0f}s")
+    student.eval()
+
+
+def latency(predictor, sentences):
+    """Milliseconds per single message (median and 95th percentile) and sentences/s in batches of 16"""
+    timings = []
+    for sentence in sentences[:args.latency_runs]:
+        start = time.perf_counter()
+        predictor.predict_batch([sentence])
+        timings.append(1000 * (time.perf_counter() - start))
+    start = time.perf_counter()
+    for i in range(0, len(sentences), 16):
+        predictor.predict_batch(sentences[i:i + 16])
+    throughput = len(sentences) / (time.perf_counter() - start)
+    return {"p50_ms": float(np.percentile(timings, 50)), "p95_ms": float(np.percentile(timings, 95)),
+            "batch16_sentences_per_s": throughput}
+
+
+def parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+os.makedirs(args.output_dir, exist_ok=True)
+messages = load_messages(args.messages_db)
+report = []
+
+if 'sequence' in args.tasks:
+    sentence_data = load_dataset("UKPLab/TexPrax", "sentence_cl")
+    teacher = SentenceClassPredictor(args.sequence_teacher)
+    num_labels = len(teacher.id2label)
+    if num_labels != len(sentence_data['train'].features['label'].names):
+        raise SystemExit(f"{args.sequence_teacher} does not predict the labels of the dataset")
+
+    sentences = list(sentence_data['train']['sentence']) + messages
+    hard_labels = torch.full((len(sentences),), IGNORE_INDEX, dtype=torch.long)
+    hard_labels[:len(sentence_data['train'])] = torch.tensor(sentence_data['train']['label'])
+    soft_targets, _ = teacher_logits(teacher.model, row_dataset(teacher.tokenizer, sentences), len(sentences), num_labels,
+                                     teacher.tokenizer.pad_token_id)
+
+    student = AutoModelForSequenceClassification.from_pretrained(
+        args.student, num_labels=num_labels,
+        id2label={int(i): label for i, label in teacher.id2label.items()},
+        label2id={label: int(i) for i, label in teacher.id2label.items()})
+    student_tokenizer = AutoTokenizer.from_pretrained(args.student)
+    distill(student, row_dataset(student_tokenizer, sentences), soft_targets, hard_labels, student_tokenizer.pad_token_id)
+
+    student_dir = os.path.join(args.output_dir, 'sequence_classification_model')
+    student.save_pretrained(student_dir)
+
+    test = sentence_data['test']
+    for name, predictor in (('teacher', teacher), ('student', SentenceClassPredictor(student_dir))):
+        test_dataset = TokenizedDataset.from_sentences(predictor.tokenizer, test['sentence'], test['label'])
+        loader = data.DataLoader(test_dataset, batch_size=args.eval_batch_size,
+                                 collate_fn=DynamicPaddingCollator(predictor.tokenizer.pad_token_id))
+        f1 = evaluate(predictor.model, loader, num_labels, report_device).macro_f1
+        report.append({"task": "sequence", "model": name, "parameters": parameters(predictor.model), "macro_f1": f1,
+                       **latency(predictor, list(test['sentence']))})
+
+if 'token' in args.tasks:
+    token_data = load_dataset("UKPLab/TexPrax", args.ner_config)
+    teacher = TokenClassPredictor(args.token_teacher)
+    unique_tags = teacher.model_config['unique_tags']
+    tags_feature = token_data['train'].features['tags'].feature
+    if list(getattr(tags_feature, 'names', unique_tags)) != list(unique_tags):
+        raise SystemExit(f"{args.token_teacher} does not predict the tags of the dataset")
+
+    words = [list(tokens) for tokens in token_data['train']['tokens']] + [message.split() for message in messages]
+    num_words = sum(len(sentence) for sentence in words)
+    # Continuation subwords of a B- word are inside the entity, as in token_training.py
+    continuation = continuation_tags(unique_tags)
+    # Rows of the first subwords of all words, then of their continuation subwords
+    hard_labels = torch.full((2 * num_words,), IGNORE_INDEX, dtype=torch.long)
+    labelled_words = [tag for tags in token_data['train']['tags'] for tag in tags]
+    if not hasattr(tags_feature, 'names'):
+        labelled_words = [unique_tags.index(tag) for tag in labelled_words]
+    hard_labels[:len(labelled_words)] = torch.tensor(labelled_words)
+    hard_labels[num_words:num_words + len(labelled_words)] = torch.from_numpy(continuation[labelled_words])
+    soft_targets, seen = teacher_logits(teacher.model, row_dataset(teacher.tokenizer, words=words), 2 * num_words,
+                                        len(unique_tags), teacher.tokenizer.pad_token_id)
+    # The teacher keeps some words whole that the student may split
+    whole = ~seen[num_words:]
+    soft_targets[num_words:][whole] = continuation_logits(soft_targets[:num_words][whole], continuation)
+
+    student_tokenizer = AutoTokenizer.from_pretrained(args.student)
+    student = AutoModelForTokenClassification.from_pretrained(args.student, num_labels=len(unique_tags))
+    distill(student, row_dataset(student_tokenizer, words=words), soft_targets, hard_labels, student_tokenizer.pad_token_id)
+
+    student_dir = os.path.join(args.output_dir, 'token_classification_model')
+    os.makedirs(student_dir, exist_ok=True)
+    torch.save(student.state_dict(), os.path.join(student_dir, 'pytorch_model.bin'))
+    with open(os.path.join(student_dir, 'config.json'), 'w') as f:
+        json.dump({"base_model": args.student, "id2tag": teacher.id2tag, "unique_tags": unique_tags},
+                  f, indent=2, ensure_ascii=False)
+
+    test = token_data['test']
+    test_tags = [list(tags) if hasattr(tags_feature, 'names') else [unique_tags.index(t) for t in tags] for tags in test['tags']]
+    test_sentences = [" ".join(tokens) for tokens in test['tokens']]
+    for name, predictor in (('teacher', teacher), ('student', TokenClassPredictor(student_dir))):
+        test_dataset = align_word_labels(predictor.tokenizer, test['tokens'], test_tags)
+        f1, _ = entity_scores(predictor.model, test_dataset, unique_tags, args.eval_batch_size, report_device,
+                              predictor.tokenizer.pad_token_id)
+        report.append({"task": "token", "model": name, "parameters": parameters(predictor.model), "entity_f1": f1,
+                       **latency(predictor, test_sentences)})
+
+with open(os.path.join(args.output_dir, 'report.json'), 'w') as f:
+    json.dump(report, f, indent=2)
+for row in report:
+    f1 = row.get('macro_f1', row.get('entity_f1'))
+    logging.info(f"{row['task']:>8} {row['model']:>7}: {row['parameters'] / 1e6:.0f}M parameters, F1 {f1:.4f}, "
+                 f"{row['p50_ms']:.1f} ms median / {row['p95_ms']:.1f} ms p95 per message, "
+                 f"{row['batch16_sentences_per_s']:.0f} sentences/s in batches of 16")
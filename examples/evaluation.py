@@ -0,0 +1,156 @@
+import argparse
+import logging
+import sys
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+import torch
+from torch.utils import data
+
+from batching import DynamicPaddingCollator
+
+# Label id of padding and of subword tokens that are not scored
+IGNORE_INDEX = -100
+
+
+class EvaluationResult(NamedTuple):
+    macro_f1: float
+    accuracy: float
+    # confusion_matrix[i, j]: items of true label i predicted as label j
+    confusion_matrix: np.ndarray
+    predictions: np.ndarray
+    labels: np.ndarray
+
+
+def macro_f1(confusion_matrix: np.ndarray) -> float:
+    """Macro-averaged F1 over every label that occurs in the gold labels or the predictions"""
+    true_positives = np.diag(confusion_matrix).astype(np.float64)
+    gold = confusion_matrix.sum(axis=1)
+    predicted = confusion_matrix.sum(axis=0)
+    present = (gold + predicted) > 0
+    f1 = np.divide(2 * true_positives, gold + predicted, out=np.zeros_like(true_positives), where=present)
+    return float(f1[present].mean()) if present.any() else 0.0
+
+
+def evaluate(model, loader: data.DataLoader, num_labels: int, device=torch.device('cpu'),
+             capacity: Optional[int] = None) -> EvaluationResult:
+    """Evaluate a sentence or token classification model batch by batch.
+
+    Predictions are the argmax over the class axis of every batch. Positions labelled
+    IGNORE_INDEX (padding, subword tokens) are skipped, so the same loop scores sentence
+    labels of shape (batch,) and token labels of shape (batch, length).
+
+    Args:
+        model: A transformers classification model.
+
+        loader: Batches with input_ids, attention_mask and labels.
+
+        num_labels: Number of classes.
+
+        capacity: Maximum number of scored labels, the number of sentences of the
+            dataset by default. Pass the number of tokens for token classification.
+    """
+    capacity = capacity or len(loader.dataset)
+    predictions = np.empty(capacity, dtype=np.int64)
+    labels = np.empty(capacity, dtype=np.int64)
+    filled = 0
+
+    was_training = model.training
+    model.eval()
+    with torch.inference_mode():
+        for batch in loader:
+            batch_labels = batch.pop('labels')
+            logits = model(**{k: v.to(device) for k, v in batch.items()}).logits
+            batch_predictions = logits.argmax(dim=-1).cpu()
+
+            scored = batch_labels != IGNORE_INDEX
+            count = int(scored.sum())
+            predictions[filled:filled + count] = batch_predictions[scored].numpy()
+            labels[filled:filled + count] = batch_labels[scored].numpy()
+            filled += count
+    model.train(was_training)
+
+    predictions, labels = predictions[:filled], labels[:filled]
+    confusion_matrix = np.bincount(labels * num_labels + predictions, minlength=num_labels ** 2).reshape(num_labels, num_labels)
+    accuracy = float(np.trace(confusion_matrix) / filled) if filled else 0.0
+    return EvaluationResult(macro_f1(confusion_matrix), accuracy, confusion_matrix, predictions, labels)
+
+
+def entity_scores(model, dataset, tag_names: List[str], batch_size: int = 64, device=torch.device('cpu'),
+                  pad_token_id: int = 0):
+    """Score the entities predicted for every sentence with seqeval.
+
+    Args:
+        dataset: A per-token TokenizedDataset in which only the first subword of every
+            word is labelled, see `batching.align_word_labels`.
+
+    Returns:
+        The entity F1 and the seqeval classification report.
+    """
+    from seqeval.metrics import classification_report, f1_score
+
+    collator = DynamicPaddingCollator(pad_token_id, label_pad_id=IGNORE_INDEX)
+    loader = data.DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=collator)
+    result = evaluate(model, loader, len(tag_names), device, capacity=len(dataset.input_ids))
+
+    # The scored positions are the words of the sentences, in order
+    words_per_sentence = np.add.reduceat((dataset.labels != IGNORE_INDEX).astype(np.int64), dataset.offsets[:-1])
+    bounds = np.concatenate([[0], np.cumsum(words_per_sentence)])
+    gold = [[tag_names[t] for t in result.labels[start:end]] for start, end in zip(bounds[:-1], bounds[1:])]
+    predicted = [[tag_names[t] for t in result.predictions[start:end]] for start, end in zip(bounds[:-1], bounds[1:])]
+    return f1_score(gold, predicted), classification_report(gold, predicted, zero_division=0)
+
+
+def format_confusion_matrix(confusion_matrix: np.ndarray, label_names: List[str]) -> str:
+    """Render the confusion matrix as a table, gold labels in rows and predictions in columns"""
+    width = max(6, *(len(name) for name in label_names))
+    lines = [" " * width + " " + " ".join(f"{name:>{width}}" for name in label_names)]
+    for name, row in zip(label_names, confusion_matrix):
+        lines.append(f"{name:>{width}} " + " ".join(f"{count:>{width}}" for count in row))
+    return "\n".join(lines)
+
+
+def log_result(result: EvaluationResult, label_names: List[str]):
+    logging.info(f"macro averaged F1 score: {result.macro_f1:.4f}, accuracy: {result.accuracy:.4f}")
+    logging.info("Confusion matrix (rows: gold, columns: predicted):\n"
+                 + format_confusion_matrix(result.confusion_matrix, label_names))
+
+
+if __name__ == '__main__':
+    # Release check: evaluate a trained checkpoint on the test split and fail if it is not good enough
+    from datasets import load_dataset
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    from batching import LengthBucketBatchSampler, TokenizedDataset
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+
+    parser = argparse.ArgumentParser(description='Evaluate a sentence classification checkpoint on the TexPrax test split.')
+    parser.add_argument('--model', default='bert-base-german-cased', help='Model to use')
+    parser.add_argument('--checkpoint', default='models/model.pt', help='Model checkpoint')
+    parser.add_argument('--batch-size', type=int, default=64, help='Sentences per batch')
+    parser.add_argument('--min-f1', type=float, default=None, help='Exit with status 1 if the macro F1 is lower')
+    args = parser.parse_args()
+
+    test_data = load_dataset("UKPLab/TexPrax", "sentence_cl", split="test")
+    label_names = test_data.features['label'].names
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    test_dataset = TokenizedDataset.from_sentences(tokenizer, test_data['sentence'], test_data['label'])
+    test_loader = data.DataLoader(
+        test_dataset,
+        batch_sampler=LengthBucketBatchSampler(test_dataset.lengths, args.batch_size, shuffle=False),
+        collate_fn=DynamicPaddingCollator(tokenizer.pad_token_id))
+
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    model = AutoModelForSequenceClassification.from_pretrained(args.model, num_labels=len(label_names))
+    model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    model.to(device)
+
+    result = evaluate(model, test_loader, len(label_names), device)
+    log_result(result, label_names)
+    if args.min_f1 is not None and result.macro_f1 < args.min_f1:
+        logging.error(f"Macro F1 {result.macro_f1:.4f} is below the required {args.min_f1}")
+        sys.exit(1)
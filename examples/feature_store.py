@@ -0,0 +1,154 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from batching import TokenizedDataset
+
+# Directory of the cached features, shared by all scripts of this folder
+DEFAULT_CACHE_DIR = os.environ.get('TEXPRAX_FEATURE_CACHE', os.path.join('models', 'features'))
+
+# Arrays of a TokenizedDataset, one .npy file each
+ARRAYS = ('input_ids', 'offsets', 'labels')
+
+
+class FeatureStore:
+    """Tokenized splits of a dataset, cached on disk as memory-mapped NumPy arrays.
+
+    The features of every split are stored once per dataset revision, tokenizer and
+    maximum length, so later runs neither load the dataset nor tokenize it again. The
+    label names of the dataset are stored as well, for scripts that only need to turn
+    predicted ids into names.
+
+    Without network access the last revision resolved for the dataset is used, so a store
+    filled once keeps working offline.
+
+    Args:
+        cache_dir: Directory of the cached features.
+
+        dataset: Name of the dataset on the Hugging Face Hub.
+
+        config: Configuration of the dataset, with a `sentence` and a `label` column.
+
+        revision: Revision (commit) of the dataset, the latest one by default.
+
+        refresh: Look up the latest revision on the Hub. If False, the last revision
+            resolved before is used without any network access, if there is one.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, dataset: str = 'UKPLab/TexPrax',
+                 config: str = 'sentence_cl', revision: Optional[str] = None, refresh: bool = True):
+        self.cache_dir = cache_dir
+        self.dataset = dataset
+        self.config = config
+        self.refresh = refresh
+        self._revision = revision
+
+    @property
+    def _dataset_dir(self) -> str:
+        return os.path.join(self.cache_dir, self.dataset.replace('/', '--'), self.config)
+
+    @property
+    def revision(self) -> str:
+        """The dataset revision the features belong to"""
+        if self._revision is None:
+            self._revision = self._resolve_revision()
+        return self._revision
+
+    def _resolve_revision(self) -> str:
+        known_path = os.path.join(self._dataset_dir, 'revision')
+        if self.refresh and os.environ.get('HF_DATASETS_OFFLINE') != '1':
+            try:
+                from huggingface_hub import HfApi
+                revision = HfApi().dataset_info(self.dataset).sha
+                os.makedirs(self._dataset_dir, exist_ok=True)
+                with open(known_path, 'w') as f:
+                    f.write(revision)
+                return revision
+            except Exception as e:
+                logging.warning(f"Could not look up the latest revision of {self.dataset}: {e}")
+        try:
+            with open(known_path) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            if not self.refresh:
+                self.refresh = True
+                return self._resolve_revision()
+            raise RuntimeError(f"No cached revision of {self.dataset}, run once with network access") from None
+
+    def _features_dir(self, tokenizer, max_length: Optional[int]) -> str:
+        key = json.dumps({
+            'tokenizer': tokenizer.name_or_path,
+            'tokenizer_class': type(tokenizer).__name__,
+            'max_length': max_length,
+        }, sort_keys=True)
+        return os.path.join(self._dataset_dir, self.revision, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+    def label_names(self) -> List[str]:
+        """Names of the labels, by label id"""
+        path = os.path.join(self._dataset_dir, self.revision, 'labels.json')
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        # Only the metadata of the dataset is needed, not the data
+        from datasets import load_dataset_builder
+        builder = load_dataset_builder(self.dataset, self.config, revision=self.revision)
+        names = list(builder.info.features['label'].names)
+        self._write_labels(names)
+        return names
+
+    def _write_labels(self, names: List[str]):
+        directory = os.path.join(self._dataset_dir, self.revision)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'labels.json'), 'w') as f:
+            json.dump(names, f, ensure_ascii=False)
+
+    def tokenized(self, tokenizer, max_length: Optional[int] = None,
+                  splits: Sequence[str] = ('train', 'test')) -> Dict[str, TokenizedDataset]:
+        """The tokenized splits, loaded from the cache or tokenized and cached on first use"""
+        directory = self._features_dir(tokenizer, max_length)
+        missing = [split for split in splits if not os.path.exists(os.path.join(directory, split, 'meta.json'))]
+        if missing:
+            self._build(tokenizer, max_length, missing, directory)
+        else:
+            logging.info(f"Using cached features from {directory}")
+        return {split: load_features(os.path.join(directory, split)) for split in splits}
+
+    def _build(self, tokenizer, max_length: Optional[int], splits: Sequence[str], directory: str):
+        from datasets import load_dataset
+        dataset = load_dataset(self.dataset, self.config, revision=self.revision)
+        self._write_labels(list(dataset[splits[0]].features['label'].names))
+        for split in splits:
+            logging.info(f"Tokenizing the {split} split of {self.dataset}")
+            features = TokenizedDataset.from_sentences(tokenizer, dataset[split]['sentence'], dataset[split]['label'],
+                                                       max_length)
+            save_features(features, os.path.join(directory, split))
+
+
+def save_features(features: TokenizedDataset, directory: str):
+    """Write the arrays of a TokenizedDataset, replacing the directory at once"""
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=parent)
+    for name in ARRAYS:
+        np.save(os.path.join(staging, f'{name}.npy'), getattr(features, name))
+    # Written last, a directory without it is incomplete
+    with open(os.path.join(staging, 'meta.json'), 'w') as f:
+        json.dump({'per_token': features.per_token, 'sentences': len(features)}, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(staging, directory)
+
+
+def load_features(directory: str) -> TokenizedDataset:
+    """Map the arrays of a cached TokenizedDataset into memory, without reading them"""
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r') for name in ARRAYS}
+    return TokenizedDataset(arrays['input_ids'], arrays['offsets'], arrays['labels'], per_token=meta['per_token'])
@@ -1,28 +1,33 @@
 import argparse
 import logging
 
-import numpy as np
 import torch
+from torch.utils import data
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
-from datasets import load_dataset 
+
+from batching import DynamicPaddingCollator, LengthBucketBatchSampler
+from evaluation import evaluate, log_result
+from feature_store import DEFAULT_CACHE_DIR, FeatureStore
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
     level=logging.INFO,
     datefmt='%Y-%m-%d %H:%M:%S')
-    
-label_dict = {"P":0,
-              "C":1,
-              "S":2,
-              "O":3}
-              
-label_idx = {v:k for k,v in label_dict.items()}
 
 parser = argparse.ArgumentParser(description='Process some integers.')
 parser.add_argument('--model', default='bert-base-german-cased', help='Model to use') # check: https://huggingface.co/bert-base-german-cased
 parser.add_argument('--checkpoint', default='models/model.pt', help='Model checkpoints')
+parser.add_argument('--evaluate', action='store_true', help='Also evaluate the checkpoint on the test split')
+parser.add_argument('--batch-size', type=int, default=64, help='Sentences per batch during evaluation')
+parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Directory of the cached tokenized features')
+parser.add_argument('--dataset-revision', default=None, help='Revision of the dataset, the latest one by default')
 args = parser.parse_args()
 
+# The label names come from the feature store, the dataset itself is not loaded. The revision
+# the features were last built from is used, so this needs no network access once cached
+store = FeatureStore(args.cache_dir, "UKPLab/TexPrax", "sentence_cl", revision=args.dataset_revision, refresh=False)
+label_names = store.label_names()
+
 tokenizer = AutoTokenizer.from_pretrained(args.model)
 
 # Example prediction
@@ -33,20 +38,26 @@ test_encodings = tokenizer([test_sentence], is_split_into_words=False, padding=T
 device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 logging.info(f"Using {device}")
 
-model = AutoModelForSequenceClassification.from_pretrained(args.model, num_labels=len(label_dict))
+model = AutoModelForSequenceClassification.from_pretrained(args.model, num_labels=len(label_names))
 
 model.to(device)  
-model.load_state_dict(torch.load(args.checkpoint))
+model.load_state_dict(torch.load(args.checkpoint, map_location=device))
 
 model.eval() #Drop gradients for evaluation (increases efficiency)
 
 input_pred = {k: torch.tensor(v).to(device) for k, v in test_encodings.items()}
 
-outputs = model(**input_pred)
+with torch.inference_mode():
+    outputs = model(**input_pred)
 
-prediction = np.argmax(outputs.logits.cpu().detach().numpy()) # Fetch predicted labels
+prediction = outputs.logits.argmax(dim=-1)[0] # Fetch predicted labels
 
-dataset = load_dataset("UKPLab/TexPrax", "sentence_cl", split="test")
-label = dataset.features['label'].int2str(int(prediction))
-logging.info(f"Predicted label: {label}")
+logging.info(f"Predicted label: {label_names[int(prediction)]}")
 
+if args.evaluate:
+    test_dataset = store.tokenized(tokenizer, splits=('test',))['test']
+    test_loader = data.DataLoader(
+        test_dataset,
+        batch_sampler=LengthBucketBatchSampler(test_dataset.lengths, args.batch_size, shuffle=False),
+        collate_fn=DynamicPaddingCollator(tokenizer.pad_token_id))
+    log_result(evaluate(model, test_loader, len(label_names), device), label_names)
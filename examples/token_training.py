@@ -0,0 +1,161 @@
+import argparse
+import json
+import logging
+import math
+import os
+import time
+
+from tqdm.auto import tqdm
+import torch
+from torch.utils import data
+from transformers import AutoModelForTokenClassification, AutoTokenizer, AdamW, get_scheduler
+from datasets import load_dataset
+
+from batching import DynamicPaddingCollator, LengthBucketBatchSampler, align_word_labels, continuation_tags
+from evaluation import IGNORE_INDEX, entity_scores
+
+# Trains the token classification model of the bot. The output directory has the layout
+# TokenClassPredictor expects: config.json with base_model, id2tag and unique_tags, and the
+# weights in pytorch_model.bin.
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+parser = argparse.ArgumentParser(description='Train the token classification model of the bot.')
+parser.add_argument('--model', default='bert-base-german-cased', help='Model to use') # check: https://huggingface.co/bert-base-german-cased
+parser.add_argument('--output-dir', default='models/token_classification_model', help='Directory to save the model to')
+parser.add_argument('--dataset-config', default='ner', help='Configuration of the TexPrax dataset with token labels')
+parser.add_argument('--tokens-column', default='tokens', help='Dataset column with the words of a sentence')
+parser.add_argument('--tags-column', default='tags', help='Dataset column with the tag of every word')
+parser.add_argument('--epochs', type=int, default=5, help='Number of epochs')
+parser.add_argument('--batch-size', type=int, default=16, help='Sentences per batch')
+parser.add_argument('--gradient-accumulation-steps', type=int, default=1,
+                    help='Batches whose gradients are summed up before each optimizer step')
+parser.add_argument('--eval-batch-size', type=int, default=64, help='Sentences per batch during evaluation')
+parser.add_argument('--max-length', type=int, default=None, help='Truncate sentences to this many subword tokens')
+parser.add_argument('--validation-fraction', type=float, default=0.1,
+                    help='Share of the training data held out to pick the best epoch')
+parser.add_argument('--first-subword-only', action='store_true',
+                    help='Train only on the first subword of every word. By default all subwords are trained, '
+                         'as the bot labels every subword token.')
+parser.add_argument('--bf16', action='store_true', help='Train with bfloat16 autocast (CPUs with AVX512-BF16/AMX, recent GPUs)')
+parser.add_argument('--num-workers', type=int, default=0, help='Processes preparing batches in the background')
+parser.add_argument('--seed', type=int, default=42)
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+
+dataset = load_dataset("UKPLab/TexPrax", args.dataset_config)
+
+# Tags are either class labels or plain strings
+tags_feature = dataset['train'].features[args.tags_column].feature
+if hasattr(tags_feature, 'names'):
+    unique_tags = list(tags_feature.names)
+    def tag_ids(tags):
+        return list(tags)
+else:
+    unique_tags = sorted({tag for split in dataset.values() for tags in split[args.tags_column] for tag in tags})
+    tag2id = {tag: i for i, tag in enumerate(unique_tags)}
+    def tag_ids(tags):
+        return [tag2id[tag] for tag in tags]
+
+# Continuation subwords of a B- word are inside the entity
+continuation = continuation_tags(unique_tags)
+
+tokenizer = AutoTokenizer.from_pretrained(args.model)
+
+
+# Hold out part of the training data to select the best epoch on, the test split stays unseen
+splits = dataset['train'].train_test_split(test_size=args.validation_fraction, seed=args.seed)
+
+
+def align_labels(split, label_all_subwords):
+    return align_word_labels(tokenizer, split[args.tokens_column], [tag_ids(tags) for tags in split[args.tags_column]],
+                             continuation=continuation if label_all_subwords else None, max_length=args.max_length)
+
+
+train_dataset = align_labels(splits['train'], label_all_subwords=not args.first_subword_only)
+# Entities are scored on words, i.e. the tag predicted for the first subword of each word
+validation_dataset = align_labels(splits['test'], label_all_subwords=False)
+test_dataset = align_labels(dataset['test'], label_all_subwords=False)
+
+# Every batch is only padded to its longest sentence
+collator = DynamicPaddingCollator(tokenizer.pad_token_id, label_pad_id=IGNORE_INDEX)
+
+# Enable using a GPU if available
+device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+logging.info(f"Using {device}")
+
+model = AutoModelForTokenClassification.from_pretrained(args.model, num_labels=len(unique_tags))
+model.to(device)
+model.train() # Enables the update of weights
+
+# Training batches are bucketed by length, evaluation batches keep the order of the sentences
+train_sampler = LengthBucketBatchSampler(train_dataset.lengths, args.batch_size, shuffle=True, seed=args.seed)
+train_loader = data.DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=collator,
+                               num_workers=args.num_workers, persistent_workers=args.num_workers > 0,
+                               pin_memory=device.type == 'cuda')
+
+
+def save_model(model, output_dir):
+    """Write the model in the format of TokenClassPredictor"""
+    os.makedirs(output_dir, exist_ok=True)
+    torch.save(model.state_dict(), os.path.join(output_dir, 'pytorch_model.bin'))
+    with open(os.path.join(output_dir, 'config.json'), 'w') as f:
+        json.dump({
+            "base_model": args.model,
+            "id2tag": {str(i): tag for i, tag in enumerate(unique_tags)},
+            "unique_tags": unique_tags,
+        }, f, indent=2, ensure_ascii=False)
+
+
+# Our optimizer
+optimizer = AdamW(model.parameters(), lr=5e-5)
+
+steps_per_epoch = math.ceil(len(train_loader) / args.gradient_accumulation_steps)
+num_training_steps = args.epochs * steps_per_epoch
+lr_scheduler = get_scheduler(
+    name="linear", optimizer=optimizer, num_warmup_steps=0, num_training_steps=num_training_steps
+    )
+
+progress_bar = tqdm(range(num_training_steps))
+best_f1 = -1.0
+
+for epoch in range(args.epochs):
+    train_sampler.set_epoch(epoch)
+    epoch_start = time.perf_counter()
+    real_tokens = 0
+
+    for step, batch in enumerate(train_loader):
+        real_tokens += int(batch['attention_mask'].sum())
+        batch = {k: v.to(device, non_blocking=True) for k, v in batch.items()}
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.bf16):
+            outputs = model(**batch)
+        # Average the loss over the accumulated batches
+        loss = outputs.loss / args.gradient_accumulation_steps
+        loss.backward() #Backward pass
+        if (step + 1) % args.gradient_accumulation_steps == 0 or step + 1 == len(train_loader):
+            optimizer.step()
+            lr_scheduler.step()
+            optimizer.zero_grad()
+            progress_bar.update(1)
+
+    elapsed = time.perf_counter() - epoch_start
+    logging.info(f"Epoch {epoch + 1}: {elapsed:.0f}s, {real_tokens / elapsed:.0f} tokens/s")
+
+    # Only keep the model of the best epoch
+    validation_f1, _ = entity_scores(model, validation_dataset, unique_tags, args.eval_batch_size, device,
+                                     tokenizer.pad_token_id)
+    if validation_f1 > best_f1:
+        best_f1 = validation_f1
+        save_model(model, args.output_dir)
+        logging.info(f"Validation entity F1 {validation_f1:.4f}, saved {args.output_dir}")
+    else:
+        logging.info(f"Validation entity F1 {validation_f1:.4f}, best is still {best_f1:.4f}")
+
+# Evaluate the best epoch on the test data
+model.load_state_dict(torch.load(os.path.join(args.output_dir, 'pytorch_model.bin'), map_location=device))
+test_f1, report = entity_scores(model, test_dataset, unique_tags, args.eval_batch_size, device, tokenizer.pad_token_id)
+logging.info(f"Test entity F1: {test_f1:.4f}\n{report}")
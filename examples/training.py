@@ -1,13 +1,16 @@
 import argparse
 import logging
+import math
+import time
 
 from tqdm.auto import tqdm
-import numpy as np
 import torch
 from torch.utils import data
 from transformers import AutoModelForSequenceClassification, AutoTokenizer, AdamW, get_scheduler
-from datasets import load_dataset 
-from sklearn.metrics import f1_score  
+
+from batching import DynamicPaddingCollator, LengthBucketBatchSampler, stratified_split
+from evaluation import evaluate, log_result
+from feature_store import DEFAULT_CACHE_DIR, FeatureStore
 
 
 logging.basicConfig(
@@ -19,89 +22,116 @@ parser = argparse.ArgumentParser(description='Process some integers.')
 parser.add_argument('--model', default='bert-base-german-cased', help='Model to use') # check: https://huggingface.co/bert-base-german-cased
 parser.add_argument('--checkpoint', default='models/model.pt', help='Model checkpoints')
 parser.add_argument('--epochs', type=int, default=5, help='Number of epochs')
+parser.add_argument('--batch-size', type=int, default=16, help='Sentences per batch')
+parser.add_argument('--gradient-accumulation-steps', type=int, default=1,
+                    help='Batches whose gradients are summed up before each optimizer step')
+parser.add_argument('--eval-batch-size', type=int, default=64, help='Sentences per batch during evaluation')
+parser.add_argument('--max-length', type=int, default=None, help='Truncate sentences to this many subword tokens')
+parser.add_argument('--validation-fraction', type=float, default=0.1,
+                    help='Share of the training data held out to pick the best epoch')
+parser.add_argument('--bf16', action='store_true', help='Train with bfloat16 autocast (CPUs with AVX512-BF16/AMX, recent GPUs)')
+parser.add_argument('--compile', action='store_true', help='Compile the model with torch.compile')
+parser.add_argument('--num-workers', type=int, default=0, help='Processes preparing batches in the background')
+parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Directory of the cached tokenized features')
+parser.add_argument('--dataset-revision', default=None, help='Revision of the dataset, the latest one by default')
 args = parser.parse_args()
 
-dataset = load_dataset("UKPLab/TexPrax", "sentence_cl") # load sentence classification
-
+# Subword-tokenize training and test data once, into compact arrays without padding. Later
+# runs map the cached arrays instead of loading and tokenizing the dataset again:
 tokenizer = AutoTokenizer.from_pretrained(args.model)
+store = FeatureStore(args.cache_dir, "UKPLab/TexPrax", "sentence_cl", revision=args.dataset_revision) # sentence classification
+features = store.tokenized(tokenizer, args.max_length)
+label_names = store.label_names()
 
-# Subword-tokenize training and test data:
-train_encodings = tokenizer(dataset['train']['sentence'], is_split_into_words=False, padding=True, truncation=True)
-test_encodings = tokenizer(dataset['test']['sentence'], is_split_into_words=False, padding=True, truncation=True)
-
-class SimpleDataset(torch.utils.data.Dataset):
-    def __init__(self, encodings, labels):
-        self.encodings = encodings
-        self.labels = labels
-
-    def __getitem__(self, idx):
-        item = {key: torch.tensor(val[idx]) for key, val in self.encodings.items()}
-        item['labels'] = torch.tensor(self.labels[idx])
-        return item
+# Hold out part of the training data to select the best epoch on, the test split stays unseen
+train_indices, validation_indices = stratified_split(features['train'].labels, args.validation_fraction, seed=42)
+train_dataset = features['train'].subset(train_indices)
+validation_dataset = features['train'].subset(validation_indices)
+test_dataset = features['test']
 
-    def __len__(self):
-        return len(self.labels)
-
-
-# Create datasets:
-train_dataset = SimpleDataset(train_encodings, dataset['train']['label'])
-test_dataset = SimpleDataset(test_encodings, dataset['test']['label'])
+# Every batch is only padded to its longest sentence
+collator = DynamicPaddingCollator(tokenizer.pad_token_id)
 
 # Enable using a GPU if available
 device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 logging.info(f"Using {device}")
 
-model = AutoModelForSequenceClassification.from_pretrained(args.model, num_labels=len(set(dataset['train']['label'])))
+model = AutoModelForSequenceClassification.from_pretrained(args.model, num_labels=len(label_names))
 
 model.to(device)
 model.train() # Enables the update of weights
 
-# PyTorch DataLoader handles batching and other routines for Datasets during training:
-train_loader = data.DataLoader(train_dataset, batch_size=4, shuffle=True)
+# Compiling takes a while up front, but speeds up every following step. The shapes of
+# the batches vary, so the graph is compiled for dynamic shapes.
+train_model = torch.compile(model, dynamic=True) if args.compile else model
+
+def make_loader(dataset, batch_size, shuffle):
+    # Pinned memory speeds up copies to a GPU, it does not help on CPU
+    return data.DataLoader(
+        dataset,
+        batch_sampler=LengthBucketBatchSampler(dataset.lengths, batch_size, shuffle=shuffle),
+        collate_fn=collator,
+        num_workers=args.num_workers,
+        persistent_workers=args.num_workers > 0,
+        pin_memory=device.type == 'cuda')
+
+# PyTorch DataLoader handles batching and other routines for Datasets during training.
+# Sentences of similar length are batched together, so there is little padding:
+train_loader = make_loader(train_dataset, args.batch_size, shuffle=True)
+train_sampler = train_loader.batch_sampler
+validation_loader = make_loader(validation_dataset, args.eval_batch_size, shuffle=False)
 
 # Our optimizer
 optimizer = AdamW(model.parameters(), lr=5e-5)
 
-num_training_steps = args.epochs * len(train_loader)
+steps_per_epoch = math.ceil(len(train_loader) / args.gradient_accumulation_steps)
+num_training_steps = args.epochs * steps_per_epoch
 lr_scheduler = get_scheduler(
     name="linear", optimizer=optimizer, num_warmup_steps=0, num_training_steps=num_training_steps
     )       
 
 progress_bar = tqdm(range(num_training_steps))
+best_f1 = -1.0
 
 for epoch in range(args.epochs):
-
-    for batch in train_loader:
-        batch = {k: v.to(device) for k, v in batch.items()}
-        outputs = model(**batch)
-        loss = outputs.loss
+    train_sampler.set_epoch(epoch)
+    epoch_start = time.perf_counter()
+    real_tokens = padded_tokens = 0
+
+    for step, batch in enumerate(train_loader):
+        real_tokens += int(batch['attention_mask'].sum())
+        padded_tokens += batch['attention_mask'].numel()
+        batch = {k: v.to(device, non_blocking=True) for k, v in batch.items()}
+        # Matrix multiplications run in bfloat16, the weights and their updates stay fp32
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.bf16):
+            outputs = train_model(**batch)
+        # Average the loss over the accumulated batches
+        loss = outputs.loss / args.gradient_accumulation_steps
         loss.backward() #Backward pass
-        optimizer.step()
-        lr_scheduler.step()
-        optimizer.zero_grad()
-        progress_bar.update(1)
-
-    # Save model
-    torch.save(model.state_dict(), args.checkpoint)
-
-model.eval() #Drop gradients for evaluation (increases efficiency)
-
-test_loader = data.DataLoader(test_dataset, shuffle=False)
-
-preds = []
-true = []
-
-for batch in test_loader:
-    batch = {k: v.to(device) for k, v in batch.items()}
-    outputs = model(**batch)
-
-    predictions = np.argmax(outputs.logits.cpu().detach().numpy()) # Fetch predicted labels
-    labels = batch['labels'].detach().numpy()
-    
-    true.append(labels)
-    preds.append(predictions)
-    
-f1_score = f1_score(preds, true, average='macro') # Do class distribution invariant computation
-
-logging.info(f"macro averaged F1 score: {f1_score}")
-
+        if (step + 1) % args.gradient_accumulation_steps == 0 or step + 1 == len(train_loader):
+            optimizer.step()
+            lr_scheduler.step()
+            optimizer.zero_grad()
+            progress_bar.update(1)
+
+    elapsed = time.perf_counter() - epoch_start
+    logging.info(f"Epoch {epoch + 1}: {elapsed:.0f}s, {len(train_dataset) / elapsed:.1f} sentences/s, "
+                 f"{real_tokens / elapsed:.0f} tokens/s, {100 * (1 - real_tokens / padded_tokens):.1f}% padding")
+
+    # Only keep the checkpoint of the best epoch
+    validation_f1 = evaluate(model, validation_loader, len(label_names), device).macro_f1
+    if validation_f1 > best_f1:
+        best_f1 = validation_f1
+        torch.save(model.state_dict(), args.checkpoint)
+        logging.info(f"Validation macro F1 {validation_f1:.4f}, saved {args.checkpoint}")
+    else:
+        logging.info(f"Validation macro F1 {validation_f1:.4f}, best is still {best_f1:.4f}")
+
+# Evaluate the best epoch on the test data
+model.load_state_dict(torch.load(args.checkpoint, map_location=device))
+
+# Evaluate in large batches, without gradients
+test_loader = make_loader(test_dataset, args.eval_batch_size, shuffle=False)
+
+result = evaluate(model, test_loader, len(label_names), device)
+log_result(result, label_names)
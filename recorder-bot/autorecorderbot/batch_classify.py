@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Classify archived messages offline, e.g. to re-label the history after a model update.
+
+    python -m autorecorderbot.batch_classify config.yaml messages.json labels.jsonl
+
+The input is streamed, see `autorecorderbot.message_archive` for the supported formats.
+Every input record with a message becomes one line of the output, with the record and
+its predicted sentence label, tokens and token labels. The models of the `intelligence`
+section of the config are used. Every worker process holds all models, so by default
+there is one worker per CORES_PER_WORKER CPU cores, and the cores are split between the
+torch threads of the workers.
+
+The output is checkpointed after every batch. Running the same command again after an
+interruption continues where it stopped, pass --restart to start over.
+"""
+import argparse
+import itertools
+import logging
+import os
+import sys
+import time
+from typing import Iterator, List
+
+from autorecorderbot.config import Config
+from autorecorderbot.intelligence import create_predictor, model_revision
+from autorecorderbot.message_archive import FORMATS, ArchivedMessage, ResumableOutput, read_archive
+
+logger = logging.getLogger(__name__)
+
+# Seconds between progress reports
+PROGRESS_INTERVAL = 30
+
+# CPU cores per worker process unless --processes is given, every worker holds a copy of the models
+CORES_PER_WORKER = 4
+
+
+def batches(records: Iterator[ArchivedMessage], size: int) -> Iterator[List[ArchivedMessage]]:
+    while True:
+        batch = list(itertools.islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+def classify_archive(predictor, records: Iterator[ArchivedMessage], output: ResumableOutput, batch_size: int) -> int:
+    """Classify the records after the ones the output already holds.
+
+    Returns:
+        The number of records read.
+    """
+    records = itertools.islice(records, output.done, None)
+    started = last_report = time.perf_counter()
+    count = 0
+    for batch in batches(records, batch_size):
+        classified = [record for record in batch if record.message.strip()]
+        predictions = predictor.predict_batch([record.message for record in classified]) if classified else []
+        output.write(
+            ({**record._asdict(), **prediction._asdict()} for record, prediction in zip(classified, predictions)),
+            len(batch),
+        )
+
+        count += len(batch)
+        now = time.perf_counter()
+        if now - last_report >= PROGRESS_INTERVAL:
+            logger.info(f"{output.done} records done, {count / (now - started):.1f} records/s")
+            last_report = now
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Classified {count} records in {elapsed:.1f}s, {count / elapsed if elapsed else 0:.1f} records/s")
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify archived messages with the models of the bot.")
+    parser.add_argument("config", help="Bot config, its intelligence section is used")
+    parser.add_argument("input", help="Message archive to classify")
+    parser.add_argument("output", help="JSON lines file to write the predictions to")
+    parser.add_argument("--format", choices=FORMATS, default=None, help="Format of the input, guessed by default")
+    parser.add_argument("--batch-size", type=int, default=256, help="Messages per batch")
+    parser.add_argument("--processes", type=int, default=None,
+                        help=f"Inference worker processes, one per {CORES_PER_WORKER} CPU cores by default. "
+                             "0 runs in this process")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Torch threads per worker process, the CPU cores split between the workers by default")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint of an earlier run")
+    args = parser.parse_args()
+
+    config = Config(args.config)
+    cores = os.cpu_count() or 1
+    processes = max(1, cores // CORES_PER_WORKER) if args.processes is None else args.processes
+    config.inference_worker_processes = processes
+    config.inference_worker_threads = args.threads or max(1, cores // max(1, processes))
+    if processes:
+        logger.info(f"Running the models in {processes} worker processes with "
+                    f"{config.inference_worker_threads} threads each")
+
+    predictor = create_predictor(config)
+    output = ResumableOutput(args.output, os.path.abspath(args.input), model_revision(config), restart=args.restart)
+    if output.done:
+        logger.info(f"Continuing after {output.done} records of {args.input}")
+    try:
+        classify_archive(predictor, read_archive(args.input, args.format), output, args.batch_size)
+    finally:
+        output.close()
+        if hasattr(predictor, "close"):
+            predictor.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
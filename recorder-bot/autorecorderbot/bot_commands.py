@@ -3,14 +3,14 @@ from nio import AsyncClient, MatrixRoom, RoomMessageText
 
 from autorecorderbot.chat_functions import react_to_event, send_text_to_room
 from autorecorderbot.config import Config
-from autorecorderbot.storage_local import Storage
+from autorecorderbot.storage_async import AsyncStorage
 
 
 class Command:
     def __init__(
         self,
         client: AsyncClient,
-        store: Storage,
+        store: AsyncStorage,
         config: Config,
         command: str,
         room: MatrixRoom,
@@ -46,17 +46,17 @@ class Command:
         response = "Okay, I will leave now."
         await send_text_to_room(self.client, self.room.room_id, response)
         await self.client.room_leave(self.room.room_id)
-        self.store.delete_room(self.room.room_id)
+        await self.store.delete_room(self.room.room_id)
     
     async def _yes(self):
         response = "I will stay and record your messages. This bot will record all messages sent in this room. The main purpose is to automatically detect the type of a message " + \
             "(problem, solution, cause) and store it to the teamboard." 
         await send_text_to_room(self.client, self.room.room_id, response)
-        self.store.set_room_recording(self.room.room_id)
+        await self.store.set_room_recording(self.room.room_id)
 
     async def _unknown_command(self):
-        if not self.store.get_room_recording(self.room.room_id):
+        if not await self.store.get_room_recording(self.room.room_id):
             response = "I did not quite understand what you said, so I assume I should not record."
             await send_text_to_room(self.client, self.room.room_id, response)
             await self.client.room_leave(self.room.room_id)
-            self.store.delete_room(self.room.room_id)
+            await self.store.delete_room(self.room.room_id)
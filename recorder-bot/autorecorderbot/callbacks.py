@@ -1,6 +1,7 @@
 import logging
-from time import sleep, time
+from time import time
 from pathlib import Path
+from typing import Optional
 
 from nio import (
     AsyncClient,
@@ -18,11 +19,17 @@ from nio.api import RoomVisibility
 from nio.responses import RoomCreateResponse
 
 from autorecorderbot.bot_commands import Command
-from autorecorderbot.chat_functions import make_pill, react_to_event, send_text_to_room
+from autorecorderbot.chat_functions import (
+    make_pill,
+    react_to_event,
+    react_to_event_concurrently,
+    send_text_to_room,
+)
 from autorecorderbot.config import Config
 from autorecorderbot.message_responses import Message
-from autorecorderbot.storage_local import Storage
-from autorecorderbot.intelligence import SentenceClassPredictor, TokenClassPredictor
+from autorecorderbot.send_queue import get_send_scheduler
+from autorecorderbot.storage_async import AsyncStorage, Reply
+from autorecorderbot.intelligence import create_engine
 
 logger = logging.getLogger(__name__)
 
@@ -51,7 +58,7 @@ class Language:
 
 
 class Callbacks:
-    def __init__(self, client: AsyncClient, store: Storage, config: Config):
+    def __init__(self, client: AsyncClient, store: AsyncStorage, config: Config):
         """
         Args:
             client: nio client used to interact with matrix.
@@ -64,8 +71,8 @@ class Callbacks:
         self.store = store
         self.config = config
         self.command_prefix = config.command_prefix
-        self.sequence_predictor = SentenceClassPredictor(config.sequence_model_path)
-        self.token_predictor = TokenClassPredictor(config.token_model_path)
+        # The models are loaded in the background, see `InferenceEngine.start`
+        self.inference = create_engine(config)
         self.language = Language(self.config.language_file_path)
 
     async def message(self, room: MatrixRoom, event: RoomMessageText) -> None:
@@ -90,9 +97,10 @@ class Callbacks:
 
         avail_sentence_types = set([self.language.texts["other_type"], self.language.texts["problem_type"], self.language.texts["cause_type"], self.language.texts["solution_type"]])
 
-        if self.store.get_room_recording(room.room_id) and not msg.startswith(":"):
-            sent_prediction = self.sequence_predictor.predict(msg)
-            tokens, labels = self.token_predictor.predict(msg)
+        if await self.store.get_room_recording(room.room_id) and not msg.startswith(":"):
+            prediction = await self.inference.predict(msg)
+            sent_prediction = prediction.sentence_label
+            tokens, labels = prediction.tokens, prediction.token_labels
             joined = [ f"{t}: {l}" for t, l in zip(tokens, labels) if l != "O"]
 
             # If no token was found, ask the user in a private room
@@ -100,13 +108,14 @@ class Callbacks:
             # if isinstance(response, RoomCreateResponse):
             #     print(response)
 
-            self.store.store_message(room.room_id, msg, event.sender, event.server_timestamp, sent_prediction, joined)
+            stored = await self.store.store_message(room.room_id, msg, event.sender, event.server_timestamp, sent_prediction, joined)
             response = await send_text_to_room(self.client, room.room_id, self.language.texts["sentence_detected"].format(sent_prediction), reply_to_event_id=event.event_id)
             if isinstance(response, RoomSendResponse):
-                await react_to_event(self.client, response.room_id, response.event_id, self.language.texts["yes"])
-                for t in avail_sentence_types.difference([sent_prediction]):
-                    react_result = await react_to_event(self.client, response.room_id, response.event_id, f'{t}')
-                    sleep(0.001)
+                # Reactions to the reply refer to exactly this message
+                await self.store.register_reply(room.room_id, response.event_id, stored)
+                reactions = [self.language.texts["yes"]] + [f'{t}' for t in avail_sentence_types.difference([sent_prediction])]
+                await react_to_event_concurrently(self.client, response.room_id, response.event_id, reactions,
+                                                  max_concurrency=self.config.max_concurrent_sends)
                 # await react_to_event(self.client, response.room_id, response.event_id, self.language.texts["leave_room"])
 
         # Process as message if in a public room without command prefix
@@ -148,7 +157,7 @@ class Callbacks:
 
         # Successfully joined room
         logger.info(f"Joined {room.room_id}")
-        first_join = self.store.store_new_room(room.room_id, int(time()))
+        first_join = await self.store.store_new_room(room.room_id, int(time()))
         if first_join:
             logger.info("Awating sync...")
             await self.client.sync()
@@ -158,8 +167,9 @@ class Callbacks:
                 self.language.texts["hello"]
             )
             if isinstance(response, RoomSendResponse):
-                await react_to_event(self.client, room.room_id, response.event_id, "✔️")
-                await react_to_event(self.client, room.room_id, response.event_id, "❌")
+                await self.store.register_reply(room.room_id, response.event_id)
+                await react_to_event_concurrently(self.client, room.room_id, response.event_id, ["✔️", "❌"],
+                                                  max_concurrency=self.config.max_concurrent_sends)
 
     async def _get_response(
         self, room: MatrixRoom, prediction: str
@@ -190,18 +200,15 @@ class Callbacks:
         """
         logger.debug(f"Got reaction to {room.room_id} from {event.sender}.")
 
-        # Get the original event that was reacted to
-        event_response = await self.client.room_get_event(room.room_id, reacted_to_id)
-        if isinstance(event_response, RoomGetEventError):
-            logger.warning(
-                "Error getting event that was reacted to (%s)", reacted_to_id
-            )
-            return
-        reacted_to_event = event_response.event
-
-        # Only acknowledge reactions to events that we sent and that come from other users
-        if reacted_to_event.sender != self.config.user_id or event.sender == self.config.user_id:
+        # Only acknowledge reactions from other users to events that we sent. The events
+        # we sent are stored, so the homeserver usually does not need to be asked.
+        if event.sender == self.config.user_id:
             return
+        reply = await self.store.get_reply(room.room_id, reacted_to_id)
+        if reply is None:
+            reply = await self._lookup_reply(room, reacted_to_id)
+            if reply is None:
+                return
 
         reaction_content = (
             event.source.get("content", {}).get("m.relates_to", {}).get("key")
@@ -209,62 +216,68 @@ class Callbacks:
 
         # Stay in room
         if reaction_content == '✔️':
-            if not self.store.get_event_worked(reacted_to_id):
+            if not await self.store.get_event_worked(reacted_to_id):
                 # response = "Okay, I will stay!"
                 # await send_text_to_room(self.client, room.room_id, response)
-                self.store.set_room_recording(room.room_id)
-                self.store.store_new_event(reacted_to_id, True)
+                await self.store.set_room_recording(room.room_id)
+                await self._mark_worked(reacted_to_id)
             return
 
         # Leave room
         if reaction_content == '❌':
-            if not self.store.get_event_worked(reacted_to_id):
+            if not await self.store.get_event_worked(reacted_to_id):
                 # response = "Okay, I will leave now!"
                 # await send_text_to_room(self.client, room.room_id, response)
                 await self.client.room_leave(room.room_id)
-                self.store.delete_room(room.room_id)
-                self.store.store_new_event(reacted_to_id, True)
+                scheduler = get_send_scheduler(self.client)
+                if scheduler is not None:
+                    scheduler.drop_room(room.room_id)
+                await self.store.delete_room(room.room_id)
+                await self._mark_worked(reacted_to_id)
             return
 
         # Accept prediction
         if reaction_content == self.language.texts["yes"]:
-            if not self.store.get_event_worked(reacted_to_id):
-                prediction = self.store.get_last_message_type()
+            if not await self.store.get_event_worked(reacted_to_id):
+                if reply.message is not None:
+                    prediction = reply.message.type
+                else:
+                    prediction = self.store.get_last_message_type(room.room_id)
 
                 if prediction == 'O':
-                    self.store.store_new_event(reacted_to_id, True)
+                    await self._mark_worked(reacted_to_id)
                     return
                 response = self._get_response(room, prediction)
 
                 # await send_text_to_room(self.client, room.room_id, response)
-                self.store.store_new_event(reacted_to_id, True)
+                await self._mark_worked(reacted_to_id)
             return
 
         if reaction_content == self.language.texts["cause_type"]:
-            if not self.store.get_event_worked(reacted_to_id):
-                self.store.change_last_message_type("Ursache", room.room_id)
+            if not await self.store.get_event_worked(reacted_to_id):
+                await self._change_type(room, reply, "Ursache")
                 response = self._get_response(room, "Ursache")
 
                 # await send_text_to_room(self.client, room.room_id, response)
-                self.store.store_new_event(reacted_to_id, True)
+                await self._mark_worked(reacted_to_id)
             return
 
         if reaction_content == self.language.texts["problem_type"]:
-            if not self.store.get_event_worked(reacted_to_id):
-                self.store.change_last_message_type("Problem", room.room_id)
+            if not await self.store.get_event_worked(reacted_to_id):
+                await self._change_type(room, reply, "Problem")
                 response = self._get_response(room, "Problem")
 
                 # await send_text_to_room(self.client, room.room_id, response)
-                self.store.store_new_event(reacted_to_id, True)
+                await self._mark_worked(reacted_to_id)
             return
 
         if reaction_content == self.language.texts["solution_type"]:
-            if not self.store.get_event_worked(reacted_to_id):
-                self.store.change_last_message_type("Lösung", room.room_id)
+            if not await self.store.get_event_worked(reacted_to_id):
+                await self._change_type(room, reply, "Lösung")
                 response = self._get_response(room, "Lösung")
 
                 # await send_text_to_room(self.client, room.room_id, response)
-                self.store.store_new_event(reacted_to_id, True)
+                await self._mark_worked(reacted_to_id)
             return
 
         # if reaction_content == self.language.texts["leave_room"]:
@@ -274,6 +287,34 @@ class Callbacks:
             
 
 
+    async def _lookup_reply(self, room: MatrixRoom, event_id: str) -> Optional[Reply]:
+        """Ask the homeserver whether we sent an event that is not stored as ours, e.g. one
+        sent before the `replies` table existed. Events we sent are stored from now on."""
+        response = await self.client.room_get_event(room.room_id, event_id)
+        if isinstance(response, RoomGetEventError):
+            logger.warning("Error getting event that was reacted to (%s)", event_id)
+            return None
+        if response.event.sender != self.config.user_id:
+            return None
+        await self.store.register_reply(room.room_id, event_id)
+        return Reply(room.room_id, None)
+
+    async def _change_type(self, room: MatrixRoom, reply: Reply, sent_type: str) -> None:
+        """Correct the type of the message our reply belongs to. Replies we do not know
+        the message of correct the last message of the room."""
+        if reply.message is not None:
+            await self.store.change_message_type(reply.message, sent_type)
+        else:
+            await self.store.change_last_message_type(sent_type, room.room_id)
+
+    async def _mark_worked(self, reacted_to_id: str) -> None:
+        """Remember that a reaction to one of our events was handled. The remaining
+        reactions we still wanted to add to that event are not needed anymore."""
+        scheduler = get_send_scheduler(self.client)
+        if scheduler is not None:
+            scheduler.supersede(reacted_to_id)
+        await self.store.store_new_event(reacted_to_id, True)
+
     async def decryption_failure(self, room: MatrixRoom, event: MegolmEvent) -> None:
         """Callback for when an event fails to decrypt. Inform the user.
 
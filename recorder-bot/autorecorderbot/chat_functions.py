@@ -1,5 +1,6 @@
+import asyncio
 import logging
-from typing import Optional, Union
+from typing import Iterable, List, Optional, Union
 
 from markdown import markdown
 from nio import (
@@ -12,6 +13,8 @@ from nio import (
     SendRetryError,
 )
 
+from autorecorderbot.send_queue import get_send_scheduler
+
 logger = logging.getLogger(__name__)
 
 
@@ -60,6 +63,9 @@ async def send_text_to_room(
         content["m.relates_to"] = {"m.in_reply_to": {"event_id": reply_to_event_id}}
 
     try:
+        scheduler = get_send_scheduler(client)
+        if scheduler is not None:
+            return await scheduler.send(room_id, "m.room.message", content)
         return await client.room_send(
             room_id,
             "m.room.message",
@@ -108,7 +114,8 @@ async def react_to_event(
         reaction_text: The string to react with. Can also be (one or more) emoji characters.
 
     Returns:
-        A nio.Response or nio.ErrorResponse if an error occurred.
+        A nio.Response or nio.ErrorResponse if an error occurred. None if the reaction
+        was coalesced away by the send scheduler, e.g. because the event was superseded.
 
     Raises:
         SendRetryError: If the reaction was unable to be sent.
@@ -121,6 +128,17 @@ async def react_to_event(
         }
     }
 
+    scheduler = get_send_scheduler(client)
+    if scheduler is not None:
+        # The same reaction to the same event only needs to be sent once
+        return await scheduler.send(
+            room_id,
+            "m.reaction",
+            content,
+            key=("m.reaction", event_id, reaction_text),
+            relates_to=event_id,
+        )
+
     return await client.room_send(
         room_id,
         "m.reaction",
@@ -129,6 +147,49 @@ async def react_to_event(
     )
 
 
+async def react_to_event_concurrently(
+    client: AsyncClient,
+    room_id: str,
+    event_id: str,
+    reactions: Iterable[str],
+    max_concurrency: int = 4,
+) -> List[Union[Response, ErrorResponse, Exception]]:
+    """Reacts to a given event with several reactions at once
+
+    The first reaction is sent on its own before the others, so clients list it first
+    (e.g. the "yes" reaction under a prediction). The rest are sent concurrently.
+
+    Args:
+        client: The client to communicate to matrix with.
+
+        room_id: The ID of the room to send the message to.
+
+        event_id: The ID of the event to react to.
+
+        reactions: The strings to react with.
+
+        max_concurrency: Maximum number of reactions in flight at the same time, to stay
+            below the rate limit of the homeserver.
+
+    Returns:
+        The result of every reaction, in the order of `reactions`. A reaction that could
+        not be sent returns its exception instead of cancelling the others.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def react(reaction_text: str) -> Union[Response, ErrorResponse]:
+        async with semaphore:
+            return await react_to_event(client, room_id, event_id, reaction_text)
+
+    reactions = list(reactions)
+    results = await asyncio.gather(*(react(r) for r in reactions[:1]), return_exceptions=True)
+    results += await asyncio.gather(*(react(r) for r in reactions[1:]), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Unable to react to {event_id} in {room_id}: {result}")
+    return results
+
+
 async def decryption_failure(self, room: MatrixRoom, event: MegolmEvent) -> None:
     """Callback for when an event fails to decrypt. Inform the user"""
     logger.error(
@@ -73,8 +73,33 @@ class Config:
         # Database setup
         database_path = self._get_cfg(["storage", "database"], required=True)
 
-        # Message Stroage setuo
-        message_path = self._get_cfg(["storage", "message_path"], required=True)
+        # Messages are stored in the database. This TinyDB file of older bot versions
+        # is imported once, when the database is migrated.
+        message_path = self._get_cfg(["storage", "message_path"], required=False)
+
+        # Maximum number of database writes waiting to be committed
+        self.write_queue_size = self._get_cfg(["storage", "write_queue_size"], default=1000, required=False)
+
+        # Maximum number of database connections (postgres only)
+        pool_size = self._get_cfg(["storage", "pool_size"], default=4, required=False)
+
+        # Seconds the state of a room is cached before it is read from the database again,
+        # to notice changes by other bot instances sharing the database
+        room_cache_ttl = self._get_cfg(["storage", "room_cache_ttl"], default=60, required=False)
+
+        # Where messages are stored: "database" (the messages table) or "log" (an
+        # append-only message log, see autorecorderbot/message_log.py)
+        message_backend = self._get_cfg(["storage", "message_backend"], default="database", required=False)
+        if message_backend not in ("database", "log"):
+            raise ConfigError("storage.message_backend must be one of 'database' or 'log'")
+        message_log = None
+        if message_backend == "log":
+            message_log = self._get_cfg(
+                ["storage", "message_log_path"], default=os.path.join(self.store_path, "messages.log"), required=False
+            )
+        message_log_compact_interval = self._get_cfg(
+            ["storage", "message_log_compact_interval"], default=3600, required=False
+        )
 
         # Support both SQLite and Postgres backends
         # Determine which one the user intends
@@ -84,10 +109,22 @@ class Config:
             self.database = {
                 "type": "sqlite",
                 "connection_string": database_path[len(sqlite_scheme) :],
-                "message_path": message_path
+                "message_path": message_path,
+                "pool_size": pool_size,
+                "room_cache_ttl": room_cache_ttl,
+                "message_log": message_log,
+                "message_log_compact_interval": message_log_compact_interval,
             }
         elif database_path.startswith(postgres_scheme):
-            self.database = {"type": "postgres", "connection_string": database_path, "message_path": message_path}
+            self.database = {
+                "type": "postgres",
+                "connection_string": database_path,
+                "message_path": message_path,
+                "pool_size": pool_size,
+                "room_cache_ttl": room_cache_ttl,
+                "message_log": message_log,
+                "message_log_compact_interval": message_log_compact_interval,
+            }
         else:
             raise ConfigError("Invalid connection string for storage.database")
 
@@ -111,9 +148,41 @@ class Config:
         
         self.encryption = self._get_cfg(["matrix", "encryption"], required=True)
 
+        # Maximum number of events (e.g. reactions) sent to the homeserver at the same time
+        self.max_concurrent_sends = self._get_cfg(["matrix", "max_concurrent_sends"], default=4, required=False)
+        # Events sent per second on average, and at once after a quiet period
+        self.send_rate = self._get_cfg(["matrix", "send_rate"], default=5.0, required=False)
+        self.send_burst = self._get_cfg(["matrix", "send_burst"], default=10, required=False)
+
         # Model Paths
         self.sequence_model_path = self._get_cfg(["intelligence", "sequence_model_path"], required=True)
         self.token_model_path = self._get_cfg(["intelligence", "token_model_path"], required=True)
+        # Optional combined checkpoint that replaces both models above with one shared encoder
+        self.multi_head_model_path = self._get_cfg(["intelligence", "multi_head_model_path"], required=False)
+
+        # Inference backend: plain pytorch, pytorch with int8 Linear layers or ONNX Runtime
+        self.inference_backend = self._get_cfg(["intelligence", "backend"], default="torch", required=False)
+        if self.inference_backend not in ("torch", "torch-int8", "onnxruntime"):
+            raise ConfigError("intelligence.backend must be one of 'torch', 'torch-int8' or 'onnxruntime'")
+
+        # Batching of incoming messages for inference
+        self.inference_max_batch_size = self._get_cfg(["intelligence", "max_batch_size"], default=16, required=False)
+        self.inference_max_wait_ms = self._get_cfg(["intelligence", "max_batch_wait_ms"], default=10, required=False)
+
+        # Run the models in worker processes instead of the bot process, 0 disables the workers
+        self.inference_worker_processes = self._get_cfg(["intelligence", "worker_processes"], default=0, required=False)
+        self.inference_worker_threads = self._get_cfg(["intelligence", "worker_threads"], default=1, required=False)
+
+        # Inference server (see autorecorderbot/inference_server.py). If a URL is set, the bot
+        # sends messages there instead of loading the models itself
+        self.inference_server_url = self._get_cfg(["intelligence", "server_url"], required=False)
+        self.inference_server_timeout = self._get_cfg(["intelligence", "server_timeout"], default=30, required=False)
+        self.inference_server_host = self._get_cfg(["intelligence", "server", "host"], default="127.0.0.1", required=False)
+        self.inference_server_port = self._get_cfg(["intelligence", "server", "port"], default=8090, required=False)
+
+        # Cache of predictions for repeated messages, optionally kept across restarts
+        self.inference_cache_size = self._get_cfg(["intelligence", "cache_size"], default=1024, required=False)
+        self.inference_cache_path = self._get_cfg(["intelligence", "cache_path"], required=False)
 
         # Check if the testing connector should be used
         self.use_testing_storage = self._get_cfg(["storage", "use_testing"], required=True)
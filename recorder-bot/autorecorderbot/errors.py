@@ -10,3 +10,14 @@ class ConfigError(RuntimeError):
 
     def __init__(self, msg: str):
         super(ConfigError, self).__init__("%s" % (msg,))
+
+
+class InferenceError(RuntimeError):
+    """An error encountered while running the models on a batch of messages.
+
+    Args:
+        msg: The message displayed to the user on error.
+    """
+
+    def __init__(self, msg: str):
+        super(InferenceError, self).__init__("%s" % (msg,))
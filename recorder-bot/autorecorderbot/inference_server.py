@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Local inference server, so the bots, the dashboard connector and offline scripts can share
+one warm copy of the models instead of each loading their own.
+
+Start it with the bot config (the `intelligence` section is used):
+
+    python -m autorecorderbot.inference_server config.yaml
+
+Endpoints, all batch requests take {"sentences": ["...", ...]}:
+    POST /classify  sentence labels: {"labels": ["Problem", ...]}
+    POST /tag       token labels: {"results": [{"tokens": [...], "labels": [...]}, ...]}
+    POST /predict   both: {"predictions": [{"sentence_label": ..., "tokens": ..., "token_labels": ...}]}
+    GET  /metrics   request latency histograms in the Prometheus text format
+    GET  /health    200 once the models are loaded, 503 before
+
+The sentences of all concurrent requests are batched together by an InferenceEngine.
+/classify and /tag only run the model of the head they return, unless both heads share
+one model.
+"""
+import asyncio
+import bisect
+import logging
+import sys
+import time
+from functools import partial
+from typing import Dict, List, Tuple
+
+from aiohttp import web
+
+from autorecorderbot.config import Config
+from autorecorderbot.errors import InferenceError
+from autorecorderbot.intelligence import HEADS, InferenceEngine, Prediction, create_engine, create_local_predictor
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Endpoints whose latency is measured
+PREDICTION_ENDPOINTS = ("/classify", "/tag", "/predict")
+
+# Maximum number of sentences accepted in one request
+MAX_REQUEST_SENTENCES = 256
+
+
+class LatencyHistogram:
+    """Cumulative latency histogram, exported like a Prometheus histogram"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class InferenceServer:
+    """aiohttp application serving the predictions of an InferenceEngine
+
+    Args:
+        engine: The engine batching the sentences of all requests.
+    """
+
+    def __init__(self, engine: InferenceEngine) -> None:
+        self.engine = engine
+        self.latencies: Dict[str, LatencyHistogram] = {}
+        self.app = web.Application(middlewares=[self._measure])
+        self.app.add_routes([
+            web.post("/classify", self.classify),
+            web.post("/tag", self.tag),
+            web.post("/predict", self.predict),
+            web.get("/metrics", self.metrics),
+            web.get("/health", self.health),
+        ])
+        self.app.on_startup.append(self._on_startup)
+        self.app.on_cleanup.append(self._on_cleanup)
+
+    async def _on_startup(self, app: web.Application) -> None:
+        # Load the models in the background, requests arriving meanwhile are queued
+        self.engine.start()
+
+    async def _on_cleanup(self, app: web.Application) -> None:
+        await self.engine.close()
+
+    @web.middleware
+    async def _measure(self, request: web.Request, handler):
+        started = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            if request.path in PREDICTION_ENDPOINTS:
+                histogram = self.latencies.setdefault(request.path, LatencyHistogram())
+                histogram.observe(time.perf_counter() - started)
+
+    async def _predict(self, request: web.Request, heads: Tuple[str, ...] = HEADS) -> List[Prediction]:
+        """Read the sentences of a request and predict the given heads for them"""
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="The body must be JSON")
+        sentences = body.get("sentences") if isinstance(body, dict) else None
+        if not isinstance(sentences, list) or not all(isinstance(s, str) for s in sentences):
+            raise web.HTTPBadRequest(text='Expected {"sentences": ["...", ...]}')
+        if len(sentences) > MAX_REQUEST_SENTENCES:
+            raise web.HTTPBadRequest(text=f"At most {MAX_REQUEST_SENTENCES} sentences per request")
+
+        try:
+            return await asyncio.gather(*(self.engine.predict(sentence, heads) for sentence in sentences))
+        except InferenceError as e:
+            raise web.HTTPInternalServerError(text=str(e))
+
+    async def classify(self, request: web.Request) -> web.Response:
+        predictions = await self._predict(request, heads=("sentence",))
+        return web.json_response({"labels": [p.sentence_label for p in predictions]})
+
+    async def tag(self, request: web.Request) -> web.Response:
+        predictions = await self._predict(request, heads=("token",))
+        return web.json_response({"results": [{"tokens": p.tokens, "labels": p.token_labels} for p in predictions]})
+
+    async def predict(self, request: web.Request) -> web.Response:
+        predictions = await self._predict(request)
+        return web.json_response({"predictions": [p._asdict() for p in predictions]})
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        lines = ["# TYPE inference_request_seconds histogram"]
+        for path, histogram in sorted(self.latencies.items()):
+            lines.extend(histogram.render("inference_request_seconds", f'endpoint="{path}"'))
+        cache = self.engine.cache
+        if cache is not None:
+            lines.append("# TYPE inference_cache_hits_total counter")
+            lines.append(f"inference_cache_hits_total {cache.hits}")
+            lines.append("# TYPE inference_cache_misses_total counter")
+            lines.append(f"inference_cache_misses_total {cache.misses}")
+        return web.Response(text="\n".join(lines) + "\n")
+
+    async def health(self, request: web.Request) -> web.Response:
+        if not self.engine.ready:
+            raise web.HTTPServiceUnavailable(text="Loading the models")
+        return web.Response(text="OK")
+
+
+def main():
+    config = Config(sys.argv[1] if len(sys.argv) > 1 else "config.yaml")
+    # Always run the models here, even if the config points the bots to this server
+    server = InferenceServer(create_engine(config, predictor_factory=partial(create_local_predictor, config)))
+    web.run_app(server.app, host=config.inference_server_host, port=config.inference_server_port)
+
+
+if __name__ == "__main__":
+    main()
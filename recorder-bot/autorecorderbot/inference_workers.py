@@ -0,0 +1,207 @@
+import itertools
+import logging
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import torch
+import torch.multiprocessing as mp
+from transformers import BatchEncoding
+
+from autorecorderbot.errors import InferenceError
+
+logger = logging.getLogger(__name__)
+
+# The encoded batch of a predictor, a tuple of encodings for a JointPredictor
+Encoded = Union[BatchEncoding, Tuple[Optional[BatchEncoding], ...]]
+
+# Seconds between health checks of the workers while waiting for their results
+HEALTH_CHECK_INTERVAL = 1.0
+
+# How often a chunk is handed to a new worker after the one running it died
+MAX_CHUNK_RETRIES = 1
+
+# Seconds a worker gets to exit after being asked to stop
+SHUTDOWN_TIMEOUT = 5.0
+
+
+def _worker_main(load: Callable[..., Any], threads: int, tasks: mp.Queue, results: mp.Queue) -> None:
+    """Entry point of a worker process: load the model and run forward passes until told to stop"""
+    torch.set_num_threads(threads)
+    predictor = load()
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        job_id, inputs = task
+        try:
+            # no_grad rather than inference_mode, inference tensors cannot be moved to shared memory
+            with torch.no_grad():
+                logits = predictor.forward(inputs)
+        except Exception as e:
+            results.put((job_id, None, repr(e)))
+        else:
+            results.put((job_id, logits, None))
+
+
+def _model_inputs(encoded: Encoded, start: int, end: int) -> Any:
+    """The rows of a batch the model needs, from one encoding or a tuple of encodings.
+    Encodings of skipped heads are None."""
+    if encoded is None:
+        return None
+    if isinstance(encoded, tuple):
+        return tuple(_model_inputs(part, start, end) for part in encoded)
+    return {
+        'input_ids': encoded['input_ids'][start:end],
+        'attention_mask': encoded['attention_mask'][start:end],
+    }
+
+
+class _Worker:
+    """A worker process and the chunks it is still working on"""
+
+    def __init__(self, process: mp.Process, tasks: mp.Queue) -> None:
+        self.process = process
+        self.tasks = tasks
+        self.pending: Dict[int, Tuple[int, int]] = {}
+
+
+class PooledPredictor:
+    """Runs the models of a SentenceClassPredictor, TokenClassPredictor, JointPredictor or
+    MultiHeadPredictor in a pool of worker processes.
+
+    The messages are tokenized and the labels decoded in this process, only the forward
+    pass runs in the workers. Every worker holds all models of the predictor, so a message
+    costs one round trip to one worker. Every batch is split into one chunk per worker, so a
+    batch uses all workers at once. Inputs and logits are passed through torch.multiprocessing
+    queues, which move the tensors to shared memory instead of pickling their data.
+
+    Every worker loads its own copy of the models, convert the models with
+    scripts-dev/convert_safetensors.py so the workers share the weights in memory. Workers
+    that die are restarted, and the chunks they were working on are run again.
+
+    The workers are started with spawn, which imports the `__main__` module of this process
+    again in every worker. Scripts that create a pool must only start when run as
+    `__main__`.
+
+    Args:
+        load: Loads the predictor. Called with `load_model=False` in this process and
+            without arguments in the workers, so it has to be picklable, e.g. a
+            `functools.partial` of `load_predictor`.
+
+        processes: Number of worker processes.
+
+        threads_per_process: Number of threads torch uses in every worker. processes *
+            threads_per_process should not exceed the number of CPU cores.
+    """
+
+    def __init__(self, load: Callable[..., Any], processes: int = 2, threads_per_process: int = 1) -> None:
+        self.load = load
+        self.threads_per_process = max(1, int(threads_per_process))
+        self.predictor = load(load_model=False)
+        self.restarts = 0
+
+        # Forking a process that already runs torch threads can deadlock
+        self._context = mp.get_context("spawn")
+        self._results = self._context.Queue()
+        self._job_ids = itertools.count()
+        # Batches are run one after another, every batch already uses all workers
+        self._lock = threading.Lock()
+        self._workers = [self._start_worker() for _ in range(max(1, int(processes)))]
+
+    def _start_worker(self) -> _Worker:
+        tasks = self._context.Queue()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(self.load, self.threads_per_process, tasks, self._results),
+            name="inference-worker",
+            daemon=True,
+        )
+        process.start()
+        return _Worker(process, tasks)
+
+    def encode(self, sentences: List[str], **kwargs) -> Encoded:
+        return self.predictor.encode(sentences, **kwargs)
+
+    def decode(self, encoded: Encoded, logits: Any) -> List[Any]:
+        return self.predictor.decode(encoded, logits)
+
+    def predict_batch(self, sentences: List[str], **kwargs) -> List[Any]:
+        """Predict a batch, keyword arguments (e.g. `heads`) are passed to the predictor's encode"""
+        encoded = self.encode(sentences, **kwargs)
+        return self.decode(encoded, self.forward(encoded))
+
+    def predict(self, sentence: str) -> Any:
+        return self.predict_batch([sentence])[0]
+
+    def forward(self, encoded: Encoded) -> Union[torch.Tensor, Tuple[torch.Tensor, ...]]:
+        """Run the model on the workers, one chunk of the batch per worker"""
+        with self._lock:
+            # Results of a batch that failed halfway are ignored when they arrive
+            for worker in self._workers:
+                worker.pending.clear()
+
+            first = next(part for part in encoded if part is not None) if isinstance(encoded, tuple) else encoded
+            rows = first['input_ids'].shape[0]
+            bounds = [(int(chunk[0]), int(chunk[-1]) + 1)
+                      for chunk in torch.arange(rows).tensor_split(min(rows, len(self._workers)))]
+            retries: Dict[Tuple[int, int], int] = {}
+            for worker, chunk in zip(self._workers, bounds):
+                self._submit(worker, encoded, chunk)
+
+            outputs: Dict[int, Tuple[torch.Tensor, ...]] = {}
+            while len(outputs) < len(bounds):
+                try:
+                    job_id, logits, error = self._results.get(timeout=HEALTH_CHECK_INTERVAL)
+                except queue.Empty:
+                    self._restart_dead_workers(encoded, retries)
+                    continue
+
+                chunk = self._complete(job_id)
+                if chunk is None:
+                    continue
+                if error is not None:
+                    raise InferenceError(f"Inference worker failed: {error}")
+                outputs[chunk[0]] = logits if isinstance(logits, tuple) else (logits,)
+
+        ordered = [outputs[start] for start in sorted(outputs)]
+        # Skipped heads have no logits in any chunk
+        merged = tuple(torch.cat(parts) if parts[0] is not None else None for parts in zip(*ordered))
+        return merged if len(merged) > 1 else merged[0]
+
+    def _submit(self, worker: _Worker, encoded: Encoded, chunk: Tuple[int, int]) -> None:
+        job_id = next(self._job_ids)
+        worker.pending[job_id] = chunk
+        worker.tasks.put((job_id, _model_inputs(encoded, *chunk)))
+
+    def _complete(self, job_id: int):
+        for worker in self._workers:
+            if job_id in worker.pending:
+                return worker.pending.pop(job_id)
+        return None
+
+    def _restart_dead_workers(self, encoded: Encoded, retries: Dict[Tuple[int, int], int]) -> None:
+        for index, worker in enumerate(self._workers):
+            if worker.process.is_alive():
+                continue
+
+            logger.error(f"Inference worker {worker.process.pid} died with exit code {worker.process.exitcode}, restarting it")
+            self.restarts += 1
+            replacement = self._start_worker()
+            self._workers[index] = replacement
+            for chunk in worker.pending.values():
+                retries[chunk] = retries.get(chunk, 0) + 1
+                if retries[chunk] > MAX_CHUNK_RETRIES:
+                    raise InferenceError(f"Inference workers keep dying on messages {chunk[0]} to {chunk[1] - 1} of the batch")
+                self._submit(replacement, encoded, chunk)
+
+    def close(self) -> None:
+        """Stop all worker processes"""
+        for worker in self._workers:
+            if worker.process.is_alive():
+                worker.tasks.put(None)
+        for worker in self._workers:
+            worker.process.join(SHUTDOWN_TIMEOUT)
+            if worker.process.is_alive():
+                worker.process.terminate()
@@ -1,53 +1,946 @@
+import asyncio
+import hashlib
 import json
+import logging
+import mmap
+import os
+import struct
+import time
+import unicodedata
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, AutoModelForTokenClassification
+from transformers import AutoConfig, AutoModel, AutoTokenizer, AutoModelForSequenceClassification, AutoModelForTokenClassification
+from transformers import BatchEncoding
+from transformers.modeling_utils import no_init_weights
 import torch
 
+from autorecorderbot.config import Config
+from autorecorderbot.errors import InferenceError
+
+logger = logging.getLogger(__name__)
+
+# Inference backends that can be selected with intelligence.backend
+BACKENDS = ("torch", "torch-int8", "onnxruntime")
+
+# File name of the exported ONNX graph inside a model directory
+ONNX_FILE = 'model.onnx'
+
+# File names of the model weights inside a model directory, the first one found is loaded
+SAFETENSORS_FILE = 'model.safetensors'
+PYTORCH_FILE = 'pytorch_model.bin'
+
+# Files of a model directory that identify the revision of the model
+REVISION_FILES = ('config.json', SAFETENSORS_FILE, PYTORCH_FILE, ONNX_FILE)
+
+
 def _get_model_config(cfg_path: Path):
     with open(cfg_path, 'r') as mconfig:
         cfg = json.load(mconfig)
         return cfg
 
+
+def _decode_token_labels(tokenizer, id2tag: dict, encoded: BatchEncoding,
+                         logits: torch.Tensor) -> List[Tuple[List[str], List[str]]]:
+    """Map token logits back to (tokens, labels) per sentence"""
+    # Padding and special tokens ([CLS], [SEP]) do not get a label
+    keep = (encoded['special_tokens_mask'] == 0) & (encoded['attention_mask'] == 1)
+    predicted = torch.argmax(logits, dim=2)
+
+    results = []
+    for row_ids, row_labels, row_keep in zip(encoded['input_ids'].tolist(), predicted.tolist(), keep.tolist()):
+        tokens = tokenizer.convert_ids_to_tokens([i for i, k in zip(row_ids, row_keep) if k])
+        labels = [id2tag[str(label)] for label, k in zip(row_labels, row_keep) if k]
+        results.append((tokens, labels))
+    return results
+
+
+class _OnnxModel:
+    """Runs a model exported with `export_onnx` through ONNX Runtime"""
+
+    def __init__(self, onnx_path: Path) -> None:
+        try:
+            import onnxruntime
+        except ImportError:
+            raise InferenceError("The onnxruntime backend requires the onnxruntime package")
+        if not onnx_path.exists():
+            raise InferenceError(f"{onnx_path} does not exist, export the model with scripts-dev/export_onnx.py first")
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        outputs = self.session.run(None, {"input_ids": input_ids.numpy(), "attention_mask": attention_mask.numpy()})
+        return tuple(torch.from_numpy(o) for o in outputs)
+
+
+class _LogitsOnly(torch.nn.Module):
+    """Unwraps the logits of a transformers model, ONNX export needs plain tensor outputs"""
+
+    def __init__(self, model: torch.nn.Module) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+
+# Element types of the safetensors format
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+
+def mmap_safetensors(path: Path) -> Dict[str, torch.Tensor]:
+    """Map the tensors of a safetensors file into memory without copying them.
+
+    The tensors are views of a private (copy-on-write) mapping of the file. As long as
+    nobody writes to them, their pages come straight from the page cache, so every
+    process on the host that maps the same file shares one physical copy of the weights.
+    """
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        offset = data_start + begin
+        count = (end - begin) // dtype.itemsize
+        if count == 0:
+            tensor = torch.empty(0, dtype=dtype)
+        elif offset % dtype.itemsize:
+            # Misaligned tensors cannot be viewed in place
+            tensor = torch.frombuffer(bytearray(buffer[offset:data_start + end]), dtype=dtype)
+        else:
+            tensor = torch.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+        tensors[name] = tensor.reshape(info["shape"])
+    return tensors
+
+
+def save_safetensors(state_dict: Dict[str, torch.Tensor], path: Path) -> None:
+    """Write a state dict as a safetensors file that `mmap_safetensors` can map"""
+    from safetensors.torch import save_file
+
+    # safetensors refuses tensors that share memory, e.g. tied embeddings
+    seen = set()
+    tensors = {}
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        if tensor.untyped_storage().data_ptr() in seen:
+            tensor = tensor.clone()
+        seen.add(tensor.untyped_storage().data_ptr())
+        tensors[name] = tensor
+    save_file(tensors, str(path), metadata={"format": "pt"})
+
+
+def _load_state_dict(model_path: Path) -> Dict[str, torch.Tensor]:
+    """Read the weights of a model directory without copying them more often than necessary.
+
+    safetensors files are preferred and mapped into memory, see `mmap_safetensors`.
+    pytorch checkpoints are memory-mapped as well if they were written in the zip format,
+    legacy checkpoints are read into memory. Convert either with
+    scripts-dev/convert_safetensors.py, which also avoids unpickling the checkpoint.
+    """
+    safetensors_path = Path.joinpath(model_path, SAFETENSORS_FILE)
+    if safetensors_path.exists():
+        return mmap_safetensors(safetensors_path)
+
+    pytorch_path = Path.joinpath(model_path, PYTORCH_FILE)
+    try:
+        return torch.load(pytorch_path, map_location='cpu', mmap=True, weights_only=True)
+    except RuntimeError:
+        # Checkpoints written in the legacy (non-zip) format cannot be memory-mapped
+        logger.warning(f"Cannot memory-map {pytorch_path}, re-save it with torch.save to speed up loading")
+        return torch.load(pytorch_path, map_location='cpu')
+
+
+def _build_with_weights(build: Callable[[], torch.nn.Module], model_path: Path) -> torch.nn.Module:
+    """Build a model without initializing its weights, then load the checkpoint straight into it.
+
+    The checkpoint tensors replace the uninitialized parameters (`assign=True`) instead of
+    being copied into them, so the weights are held in memory only once.
+    """
+    with no_init_weights():
+        model = build()
+
+    state_dict = _load_state_dict(model_path)
+    missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+    # Buffers are set up by the model itself, but parameters must all come from the checkpoint
+    parameters = dict(model.named_parameters())
+    missing = [key for key in missing if key in parameters]
+    if missing:
+        raise InferenceError(f"{model_path} is missing weights for {', '.join(missing)}")
+    if unexpected:
+        logger.debug(f"Ignoring unused weights in {model_path}: {', '.join(unexpected)}")
+    return model
+
+
+def _load_model(model_path: Path, backend: str, load_torch_model: Callable[[], torch.nn.Module]) -> Any:
+    """Load a model for the given inference backend.
+
+    The torch model is only built for the torch backends, the onnxruntime backend reads
+    the exported graph from the model directory instead.
+    """
+    if backend not in BACKENDS:
+        raise InferenceError(f"Unknown inference backend '{backend}', choose one of {', '.join(BACKENDS)}")
+    if backend == "onnxruntime":
+        return _OnnxModel(Path.joinpath(model_path, ONNX_FILE))
+
+    model = load_torch_model()
+    model.eval()
+    if backend == "torch-int8":
+        # Weights of all Linear layers are stored as int8, activations are quantized on the fly
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def _run_model(model: Any, encoded: BatchEncoding) -> Tuple[torch.Tensor, ...]:
+    """Run a torch or ONNX Runtime model and return all of its logits"""
+    if isinstance(model, _OnnxModel):
+        return model(encoded['input_ids'], encoded['attention_mask'])
+    outputs = model(input_ids=encoded['input_ids'], attention_mask=encoded['attention_mask'])
+    if isinstance(outputs, tuple):
+        return outputs
+    return (outputs.logits,)
+
+
+def _export_onnx(model: torch.nn.Module, backend: str, onnx_path: Path, output_axes: Dict[str, Dict[int, str]]) -> Path:
+    """Export a torch model taking input ids and attention mask to ONNX, with dynamic batch and length"""
+    if backend != "torch":
+        raise InferenceError("Only models loaded with the fp32 'torch' backend can be exported")
+
+    dummy = torch.ones((2, 8), dtype=torch.long)
+    input_axes = {name: {0: "batch", 1: "sequence"} for name in ("input_ids", "attention_mask")}
+    torch.onnx.export(
+        model,
+        (dummy, dummy),
+        str(onnx_path),
+        input_names=list(input_axes),
+        output_names=list(output_axes),
+        dynamic_axes={**input_axes, **output_axes},
+        opset_version=14,
+    )
+    logger.info(f"Exported {onnx_path}")
+    return onnx_path
+
+
+# Heads a prediction can be asked for, the sentence label and the token labels
+HEADS = ("sentence", "token")
+
+# Messages the combined model of `build_multi_head_model` is compared with the separate models on
+PARITY_SENTENCES = (
+    "Die Maschine steht still.",
+    "Der Sensor an Station 3 ist defekt.",
+    "Ursache war ein loses Kabel am Motor.",
+    "Ich habe das Kabel getauscht, läuft wieder.",
+    "Förderband blockiert, bitte prüfen",
+    "Danke!",
+)
+
+
+class Prediction(NamedTuple):
+    """Everything the bot predicts for a single message. The fields of heads that were not
+    asked for are None."""
+    sentence_label: Optional[str]
+    tokens: Optional[List[str]]
+    token_labels: Optional[List[str]]
+
+
 class SentenceClassPredictor:
-    def __init__(self, model_path: str) -> None:
+    def __init__(self, model_path: str, backend: str = "torch", load_model: bool = True) -> None:
         self.model_path = Path(model_path)
         self.config_path = Path.joinpath(self.model_path , 'config.json')
         self.model_config = _get_model_config(self.config_path)
-        self.model = AutoModelForSequenceClassification.from_pretrained(self.model_path)
+        self.backend = backend
+        # Without the model, only encode and decode work, e.g. for a PooledPredictor
+        self.model = _load_model(self.model_path, backend, self._load_torch_model) if load_model else None
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_config['_name_or_path'])
         self.id2label = self.model_config['id2label']
-    
+
+    def encode(self, sentences: List[str]) -> BatchEncoding:
+        """Tokenize a batch of sentences, padded to the longest one"""
+        return self.tokenizer(sentences, truncation=True, padding=True, return_tensors='pt')
+
+    def _load_torch_model(self) -> torch.nn.Module:
+        return _build_with_weights(
+            lambda: AutoModelForSequenceClassification.from_config(AutoConfig.from_pretrained(self.model_path)),
+            self.model_path)
+
+    def forward(self, encoded: BatchEncoding) -> torch.Tensor:
+        return _run_model(self.model, encoded)[0]
+
+    def export_onnx(self) -> Path:
+        """Export the model next to its weights for the onnxruntime backend"""
+        return _export_onnx(_LogitsOnly(self.model), self.backend, Path.joinpath(self.model_path, ONNX_FILE),
+                            {"logits": {0: "batch"}})
+
+    def decode(self, encoded: BatchEncoding, logits: torch.Tensor) -> List[str]:
+        return [self.id2label[str(i)] for i in torch.argmax(logits, 1).tolist()]
+
+    def predict_batch(self, sentences: List[str]) -> List[str]:
+        encoded = self.encode(sentences)
+        with torch.inference_mode():
+            logits = self.forward(encoded)
+        return self.decode(encoded, logits)
+
     def predict(self, sentence: str) -> str:
-        tokenized = self.tokenizer(sentence, truncation=True, padding=True, return_tensors='pt')
-        input_ids = tokenized['input_ids']
-        result = torch.argmax(self.model(input_ids).logits, 1)
-        return self.id2label[str(result.item())]
+        return self.predict_batch([sentence])[0]
 
 
 class TokenClassPredictor:
-    def __init__(self, model_path: str) -> None:
+    def __init__(self, model_path: str, backend: str = "torch", load_model: bool = True) -> None:
         self.model_path = Path(model_path)
         self.config_path = Path.joinpath(self.model_path , 'config.json')
         self.model_config = _get_model_config(self.config_path)
         self.id2tag = self.model_config['id2tag']
-        self.model = AutoModelForTokenClassification.from_pretrained(self.model_config['base_model'],
-                                                                     num_labels=len(self.model_config['unique_tags']))
-        self.model.load_state_dict(torch.load(Path.joinpath(self.model_path, 'pytorch_model.bin'), map_location=torch.device('cpu')))
+        self.backend = backend
+        # Without the model, only encode and decode work, e.g. for a PooledPredictor
+        self.model = _load_model(self.model_path, backend, self._load_torch_model) if load_model else None
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_config['base_model'])
 
+    def encode(self, sentences: List[str]) -> BatchEncoding:
+        """Tokenize a batch of sentences, padded to the longest one"""
+        return self.tokenizer(sentences,
+                              is_split_into_words=False,
+                              truncation=True,
+                              padding=True,
+                              return_special_tokens_mask=True,
+                              return_tensors='pt')
+
+    def _load_torch_model(self) -> torch.nn.Module:
+        # Only the architecture of the base model is needed, its pretrained weights are overwritten anyway
+        base_config = AutoConfig.from_pretrained(self.model_config['base_model'],
+                                                 num_labels=len(self.model_config['unique_tags']))
+        return _build_with_weights(lambda: AutoModelForTokenClassification.from_config(base_config), self.model_path)
+
+    def forward(self, encoded: BatchEncoding) -> torch.Tensor:
+        return _run_model(self.model, encoded)[0]
+
+    def export_onnx(self) -> Path:
+        """Export the model next to its weights for the onnxruntime backend"""
+        return _export_onnx(_LogitsOnly(self.model), self.backend, Path.joinpath(self.model_path, ONNX_FILE),
+                            {"logits": {0: "batch", 1: "sequence"}})
+
+    def decode(self, encoded: BatchEncoding, logits: torch.Tensor) -> List[Tuple[List[str], List[str]]]:
+        return _decode_token_labels(self.tokenizer, self.id2tag, encoded, logits)
+
+    def predict_batch(self, sentences: List[str]) -> List[Tuple[List[str], List[str]]]:
+        encoded = self.encode(sentences)
+        with torch.inference_mode():
+            logits = self.forward(encoded)
+        return self.decode(encoded, logits)
+
     def predict(self, sentence: str) -> any:
-        tokenized = self.tokenizer(sentence, 
-                                   is_split_into_words=False,
-                                   return_special_tokens_mask=True,
-                                   return_tensors='pt')
-        input_ids = tokenized['input_ids']
-        outputs = self.model(input_ids).logits
-
-        predicted_labels = [l for (i, l) in enumerate(torch.argmax(outputs, dim=2).tolist()[0])
-            if tokenized["special_tokens_mask"].tolist()[0][i] == 0]
-        merged_tokens = [l for (i, l) in 
-            enumerate(self.tokenizer.convert_ids_to_tokens(input_ids.tolist()[0]))
-            if tokenized["special_tokens_mask"].tolist()[0][i] == 0]
-
-        return merged_tokens, [self.id2tag[str(i)] for i in predicted_labels]
\ No newline at end of file
+        return self.predict_batch([sentence])[0]
+
+
+class JointPredictor:
+    """Runs the sentence and the token classifier over the same batch of messages"""
+
+    def __init__(self, sequence_predictor: SentenceClassPredictor, token_predictor: TokenClassPredictor) -> None:
+        self.sequence_predictor = sequence_predictor
+        self.token_predictor = token_predictor
+
+    def encode(self, sentences: List[str], heads: Tuple[str, ...] = HEADS) -> Tuple[Optional[BatchEncoding], Optional[BatchEncoding]]:
+        """Tokenize a batch of sentences for the models of the given heads"""
+        return (self.sequence_predictor.encode(sentences) if "sentence" in heads else None,
+                self.token_predictor.encode(sentences) if "token" in heads else None)
+
+    def forward(self, encoded: Tuple[Optional[BatchEncoding], Optional[BatchEncoding]]) -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """Run the models of the encoded heads, the other model is skipped"""
+        sequence_encoded, token_encoded = encoded
+        return (self.sequence_predictor.forward(sequence_encoded) if sequence_encoded is not None else None,
+                self.token_predictor.forward(token_encoded) if token_encoded is not None else None)
+
+    def decode(self, encoded: Tuple[Optional[BatchEncoding], Optional[BatchEncoding]],
+               logits: Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]) -> List[Prediction]:
+        rows = len(next(part for part in encoded if part is not None)['input_ids'])
+        sentence_labels = [None] * rows
+        if encoded[0] is not None:
+            sentence_labels = self.sequence_predictor.decode(encoded[0], logits[0])
+        token_results = [(None, None)] * rows
+        if encoded[1] is not None:
+            token_results = self.token_predictor.decode(encoded[1], logits[1])
+        return [Prediction(label, tokens, labels)
+                for label, (tokens, labels) in zip(sentence_labels, token_results)]
+
+    def predict_batch(self, sentences: List[str], heads: Tuple[str, ...] = HEADS) -> List[Prediction]:
+        encoded = self.encode(sentences, heads)
+        with torch.inference_mode():
+            logits = self.forward(encoded)
+        return self.decode(encoded, logits)
+
+    def close(self) -> None:
+        for predictor in (self.sequence_predictor, self.token_predictor):
+            if hasattr(predictor, 'close'):
+                predictor.close()
+
+
+class MultiHeadModel(torch.nn.Module):
+    """One encoder with a sentence classification and a token classification head"""
+
+    def __init__(self, encoder: torch.nn.Module, num_labels: int, num_tags: int) -> None:
+        super().__init__()
+        self.encoder = encoder
+        hidden_size = encoder.config.hidden_size
+        self.sequence_head = torch.nn.Linear(hidden_size, num_labels)
+        self.token_head = torch.nn.Linear(hidden_size, num_tags)
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        outputs = self.encoder(input_ids=input_ids, attention_mask=attention_mask)
+        pooled = outputs.pooler_output
+        if pooled is None:
+            pooled = outputs.last_hidden_state[:, 0]
+        return self.sequence_head(pooled), self.token_head(outputs.last_hidden_state)
+
+
+def _encode_multi_head(tokenizer, sentences: List[str]) -> BatchEncoding:
+    return tokenizer(sentences,
+                     truncation=True,
+                     padding=True,
+                     return_special_tokens_mask=True,
+                     return_tensors='pt')
+
+
+def _decode_multi_head(tokenizer, id2label: dict, id2tag: dict, encoded: BatchEncoding,
+                       logits: Tuple[torch.Tensor, torch.Tensor]) -> List[Prediction]:
+    sentence_logits, token_logits = logits
+    sentence_labels = [id2label[str(i)] for i in torch.argmax(sentence_logits, 1).tolist()]
+    token_results = _decode_token_labels(tokenizer, id2tag, encoded, token_logits)
+    return [Prediction(label, tokens, labels)
+            for label, (tokens, labels) in zip(sentence_labels, token_results)]
+
+
+class MultiHeadPredictor:
+    """Predicts sentence and token labels with a single encoder pass per batch.
+
+    Loads a checkpoint built by `build_multi_head_model`: the `encoder` subfolder holds
+    the backbone config, `pytorch_model.bin` the weights of the encoder and both heads,
+    and `config.json` the label maps of both tasks.
+    """
+
+    def __init__(self, model_path: str, backend: str = "torch", load_model: bool = True) -> None:
+        self.model_path = Path(model_path)
+        self.config_path = Path.joinpath(self.model_path, 'config.json')
+        self.model_config = _get_model_config(self.config_path)
+        self.id2label = self.model_config['id2label']
+        self.id2tag = self.model_config['id2tag']
+        self.backend = backend
+        # Without the model, only encode and decode work, e.g. for a PooledPredictor
+        self.model = _load_model(self.model_path, backend, self._load_torch_model) if load_model else None
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_config['base_model'])
+
+    def encode(self, sentences: List[str], heads: Tuple[str, ...] = HEADS) -> BatchEncoding:
+        """Tokenize a batch of sentences once for both heads. Both heads share the encoder
+        pass, so they are always both predicted, whatever `heads` asks for."""
+        return _encode_multi_head(self.tokenizer, sentences)
+
+    def _load_torch_model(self) -> torch.nn.Module:
+        encoder_config = AutoConfig.from_pretrained(Path.joinpath(self.model_path, 'encoder'))
+        return _build_with_weights(
+            lambda: MultiHeadModel(AutoModel.from_config(encoder_config), len(self.id2label), len(self.id2tag)),
+            self.model_path)
+
+    def forward(self, encoded: BatchEncoding) -> Tuple[torch.Tensor, torch.Tensor]:
+        return _run_model(self.model, encoded)
+
+    def export_onnx(self) -> Path:
+        """Export the model next to its weights for the onnxruntime backend"""
+        return _export_onnx(self.model, self.backend, Path.joinpath(self.model_path, ONNX_FILE),
+                            {"sequence_logits": {0: "batch"}, "token_logits": {0: "batch", 1: "sequence"}})
+
+    def decode(self, encoded: BatchEncoding, logits: Tuple[torch.Tensor, torch.Tensor]) -> List[Prediction]:
+        return _decode_multi_head(self.tokenizer, self.id2label, self.id2tag, encoded, logits)
+
+    def predict_batch(self, sentences: List[str], heads: Tuple[str, ...] = HEADS) -> List[Prediction]:
+        encoded = self.encode(sentences, heads)
+        with torch.inference_mode():
+            logits = self.forward(encoded)
+        return self.decode(encoded, logits)
+
+
+def build_multi_head_model(sequence_model_path: str, token_model_path: str, output_path: str,
+                           encoder_source: str = "sequence", sample_sentences: Optional[List[str]] = None,
+                           min_agreement: float = 1.0) -> None:
+    """Combine the separate sentence and token models into one MultiHeadPredictor checkpoint.
+
+    Both heads are kept, but only one of the two fine-tuned encoders survives. The head
+    of the other model then runs on an encoder it was not trained with, which only works
+    if both models share their encoder, e.g. because they were fine-tuned jointly. So the
+    combined model is compared with the separate models first, and nothing is written
+    unless they predict the same labels.
+
+    Args:
+        sequence_model_path: Directory of the SentenceClassPredictor model.
+
+        token_model_path: Directory of the TokenClassPredictor model.
+
+        output_path: Directory to write the combined checkpoint to.
+
+        encoder_source: Which model's encoder to keep, "sequence" or "token".
+
+        sample_sentences: Messages to compare the models on, defaults to PARITY_SENTENCES.
+
+        min_agreement: Share of the messages on which all sentence and token labels
+            have to agree.
+
+    Raises:
+        InferenceError: The combined model disagrees with the separate models.
+    """
+    if encoder_source not in ("sequence", "token"):
+        raise ValueError(f"encoder_source must be 'sequence' or 'token', not {encoder_source!r}")
+
+    sequence = SentenceClassPredictor(sequence_model_path)
+    token = TokenClassPredictor(token_model_path)
+    sequence_base = getattr(sequence.model, sequence.model.base_model_prefix)
+    token_base = getattr(token.model, token.model.base_model_prefix)
+
+    # The token model is built without a pooler, the sentence head needs the one it was trained with
+    encoder = AutoModel.from_config(sequence_base.config)
+    encoder_state = (sequence_base if encoder_source == "sequence" else token_base).state_dict()
+    encoder_state.update({f"pooler.{k}": v for k, v in sequence_base.pooler.state_dict().items()})
+    encoder.load_state_dict(encoder_state)
+
+    model = MultiHeadModel(encoder, len(sequence.id2label), len(token.id2tag))
+    model.sequence_head.load_state_dict(sequence.model.classifier.state_dict())
+    model.token_head.load_state_dict(token.model.classifier.state_dict())
+    _check_parity(model, sequence, token, list(sample_sentences or PARITY_SENTENCES), min_agreement)
+
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    encoder.config.save_pretrained(Path.joinpath(output_path, 'encoder'))
+    torch.save(model.state_dict(), Path.joinpath(output_path, PYTORCH_FILE))
+    with open(Path.joinpath(output_path, 'config.json'), 'w') as mconfig:
+        json.dump({
+            "base_model": sequence.model_config['_name_or_path'],
+            "id2label": sequence.id2label,
+            "id2tag": token.id2tag,
+            "unique_tags": token.model_config['unique_tags'],
+            "encoder_source": encoder_source,
+        }, mconfig, indent=2, ensure_ascii=False)
+
+
+def _check_parity(model: MultiHeadModel, sequence: SentenceClassPredictor, token: TokenClassPredictor,
+                  sentences: List[str], min_agreement: float) -> None:
+    """Raise an InferenceError unless the combined model predicts what the separate models do"""
+    model.eval()
+    encoded = _encode_multi_head(sequence.tokenizer, sentences)
+    with torch.inference_mode():
+        combined = _decode_multi_head(sequence.tokenizer, sequence.id2label, token.id2tag, encoded,
+                                      model(encoded['input_ids'], encoded['attention_mask']))
+    separate = JointPredictor(sequence, token).predict_batch(sentences)
+
+    disagreeing = [sentence for sentence, a, b in zip(sentences, combined, separate) if a != b]
+    agreeing = len(sentences) - len(disagreeing)
+    if agreeing < min_agreement * len(sentences):
+        raise InferenceError(
+            f"The combined model agrees with the separate models on {agreeing} of {len(sentences)} messages, "
+            f"not e.g. on {disagreeing[0]!r}. Its heads need one shared, jointly fine-tuned encoder."
+        )
+    logger.info(f"The combined model agrees with the separate models on {agreeing} of {len(sentences)} messages")
+
+
+def load_predictor(model_path: str, backend: str = "torch", load_model: bool = True):
+    """Load any bot model directory, picking the predictor from its config.json"""
+    model_config = _get_model_config(Path.joinpath(Path(model_path), 'config.json'))
+    if 'id2tag' in model_config and 'id2label' in model_config:
+        return MultiHeadPredictor(model_path, backend=backend, load_model=load_model)
+    if 'id2tag' in model_config:
+        return TokenClassPredictor(model_path, backend=backend, load_model=load_model)
+    return SentenceClassPredictor(model_path, backend=backend, load_model=load_model)
+
+
+def load_joint_predictor(sequence_model_path: str, token_model_path: str, backend: str = "torch",
+                         load_model: bool = True) -> JointPredictor:
+    """Load the separate sentence and token models"""
+    return JointPredictor(SentenceClassPredictor(sequence_model_path, backend=backend, load_model=load_model),
+                          TokenClassPredictor(token_model_path, backend=backend, load_model=load_model))
+
+
+class RemotePredictor:
+    """Sends messages to an inference server (see `autorecorderbot.inference_server`)
+    instead of loading the models, so several bots can share one warm model host.
+
+    Args:
+        server_url: Base URL of the inference server, e.g. "http://127.0.0.1:8090".
+
+        timeout: Seconds to wait for the server to answer a batch.
+    """
+
+    def __init__(self, server_url: str, timeout: float = 30.0) -> None:
+        self.server_url = server_url.rstrip('/')
+        self.timeout = timeout
+
+    def predict_batch(self, sentences: List[str], heads: Tuple[str, ...] = HEADS) -> List[Prediction]:
+        """Predict the sentences on the server, always with both heads"""
+        request = urllib.request.Request(
+            f"{self.server_url}/predict",
+            data=json.dumps({"sentences": sentences}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                body = json.load(response)
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            raise InferenceError(f"Inference server {self.server_url} failed: {e!r}")
+        return [Prediction(p["sentence_label"], p["tokens"], p["token_labels"]) for p in body["predictions"]]
+
+
+def create_local_predictor(config: Config):
+    """Load the models configured in the `intelligence` section in this process, or in a
+    pool of worker processes"""
+    if config.multi_head_model_path:
+        load = partial(load_predictor, config.multi_head_model_path, backend=config.inference_backend)
+    else:
+        load = partial(load_joint_predictor, config.sequence_model_path, config.token_model_path,
+                       backend=config.inference_backend)
+
+    if config.inference_worker_processes:
+        # Imported here, only the worker pool needs torch.multiprocessing
+        from autorecorderbot.inference_workers import PooledPredictor
+
+        # One pool for all models, every message is a single round trip to one worker
+        return PooledPredictor(load, processes=config.inference_worker_processes,
+                               threads_per_process=config.inference_worker_threads)
+    return load()
+
+
+def create_predictor(config: Config):
+    """Load the predictor configured in the `intelligence` section, or connect to the
+    configured inference server"""
+    if config.inference_server_url:
+        return RemotePredictor(config.inference_server_url, timeout=config.inference_server_timeout)
+    return create_local_predictor(config)
+
+
+def model_revision(config: Config) -> str:
+    """Identify the configured models, so cached predictions of older models are not reused.
+
+    Hashes the backend and the config, size and modification time of the weight files of
+    every model directory. Paths that are not local directories (huggingface names)
+    only contribute their name.
+    """
+    if config.multi_head_model_path:
+        model_paths = [config.multi_head_model_path]
+    else:
+        model_paths = [config.sequence_model_path, config.token_model_path]
+
+    revision = hashlib.sha256(config.inference_backend.encode())
+    for model_path in model_paths:
+        revision.update(str(model_path).encode())
+        for name in REVISION_FILES:
+            file_path = Path.joinpath(Path(model_path), name)
+            if name == 'config.json' and file_path.is_file():
+                revision.update(file_path.read_bytes())
+            elif file_path.is_file():
+                stat = file_path.stat()
+                revision.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return revision.hexdigest()[:16]
+
+
+def normalize_message(sentence: str) -> str:
+    """Normalize a message for the prediction cache.
+
+    Only unicode composition and whitespace are normalized, both are invisible to the
+    tokenizer. Case and punctuation are kept, the models are case sensitive.
+    """
+    return " ".join(unicodedata.normalize("NFC", sentence).split())
+
+
+class PredictionCache:
+    """Bounded LRU cache of predictions, keyed by the normalized message and the model revision.
+
+    Args:
+        max_size: Maximum number of cached predictions, the least recently used ones are
+            dropped first.
+
+        revision: Revision of the models the predictions come from, see `model_revision`.
+
+        path: JSON file the cache is persisted to across restarts. The cache is loaded
+            from it if it exists and was written for the same revision.
+    """
+
+    # Number of new predictions after which the cache is written to `path` again
+    SAVE_INTERVAL = 100
+
+    def __init__(self, max_size: int = 1024, revision: str = "", path: Optional[str] = None) -> None:
+        self.max_size = max(1, int(max_size))
+        self.revision = revision
+        self.path = Path(path) if path else None
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Prediction]" = OrderedDict()
+        self._unsaved = 0
+        if self.path is not None:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def key(self, sentence: str) -> str:
+        return hashlib.sha256(f"{self.revision}\0{normalize_message(sentence)}".encode()).hexdigest()
+
+    def get(self, sentence: str) -> Optional[Prediction]:
+        key = self.key(sentence)
+        prediction = self._entries.get(key)
+        if prediction is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return prediction
+
+    def put(self, sentence: str, prediction: Prediction) -> None:
+        key = self.key(sentence)
+        self._entries[key] = prediction
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        self._unsaved += 1
+        if self.path is not None and self._unsaved >= self.SAVE_INTERVAL:
+            self.save()
+
+    def load(self) -> None:
+        """Read the predictions persisted at `path`"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable prediction cache {self.path}: {e}")
+            return
+        if data.get("revision") != self.revision:
+            logger.info("Prediction cache was written for other models, starting with an empty cache")
+            return
+
+        for key, prediction in data.get("entries", [])[-self.max_size:]:
+            self._entries[key] = Prediction(*prediction)
+        logger.info(f"Loaded {len(self._entries)} cached predictions from {self.path}")
+
+    def save(self) -> None:
+        """Persist the cache to `path`, replacing the previous file atomically"""
+        if self.path is None:
+            return
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({"revision": self.revision, "entries": list(self._entries.items())}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self._unsaved = 0
+
+
+class InferenceEngine:
+    """Micro-batches incoming messages and runs the models off the event loop.
+
+    Messages are queued and grouped into batches of at most `max_batch_size` messages.
+    A batch is closed as soon as it is full or `max_wait_ms` after its first message
+    arrived, whichever comes first. Batches are run on a dedicated worker thread, so
+    the asyncio event loop keeps processing sync responses while the model computes.
+    Under load, messages pile up while a batch runs and the next batch is larger.
+
+    With a cache, repeated messages are answered from it without queueing, and identical
+    messages in one batch are only run through the model once.
+
+    Callers that only need some of the `HEADS` ask for them, and the messages of a batch
+    are run once per set of heads. Only predictions of all heads are cached, but they
+    answer callers of any head.
+
+    Instead of a loaded predictor, the engine can be given a factory that loads it. The
+    models are then loaded on the worker thread once the engine is started, and messages
+    submitted in the meantime are queued until they are ready.
+
+    Args:
+        predictor: Anything with a `predict_batch(sentences)` method returning one
+            result per sentence, usually a JointPredictor or MultiHeadPredictor.
+            None if `predictor_factory` is given.
+
+        max_batch_size: Maximum number of messages run through the model at once.
+
+        max_wait_ms: Maximum time a message waits for other messages to join its batch.
+
+        cache: Cache for the predictions, None to always run the model.
+
+        predictor_factory: Loads the predictor in the background, e.g. `create_predictor`
+            bound to the bot config.
+    """
+
+    def __init__(self, predictor: Optional[Union[JointPredictor, MultiHeadPredictor, RemotePredictor]] = None,
+                 max_batch_size: int = 16, max_wait_ms: float = 10.0, cache: Optional[PredictionCache] = None,
+                 predictor_factory: Optional[Callable[[], Union[JointPredictor, MultiHeadPredictor, RemotePredictor]]] = None) -> None:
+        if predictor is None and predictor_factory is None:
+            raise ValueError("Either a predictor or a predictor_factory is required")
+        self.predictor = predictor
+        self.predictor_factory = predictor_factory
+        self.cache = cache
+        self._loading: Optional[asyncio.Future] = None
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self._queue: Optional[asyncio.Queue] = None
+        self._batcher: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Start the batching task on the running event loop, and loading the models if necessary"""
+        loop = asyncio.get_running_loop()
+        if self.predictor is None and self._loading is None:
+            self._loading = loop.run_in_executor(self._executor, self._load_predictor)
+        if self._batcher is None or self._batcher.done():
+            self._queue = asyncio.Queue()
+            self._batcher = loop.create_task(self._run())
+
+    @property
+    def ready(self) -> bool:
+        """Whether the models are loaded"""
+        return self.predictor is not None
+
+    async def wait_until_ready(self) -> None:
+        """Start loading the models if necessary and wait until they are loaded"""
+        self.start()
+        if self._loading is not None:
+            await self._loading
+
+    def _load_predictor(self) -> None:
+        started = time.monotonic()
+        predictor = self.predictor_factory()
+        logger.info(f"Startup: loaded the models in {time.monotonic() - started:.2f}s")
+        self.predictor = predictor
+
+    async def close(self) -> None:
+        """Stop batching, wait for the worker thread and close the predictor"""
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            self._batcher = None
+        # Models that are still loading are closed as well once they are ready
+        await asyncio.get_running_loop().run_in_executor(None, partial(self._executor.shutdown, wait=True))
+        if hasattr(self.predictor, 'close'):
+            self.predictor.close()
+        if self.cache is not None:
+            self.cache.save()
+            logger.info(f"Prediction cache: {self.cache.hits} hits, {self.cache.misses} misses")
+
+    def submit(self, sentence: str, heads: Tuple[str, ...] = HEADS) -> "asyncio.Future[Prediction]":
+        """Queue a message for prediction.
+
+        Args:
+            heads: The heads to predict, see `HEADS`.
+
+        Returns:
+            A future that resolves to the Prediction for this message.
+        """
+        future = asyncio.get_running_loop().create_future()
+        cached = self.cache.get(sentence) if self.cache is not None else None
+        if cached is not None:
+            future.set_result(cached)
+            return future
+
+        self.start()
+        self._queue.put_nowait((sentence, tuple(heads), future))
+        return future
+
+    async def predict(self, sentence: str, heads: Tuple[str, ...] = HEADS) -> Prediction:
+        return await self.submit(sentence, heads)
+
+    async def _next_batch(self) -> List[Tuple[str, Tuple[str, ...], asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            # Take whatever is already waiting before considering the deadline
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Callers may have given up on their message in the meantime
+        return [(sentence, heads, future) for sentence, heads, future in batch if not future.done()]
+
+    def _predict_batch(self, sentences: List[str], heads: Tuple[str, ...]) -> List[Prediction]:
+        if heads == HEADS:
+            return self.predictor.predict_batch(sentences)
+        return self.predictor.predict_batch(sentences, heads=heads)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                continue
+
+            # Identical messages in one batch only need to be predicted once per set of heads
+            groups: Dict[Tuple[str, ...], Dict[str, None]] = {}
+            for sentence, heads, _ in batch:
+                groups.setdefault(heads, {})[sentence] = None
+            try:
+                if self.predictor is None:
+                    logger.info(f"Waiting for the models to load, {len(batch) + self._queue.qsize()} messages buffered")
+                    await self._loading
+                predictions = {}
+                for heads, sentences in groups.items():
+                    sentences = list(sentences)
+                    results = await loop.run_in_executor(self._executor, self._predict_batch, sentences, heads)
+                    predictions.update({(sentence, heads): result for sentence, result in zip(sentences, results)})
+            except Exception as e:
+                logger.exception(f"Inference failed for a batch of {len(batch)} messages")
+                # Hand every caller its own error, the original traceback holds this task's frame
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(InferenceError(f"Inference failed: {e!r}"))
+                continue
+
+            logger.debug(f"Predicted a batch of {len(predictions)} messages")
+            if self.cache is not None:
+                for (sentence, heads), prediction in predictions.items():
+                    if heads == HEADS:
+                        self.cache.put(sentence, prediction)
+            for sentence, heads, future in batch:
+                if not future.done():
+                    future.set_result(predictions[sentence, heads])
+
+
+def create_engine(config: Config, predictor_factory: Optional[Callable[[], Any]] = None) -> InferenceEngine:
+    """Build the inference engine configured in the `intelligence` section. The models are
+    loaded once it is started.
+
+    Args:
+        config: The bot config.
+
+        predictor_factory: Loads the predictor, `create_predictor` for the config by default.
+    """
+    cache = None
+    if config.inference_cache_size:
+        # The models behind an inference server may change without this process noticing,
+        # so their predictions are only cached in memory
+        cache_path = None if config.inference_server_url else config.inference_cache_path
+        cache = PredictionCache(config.inference_cache_size, revision=model_revision(config), path=cache_path)
+    return InferenceEngine(
+        max_batch_size=config.inference_max_batch_size,
+        max_wait_ms=config.inference_max_wait_ms,
+        cache=cache,
+        predictor_factory=predictor_factory or partial(create_predictor, config),
+    )
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 import asyncio
 import logging
+import random
 import sys
-from time import sleep
+import time
 
 from aiohttp import ClientConnectionError, ServerDisconnectedError
 from nio import (
@@ -13,19 +14,34 @@ from nio import (
     LoginError,
     MegolmEvent,
     RoomMessageText,
+    SyncResponse,
     UnknownEvent,
 )
 
 from autorecorderbot.callbacks import Callbacks
 from autorecorderbot.config import Config
+from autorecorderbot.send_queue import SendScheduler
+from autorecorderbot.storage_async import AsyncStorage
 from autorecorderbot.storage_local import Storage
 
 
 logger = logging.getLogger(__name__)
 
+# Delays (in seconds) between attempts to reconnect to the homeserver
+RECONNECT_BASE_DELAY = 2
+RECONNECT_MAX_DELAY = 300
+
+
+def log_startup_phase(phase: str, started: float) -> float:
+    """Log how long a phase of the startup took and return the start of the next one"""
+    now = time.monotonic()
+    logger.info(f"Startup: {phase} took {now - started:.2f}s")
+    return now
+
 
 async def main():
     """The first function that is run when starting the bot"""
+    startup = phase_started = time.monotonic()
 
     # Read user-configured options from a config file.
     # A different config file path can be specified as the first command line argument
@@ -36,12 +52,14 @@ async def main():
 
     # Read the parsed config file and create a Config object
     config = Config(config_path)
+    phase_started = log_startup_phase("reading the config", phase_started)
 
-    # Configure the database
-    store = Storage(config.database)
+    # Configure the database. Callbacks go through the non-blocking facade.
+    store = AsyncStorage(Storage(config.database), max_queue_size=config.write_queue_size)
+    phase_started = log_startup_phase("opening the database", phase_started)
 
-
-    # Configuration options for the AsyncClient
+    # Configuration options for the AsyncClient. Rate limits are handled by the send
+    # scheduler below, nio itself gives up on the first 429.
     client_config = AsyncClientConfig(
         max_limit_exceeded=0,
         max_timeouts=0,
@@ -58,6 +76,14 @@ async def main():
         config=client_config,
     )
 
+    # Route all outgoing messages and reactions through one rate-limited queue
+    SendScheduler(
+        client,
+        rate=config.send_rate,
+        burst=config.send_burst,
+        max_concurrent_per_room=config.max_concurrent_sends,
+    ).install()
+
     if config.user_token:
         client.access_token = config.user_token
         client.user_id = config.user_id
@@ -69,53 +95,84 @@ async def main():
     client.add_event_callback(callbacks.decryption_failure, (MegolmEvent,))
     client.add_event_callback(callbacks.unknown, (UnknownEvent,))
 
-    # Keep trying to reconnect on failure (with some time in-between)
-    while True:
-        try:
-            if config.user_token:
-                # Use token to log in
-                client.load_store()
-
-                # Sync encryption keys with the server
-                if client.should_upload_keys:
-                    await client.keys_upload()
-            else:
-                # Try to login with the configured username/password
-                try:
-                    login_response = await client.login(
-                        password=config.user_password,
-                        device_name=config.device_name,
-                    )
-
-                    # Check if login failed
-                    if type(login_response) == LoginError:
-                        logger.error("Failed to login: %s", login_response.message)
+    # Load the models in the background while logging in and syncing. Messages that
+    # arrive before they are ready are buffered by the inference engine.
+    callbacks.inference.start()
+    phase_started = log_startup_phase("setting up the client", phase_started)
+
+    first_sync = True
+
+    async def log_first_sync(response: SyncResponse) -> None:
+        nonlocal first_sync
+        if first_sync:
+            first_sync = False
+            log_startup_phase("the first sync", phase_started)
+            log_startup_phase("starting the bot", startup)
+
+    client.add_response_callback(log_first_sync, (SyncResponse,))
+
+    try:
+        # Keep trying to reconnect on failure, waiting longer after every failed attempt
+        reconnect_attempt = 0
+        while True:
+            try:
+                if config.user_token:
+                    # Use token to log in
+                    client.load_store()
+
+                    # Sync encryption keys with the server
+                    if client.should_upload_keys:
+                        await client.keys_upload()
+                else:
+                    # Try to login with the configured username/password
+                    try:
+                        login_response = await client.login(
+                            password=config.user_password,
+                            device_name=config.device_name,
+                        )
+
+                        # Check if login failed
+                        if type(login_response) == LoginError:
+                            logger.error("Failed to login: %s", login_response.message)
+                            return False
+                    except LocalProtocolError as e:
+                        # There's an edge case here where the user hasn't installed the correct C
+                        # dependencies. In that case, a LocalProtocolError is raised on login.
+                        logger.fatal(
+                            "Failed to login. Have you installed the correct dependencies? "
+                            "https://github.com/poljar/matrix-nio#installation "
+                            "Error: %s",
+                            e,
+                        )
                         return False
-                except LocalProtocolError as e:
-                    # There's an edge case here where the user hasn't installed the correct C
-                    # dependencies. In that case, a LocalProtocolError is raised on login.
-                    logger.fatal(
-                        "Failed to login. Have you installed the correct dependencies? "
-                        "https://github.com/poljar/matrix-nio#installation "
-                        "Error: %s",
-                        e,
-                    )
-                    return False
-
-                # Login succeeded!
-
-            logger.info(f"Logged in as {config.user_id}")
-            await client.sync_forever(timeout=30000, full_state=True)
-
-        except (ClientConnectionError, ServerDisconnectedError):
-            logger.warning("Unable to connect to homeserver, retrying in 15s...")
-
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        finally:
-            # Make sure to close the client connection on disconnect
-            await client.close()
-
-
-# Run the main function in an asyncio event loop
-asyncio.get_event_loop().run_until_complete(main())
+
+                    # Login succeeded!
+
+                logger.info(f"Logged in as {config.user_id}")
+                if first_sync:
+                    phase_started = log_startup_phase("logging in", phase_started)
+                reconnect_attempt = 0
+                await client.sync_forever(timeout=30000, full_state=True)
+
+            except (ClientConnectionError, ServerDisconnectedError):
+                # Back off exponentially (with jitter) so we don't bombard the server with
+                # login requests, without blocking the event loop in the meantime
+                delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** reconnect_attempt)
+                delay *= random.uniform(0.5, 1.0)
+                reconnect_attempt += 1
+                logger.warning(f"Unable to connect to homeserver, retrying in {delay:.0f}s...")
+                await asyncio.sleep(delay)
+            finally:
+                # Make sure to close the client connection on disconnect
+                await client.close()
+    finally:
+        # Save the prediction cache and stop the inference workers
+        await callbacks.inference.close()
+        # Commit the writes that are still queued, the writer thread does not outlive the bot
+        await store.close()
+
+
+# Run the main function in an asyncio event loop. Only when run as a script, inference
+# worker processes import this module again.
+if __name__ == "__main__":
+    asyncio.run(main())
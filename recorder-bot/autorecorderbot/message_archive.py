@@ -0,0 +1,290 @@
+"""
+Streaming readers for archived messages, for offline jobs over the whole history.
+
+Every reader yields `ArchivedMessage`s one at a time without loading the file, so
+multi-GB archives are processed in constant memory. Supported inputs:
+
+    TinyDB `messages.json` of older bot versions   {"_default": {"1": {...}, ...}}
+    room exports of scripts-dev/extract_messages.py [{...}, ...] or one JSON record per line
+    JSON lines and CSV files with a `message` column (and optionally roomid, sender, timestamp)
+    the SQLite database of the bot (its `messages` table)
+"""
+import csv
+import json
+import os
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, NamedTuple, Optional, TextIO
+
+# Characters read from a JSON file at a time
+CHUNK_SIZE = 1 << 16
+
+# Input formats of `read_archive`
+FORMATS = ("tinydb", "room-export", "jsonl", "csv", "sqlite")
+
+
+class ArchivedMessage(NamedTuple):
+    """A message of an archive, in the order of the archive"""
+    record_id: str
+    roomid: Optional[str]
+    message: str
+    sender: Optional[str]
+    timestamp: Optional[int]
+
+
+class _JsonStream:
+    """Incremental JSON tokenizer that decodes one value at a time from a text stream.
+
+    Containers are walked with `members` and `elements`, which stop at every entry so
+    the caller decodes (`value`) or descends into it. Only the entry currently being
+    decoded is held in memory.
+    """
+
+    _WHITESPACE = " \t\n\r"
+
+    def __init__(self, stream: TextIO, chunk_size: int = CHUNK_SIZE) -> None:
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        """Read the next chunk, dropping everything already decoded"""
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """The next non-whitespace character, "" at the end of the stream"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self._WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, characters: str) -> str:
+        """Consume the next character, which must be one of `characters`"""
+        char = self.peek()
+        if not char or char not in characters:
+            raise ValueError(f"Expected one of {characters!r} in JSON, found {char or 'the end'!r}")
+        self.pos += 1
+        return char
+
+    def value(self) -> Any:
+        """Decode the next complete value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def members(self) -> Iterator[str]:
+        """Walk an object: yields every key, the caller then consumes its value"""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def elements(self) -> Iterator[int]:
+        """Walk an array: yields every index, the caller then consumes the element"""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        index = 0
+        while True:
+            yield index
+            index += 1
+            if self.expect(",]") == "]":
+                return
+
+
+def _message(record_id: str, record: Dict[str, Any], roomid: Optional[str] = None) -> ArchivedMessage:
+    timestamp = record.get("timestamp")
+    return ArchivedMessage(
+        record_id=str(record.get("id", record_id)),
+        roomid=record.get("roomid") or roomid,
+        message=record.get("message") or "",
+        sender=record.get("sender"),
+        timestamp=int(timestamp) if timestamp not in (None, "") else None,
+    )
+
+
+def iter_tinydb_documents(path: str, table: str = "_default",
+                          chunk_size: int = CHUNK_SIZE) -> Iterator[tuple]:
+    """Stream (doc_id, document) pairs of a TinyDB JSON file, in file order"""
+    with open(path, encoding="utf-8") as f:
+        stream = _JsonStream(f, chunk_size)
+        for name in stream.members():
+            if name != table:
+                stream.value()
+                continue
+            for doc_id in stream.members():
+                yield doc_id, stream.value()
+
+
+def read_tinydb(path: str, table: str = "_default") -> Iterator[ArchivedMessage]:
+    """Messages of the TinyDB `messages.json` written by older versions of the bot"""
+    for doc_id, document in iter_tinydb_documents(path, table):
+        yield _message(doc_id, document)
+
+
+def read_room_export(path: str, roomid: Optional[str] = None) -> Iterator[ArchivedMessage]:
+    """Messages of a JSON array of one room, as written by scripts-dev/extract_messages.py.
+
+    The records of these exports do not repeat the room, it defaults to the file name.
+    """
+    roomid = roomid or Path(path).stem
+    with open(path, encoding="utf-8") as f:
+        stream = _JsonStream(f)
+        for index in stream.elements():
+            yield _message(str(index), stream.value(), roomid)
+
+
+def read_jsonl(path: str) -> Iterator[ArchivedMessage]:
+    """Messages of a file with one JSON record per line"""
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                yield _message(str(line_number), json.loads(line))
+
+
+def read_csv(path: str) -> Iterator[ArchivedMessage]:
+    """Messages of a CSV file with a header row"""
+    with open(path, encoding="utf-8", newline="") as f:
+        for row_number, row in enumerate(csv.DictReader(f), 1):
+            yield _message(str(row_number), row)
+
+
+def read_sqlite(path: str) -> Iterator[ArchivedMessage]:
+    """Messages of the `messages` table of a bot database, in the order they were stored"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        # Iterating the cursor fetches the rows in batches
+        for row in conn.execute("SELECT id, roomid, message, sender, timestamp FROM messages ORDER BY id"):
+            yield ArchivedMessage(str(row[0]), row[1], row[2] or "", row[3], row[4])
+    finally:
+        conn.close()
+
+
+def detect_format(path: str) -> str:
+    """Guess the format of an archive from its extension, and for .json from its content"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if extension == ".csv":
+        return "csv"
+    if extension in (".db", ".sqlite", ".sqlite3"):
+        return "sqlite"
+    with open(path, encoding="utf-8") as f:
+        first = _JsonStream(f, chunk_size=4096).peek()
+    if first == "{":
+        return "tinydb"
+    if first == "[":
+        return "room-export"
+    raise ValueError(f"Cannot tell the format of {path}, pass one of {', '.join(FORMATS)}")
+
+
+def read_archive(path: str, archive_format: Optional[str] = None) -> Iterator[ArchivedMessage]:
+    """Stream the messages of an archive of any supported format"""
+    archive_format = archive_format or detect_format(path)
+    readers = {
+        "tinydb": read_tinydb,
+        "room-export": read_room_export,
+        "jsonl": read_jsonl,
+        "csv": read_csv,
+        "sqlite": read_sqlite,
+    }
+    if archive_format not in readers:
+        raise ValueError(f"Unknown archive format {archive_format!r}, use one of {', '.join(FORMATS)}")
+    return readers[archive_format](path)
+
+
+class ResumableOutput:
+    """JSON lines output of a job over an archive that can continue where it stopped.
+
+    After every `write` the output is flushed to disk and a checkpoint next to it records
+    how many input records are done and how long the output is. A restarted job for the
+    same input and revision truncates whatever was written after the last checkpoint and
+    skips the records that are done.
+
+    Args:
+        path: The JSON lines file to write.
+
+        source: Identifies the input, e.g. its absolute path.
+
+        revision: Identifies whatever produces the output, e.g. the model revision.
+            Results of another revision are not continued.
+
+        restart: Ignore any checkpoint and start over.
+    """
+
+    def __init__(self, path: str, source: str, revision: str = "", restart: bool = False) -> None:
+        self.path = path
+        self.checkpoint_path = f"{path}.checkpoint"
+        self.source = source
+        self.revision = revision
+        self.done = 0
+
+        checkpoint = None if restart else self._read_checkpoint()
+        if checkpoint is not None and os.path.exists(path):
+            self.done = checkpoint["records"]
+            self._file = open(path, "r+b")
+            self._file.truncate(checkpoint["bytes"])
+            self._file.seek(checkpoint["bytes"])
+        else:
+            self._file = open(path, "wb")
+            self._write_checkpoint()
+
+    def _read_checkpoint(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if checkpoint.get("source") != self.source or checkpoint.get("revision") != self.revision:
+            return None
+        return checkpoint
+
+    def _write_checkpoint(self) -> None:
+        staging = f"{self.checkpoint_path}.tmp"
+        with open(staging, "w") as f:
+            json.dump({"source": self.source, "revision": self.revision,
+                       "records": self.done, "bytes": self._file.tell()}, f)
+        os.replace(staging, self.checkpoint_path)
+
+    def write(self, rows: Iterable[Dict[str, Any]], records: int) -> None:
+        """Append rows and mark `records` more input records as done"""
+        for row in rows:
+            self._file.write(json.dumps(row, ensure_ascii=False).encode("utf-8") + b"\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.done += records
+        self._write_checkpoint()
+
+    def close(self) -> None:
+        self._file.close()
@@ -0,0 +1,308 @@
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry(NamedTuple):
+    """In-memory index entry of a message"""
+    offset: int
+    type: str
+
+
+class MessageLog:
+    """Append-only message store, an alternative to the `messages` table of the database.
+
+    Every change is one JSON line appended to the log: an `insert` record per stored
+    message and an `update` record per type correction. Nothing already written is
+    rewritten, so storing a message costs the same however long the history is.
+
+    An index of the messages (log offset and current type, by room) is kept in memory
+    and saved next to the log as `<path>.index`, together with the log length it covers.
+    The whole index is only written on close and after compaction. In between, the index
+    entries of every `index_interval` new records are appended to it as one checkpoint
+    line, so saving the index does not get slower as the history grows either. On startup
+    the index and its checkpoints are loaded and only the log written after them is
+    replayed. A missing or broken index is rebuilt from the whole log, and a record cut
+    off by a crash is dropped.
+
+    Superseded records are removed by `compact`, which rewrites the log with one insert
+    record per message. A background thread compacts the log every `compact_interval`
+    seconds once at least `compact_ratio` of its records are superseded.
+
+    Args:
+        path: The log file.
+
+        compact_interval: Seconds between checks for compaction, 0 disables the thread.
+
+        compact_ratio: Share of superseded records from which on the log is compacted.
+
+        index_interval: Number of appended records after which their index entries are
+            appended to the index.
+    """
+
+    def __init__(self, path: str, compact_interval: float = 3600, compact_ratio: float = 0.25,
+                 index_interval: int = 1000) -> None:
+        self.path = path
+        self.index_path = f"{path}.index"
+        self.compact_ratio = compact_ratio
+        self.index_interval = max(1, index_interval)
+
+        self._lock = threading.RLock()
+        self._entries: Dict[int, _Entry] = {}
+        # Message ids of every room, in the order they were stored
+        self._rooms: Dict[str, List[int]] = {}
+        self._last_id = 0
+        self._superseded = 0
+        self._unindexed = 0
+        # Index changes since the index was last written: new entries and type corrections
+        self._added: List[list] = []
+        self._updated: Dict[int, str] = {}
+
+        self._recover()
+        self._file = open(self.path, "ab")
+
+        self._stop = threading.Event()
+        self._compactor = None
+        if compact_interval:
+            self._compactor = threading.Thread(
+                target=self._compact_loop, args=(compact_interval,), name="message-log-compaction", daemon=True
+            )
+            self._compactor.start()
+
+    def _recover(self) -> None:
+        """Load the index and replay the log written after it"""
+        if not os.path.exists(self.path):
+            open(self.path, "ab").close()
+
+        start = 0
+        try:
+            with open(self.index_path) as f:
+                index = json.loads(f.readline())
+                # Compaction replaces the log by a new file, an index of the old one does not fit
+                if index["inode"] != os.stat(self.path).st_ino:
+                    raise ValueError("the index belongs to an earlier log file")
+                for roomid, messages in index["rooms"].items():
+                    for message_id, offset, sent_type in messages:
+                        self._add(message_id, roomid, offset, sent_type)
+                self._last_id = index["last_id"]
+                self._superseded = index["superseded"]
+                start = index["size"]
+
+                for line in f:
+                    # A checkpoint cut off by a crash is covered by replaying the log
+                    if not line.endswith("\n"):
+                        break
+                    try:
+                        checkpoint = json.loads(line)
+                    except ValueError:
+                        break
+                    for message_id, roomid, offset, sent_type in checkpoint["added"]:
+                        self._add(message_id, roomid, offset, sent_type)
+                    for message_id, sent_type in checkpoint["updated"]:
+                        self._entries[message_id] = self._entries[message_id]._replace(type=sent_type)
+                    self._last_id = checkpoint["last_id"]
+                    self._superseded = checkpoint["superseded"]
+                    start = checkpoint["size"]
+            if start > os.path.getsize(self.path):
+                raise ValueError("the log is shorter than the index")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Rebuilding the index of {self.path}: {e}")
+            self._entries.clear()
+            self._rooms.clear()
+            self._last_id = self._superseded = start = 0
+
+        replayed = 0
+        with open(self.path, "r+b") as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self._replay(record, offset)
+                offset += len(line)
+                replayed += 1
+            if offset < os.path.getsize(self.path):
+                logger.warning(f"Dropping an incomplete record at the end of {self.path}")
+                f.truncate(offset)
+        if replayed:
+            logger.info(f"Replayed {replayed} records of {self.path}")
+            self._save_index()
+
+    def _add(self, message_id: int, roomid: str, offset: int, sent_type: str) -> None:
+        self._entries[message_id] = _Entry(offset, sent_type)
+        self._rooms.setdefault(roomid, []).append(message_id)
+
+    def _replay(self, record: dict, offset: int) -> None:
+        if record["op"] == "insert":
+            self._add(record["id"], record["roomid"], offset, record["type"])
+            self._last_id = max(self._last_id, record["id"])
+        elif record["op"] == "update" and record["id"] in self._entries:
+            self._entries[record["id"]] = self._entries[record["id"]]._replace(type=record["type"])
+            self._superseded += 1
+
+    def _save_index(self) -> None:
+        """Write the whole index atomically, covering everything appended so far"""
+        size = self._file.tell() if getattr(self, "_file", None) else os.path.getsize(self.path)
+        rooms = {
+            roomid: [[message_id, self._entries[message_id].offset, self._entries[message_id].type] for message_id in ids]
+            for roomid, ids in self._rooms.items()
+        }
+        staging = f"{self.index_path}.tmp"
+        with open(staging, "w") as f:
+            json.dump({
+                "inode": os.stat(self.path).st_ino, "size": size, "last_id": self._last_id,
+                "superseded": self._superseded, "rooms": rooms,
+            }, f)
+            # Checkpoints are appended as the following lines
+            f.write("\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(staging, self.index_path)
+        self._added = []
+        self._updated = {}
+        self._unindexed = 0
+
+    def _checkpoint(self) -> None:
+        """Append the index changes since the index was last written to it"""
+        if not os.path.exists(self.index_path):
+            self._save_index()
+            return
+        with open(self.index_path, "a") as f:
+            f.write(json.dumps({
+                "size": self._file.tell(), "last_id": self._last_id, "superseded": self._superseded,
+                "added": self._added, "updated": list(self._updated.items()),
+            }) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._added = []
+        self._updated = {}
+        self._unindexed = 0
+
+    def _append(self, record: dict) -> int:
+        """Append a record and return its offset"""
+        offset = self._file.tell()
+        self._file.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        self._file.flush()
+        return offset
+
+    def _appended(self) -> None:
+        """Checkpoint the index now and then, once the memory reflects the appended record"""
+        self._unindexed += 1
+        if self._unindexed >= self.index_interval:
+            self._checkpoint()
+
+    def _read(self, message_id: int) -> dict:
+        with open(self.path, "rb") as f:
+            f.seek(self._entries[message_id].offset)
+            return json.loads(f.readline())
+
+    def store_message(self, roomid: str, message: str, sender: str, timestamp: int, sent_type: str,
+                      tokens: List[str]) -> int:
+        """Append a message and return its id"""
+        with self._lock:
+            message_id = self._last_id + 1
+            offset = self._append({
+                "op": "insert", "id": message_id, "roomid": roomid, "message": message, "sender": sender,
+                "timestamp": timestamp, "type": sent_type, "tokens": tokens,
+            })
+            self._last_id = message_id
+            self._add(message_id, roomid, offset, sent_type)
+            self._added.append([message_id, roomid, offset, sent_type])
+            self._appended()
+            return message_id
+
+    def update_type(self, message_id: int, sent_type: str) -> bool:
+        """Record a type correction of a message.
+
+        Returns:
+            False if there is no message with this id.
+        """
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is None:
+                return False
+            self._append({"op": "update", "id": message_id, "type": sent_type})
+            self._entries[message_id] = entry._replace(type=sent_type)
+            self._updated[message_id] = sent_type
+            self._superseded += 1
+            self._appended()
+            return True
+
+    def last_message_id(self, roomid: Optional[str] = None) -> Optional[int]:
+        """The id of the last message of a room, or of all rooms"""
+        with self._lock:
+            if roomid is None:
+                return self._last_id if self._entries else None
+            ids = self._rooms.get(roomid)
+            return ids[-1] if ids else None
+
+    def get_type(self, message_id: int) -> Optional[str]:
+        entry = self._entries.get(message_id)
+        return entry.type if entry else None
+
+    def get_last_message_types(self) -> Dict[str, str]:
+        """The type of the last message of every room"""
+        with self._lock:
+            return {roomid: self._entries[ids[-1]].type for roomid, ids in self._rooms.items() if ids}
+
+    def get_last_message_with_type(self, roomid: str, searched_type: str) -> str:
+        """The text of the last message of the room with the given type, "" if there is none"""
+        with self._lock:
+            for message_id in reversed(self._rooms.get(roomid, ())):
+                if self._entries[message_id].type == searched_type:
+                    return self._read(message_id)["message"]
+        return ""
+
+    def compact(self) -> None:
+        """Rewrite the log with one insert record per message, holding the current type"""
+        with self._lock:
+            staging = f"{self.path}.compact"
+            entries = {}
+            with open(self.path, "rb") as source, open(staging, "wb") as target:
+                for message_id in sorted(self._entries):
+                    entry = self._entries[message_id]
+                    source.seek(entry.offset)
+                    record = json.loads(source.readline())
+                    record["type"] = entry.type
+                    entries[message_id] = _Entry(target.tell(), entry.type)
+                    target.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+                target.flush()
+                os.fsync(target.fileno())
+
+            self._file.close()
+            os.replace(staging, self.path)
+            self._file = open(self.path, "ab")
+            self._entries = entries
+            self._superseded = 0
+            self._save_index()
+            logger.info(f"Compacted {self.path} to {len(entries)} records")
+
+    def _needs_compaction(self) -> bool:
+        records = len(self._entries) + self._superseded
+        return self._superseded > 0 and self._superseded >= self.compact_ratio * records
+
+    def _compact_loop(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            try:
+                if self._needs_compaction():
+                    self.compact()
+            except Exception:
+                logger.exception(f"Compacting {self.path} failed")
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._compactor is not None:
+            self._compactor.join()
+        with self._lock:
+            self._save_index()
+            self._file.close()
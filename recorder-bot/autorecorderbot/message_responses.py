@@ -4,7 +4,7 @@ from nio import AsyncClient, MatrixRoom, RoomMessageText
 
 from autorecorderbot.chat_functions import send_text_to_room
 from autorecorderbot.config import Config
-from autorecorderbot.storage_local import Storage
+from autorecorderbot.storage_async import AsyncStorage
 
 logger = logging.getLogger(__name__)
 
@@ -13,7 +13,7 @@ class Message:
     def __init__(
         self,
         client: AsyncClient,
-        store: Storage,
+        store: AsyncStorage,
         config: Config,
         message_content: str,
         room: MatrixRoom,
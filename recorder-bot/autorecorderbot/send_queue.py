@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import random
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+from aiohttp import ClientConnectionError, ServerDisconnectedError
+from nio import AsyncClient, ErrorResponse, Response, SendRetryError
+
+logger = logging.getLogger(__name__)
+
+# How many superseded event ids are remembered
+MAX_SUPERSEDED_EVENTS = 10000
+
+# The scheduler installed for each client, see `SendScheduler.install`
+_schedulers: "weakref.WeakKeyDictionary[AsyncClient, SendScheduler]" = weakref.WeakKeyDictionary()
+
+# Errors worth sending an event again for
+_RETRY_EXCEPTIONS = (
+    asyncio.TimeoutError,
+    ClientConnectionError,
+    ServerDisconnectedError,
+    SendRetryError,
+)
+
+
+def get_send_scheduler(client: AsyncClient) -> Optional["SendScheduler"]:
+    """The scheduler installed for the client, or None if events are sent directly"""
+    try:
+        return _schedulers.get(client)
+    except TypeError:
+        return None
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, and bursts of up to `burst` events.
+
+    Args:
+        rate: Tokens added per second.
+
+        burst: Maximum number of tokens saved up.
+    """
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Hand out no tokens for the given time, e.g. when the server asks us to back off"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._updated = self._paused_until
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class _Send:
+    """An event waiting to be sent"""
+
+    __slots__ = ("room_id", "message_type", "content", "key", "relates_to", "future")
+
+    def __init__(self, room_id: str, message_type: str, content: Dict[str, Any],
+                 key: Optional[Hashable], relates_to: Optional[str], future: asyncio.Future) -> None:
+        self.room_id = room_id
+        self.message_type = message_type
+        self.content = content
+        self.key = key
+        self.relates_to = relates_to
+        self.future = future
+
+
+class SendScheduler:
+    """Rate-limit-aware outbound queue for events sent to the homeserver.
+
+    Every room has its own queue, so a busy room cannot starve the others. All rooms
+    share one token bucket, as homeservers rate limit per user. When the server answers
+    with M_LIMIT_EXCEEDED the bucket is paused for the `retry_after_ms` it asked for, other
+    failures are retried with exponential backoff and jitter.
+
+    Redundant sends are coalesced: sending an event with the same key as one that is
+    still queued returns the queued one, and events relating to an event that was
+    superseded (see `supersede`) or to a room that was left (see `drop_room`) are not sent
+    at all and resolve to None.
+
+    Args:
+        client: The client to send events with.
+
+        rate: Events sent per second on average.
+
+        burst: Events that may be sent at once after a quiet period.
+
+        max_concurrent_per_room: Events of one room in flight at the same time.
+
+        max_retries: Attempts after the first one before giving up on an event.
+
+        base_retry_delay: Delay in seconds before the first retry, doubled every retry.
+    """
+
+    def __init__(
+        self,
+        client: AsyncClient,
+        rate: float = 5.0,
+        burst: int = 10,
+        max_concurrent_per_room: int = 4,
+        max_retries: int = 5,
+        base_retry_delay: float = 0.5,
+    ) -> None:
+        self.client = client
+        self.max_concurrent_per_room = max(1, max_concurrent_per_room)
+        self.max_retries = max_retries
+        self.base_retry_delay = base_retry_delay
+        self._bucket = TokenBucket(rate, burst)
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._dispatchers: Dict[str, asyncio.Task] = {}
+        self._in_flight: Dict[str, asyncio.Semaphore] = {}
+        self._pending: Dict[Hashable, _Send] = {}
+        # Used as an ordered set, the oldest entries are forgotten first
+        self._superseded: "OrderedDict[str, None]" = OrderedDict()
+
+    def install(self) -> "SendScheduler":
+        """Route `send_text_to_room` and `react_to_event` for this client through the scheduler"""
+        _schedulers[self.client] = self
+        return self
+
+    async def send(
+        self,
+        room_id: str,
+        message_type: str,
+        content: Dict[str, Any],
+        key: Optional[Hashable] = None,
+        relates_to: Optional[str] = None,
+    ) -> Optional[Response]:
+        """Queue an event and wait until it was sent.
+
+        Args:
+            room_id: The ID of the room to send the event to.
+
+            message_type: The type of the event, e.g. "m.room.message".
+
+            content: The content of the event.
+
+            key: Events with the same key are considered identical. While one is
+                queued, sending another one returns the queued one instead.
+
+            relates_to: The ID of the event this event refers to, e.g. the event a
+                reaction is for.
+
+        Returns:
+            The response of the homeserver (an ErrorResponse if it kept failing), or None
+            if the event was coalesced away.
+        """
+        if relates_to in self._superseded:
+            logger.debug(f"Not sending {message_type} for superseded event {relates_to}")
+            return None
+        if key is not None and key in self._pending:
+            return await asyncio.shield(self._pending[key].future)
+
+        item = _Send(room_id, message_type, content, key, relates_to, asyncio.get_running_loop().create_future())
+        if key is not None:
+            self._pending[key] = item
+        self._queue_for(room_id).put_nowait(item)
+        return await asyncio.shield(item.future)
+
+    def supersede(self, event_id: str) -> None:
+        """Drop queued and future events that relate to `event_id`"""
+        self._superseded[event_id] = None
+        if len(self._superseded) > MAX_SUPERSEDED_EVENTS:
+            self._superseded.popitem(last=False)
+
+    def drop_room(self, room_id: str) -> None:
+        """Drop all events still queued for the room"""
+        dispatcher = self._dispatchers.pop(room_id, None)
+        if dispatcher is not None:
+            dispatcher.cancel()
+        self._in_flight.pop(room_id, None)
+        queue = self._queues.pop(room_id, None)
+        while queue is not None and not queue.empty():
+            self._finish(queue.get_nowait(), None)
+
+    def _queue_for(self, room_id: str) -> asyncio.Queue:
+        if room_id not in self._queues:
+            self._queues[room_id] = asyncio.Queue()
+            self._in_flight[room_id] = asyncio.Semaphore(self.max_concurrent_per_room)
+        dispatcher = self._dispatchers.get(room_id)
+        if dispatcher is None or dispatcher.done():
+            self._dispatchers[room_id] = asyncio.get_running_loop().create_task(self._dispatch(room_id))
+        return self._queues[room_id]
+
+    async def _dispatch(self, room_id: str) -> None:
+        """Send the queued events of one room, in order and with bounded concurrency.
+        Returns once the queue is empty, `_queue_for` starts it again for the next event."""
+        queue = self._queues[room_id]
+        in_flight = self._in_flight[room_id]
+        while True:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await in_flight.acquire()
+            except asyncio.CancelledError:
+                # The room was dropped while this event waited for a free slot
+                self._finish(item, None)
+                raise
+            task = asyncio.get_running_loop().create_task(self._deliver(item))
+            task.add_done_callback(lambda _: in_flight.release())
+
+    async def _deliver(self, item: _Send) -> None:
+        response = None
+        for attempt in range(self.max_retries + 1):
+            if item.future.done() or item.relates_to in self._superseded:
+                self._finish(item, None)
+                return
+
+            await self._bucket.acquire()
+            try:
+                response = await self.client.room_send(
+                    item.room_id,
+                    item.message_type,
+                    item.content,
+                    ignore_unverified_devices=True,
+                )
+            except _RETRY_EXCEPTIONS as e:
+                logger.debug(f"Sending {item.message_type} to {item.room_id} failed: {e!r}")
+                response = e
+            except Exception as e:
+                self._finish(item, e)
+                return
+
+            if not isinstance(response, (ErrorResponse, Exception)):
+                self._finish(item, response)
+                return
+
+            retry_after_ms = getattr(response, "retry_after_ms", None)
+            if retry_after_ms:
+                # Rate limited: nobody should send until the server allows it again
+                self._bucket.pause(retry_after_ms / 1000)
+                continue
+            if attempt < self.max_retries:
+                delay = self.base_retry_delay * 2 ** attempt
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+
+        logger.warning(f"Giving up on sending {item.message_type} to {item.room_id}: {response}")
+        self._finish(item, response)
+
+    def _finish(self, item: _Send, result: Any) -> None:
+        if item.key is not None and self._pending.get(item.key) is item:
+            del self._pending[item.key]
+        if item.future.done():
+            return
+        if isinstance(result, Exception):
+            item.future.set_exception(result)
+        else:
+            item.future.set_result(result)
@@ -0,0 +1,331 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from autorecorderbot.storage_local import RoomState, Storage
+
+logger = logging.getLogger(__name__)
+
+# A queued write: the storage method, its arguments and the future awaiting its result (if any)
+_Write = Tuple[Callable[..., Any], tuple, Optional[asyncio.Future]]
+
+
+class StoredMessage:
+    """A message stored through AsyncStorage, with its current type.
+
+    `message_id` is the id of the stored message. It is filled in by the writer thread,
+    so it is None until the message was committed. Writes that refer to the message are
+    queued after it and therefore always see the id.
+    """
+
+    __slots__ = ("roomid", "message_id", "type")
+
+    def __init__(self, roomid: str, sent_type: str) -> None:
+        self.roomid = roomid
+        self.message_id: Optional[int] = None
+        self.type = sent_type
+
+
+class Reply(NamedTuple):
+    """An event the bot sent, and the message it replied to (None for other events, and for
+    replies sent before they were stored)"""
+    roomid: str
+    message: Optional[StoredMessage]
+
+
+class AsyncStorage:
+    """Non-blocking facade over Storage for the asyncio callbacks.
+
+    Everything the callbacks read (room state, the type of the last message) is kept in
+    memory and answered without touching the database. Rooms are read again once they
+    were cached for the `room_cache_ttl` of the store, so changes by other bot instances
+    sharing the database are noticed. Handled events and sent events are looked up in the
+    database, behind a cache of the recent ones. Writes update
+    that memory right away and are then queued for a single writer thread, which commits
+    whatever has piled up in one transaction. Callbacks therefore never wait for the disk,
+    unless the bounded write queue is full.
+
+    Args:
+        store: The underlying synchronous storage.
+
+        max_queue_size: Maximum number of writes waiting for the writer thread. Writers
+            wait (without blocking the event loop) while the queue is full.
+
+        max_group_size: Maximum number of writes committed in one transaction.
+
+        reply_cache_size: Number of recently sent events kept in memory, see `get_reply`.
+            Older ones are read from the `replies` table.
+
+        worked_cache_size: Number of recently handled events kept in memory, see
+            `get_event_worked`. Older ones are read from the `events` table.
+    """
+
+    def __init__(self, store: Storage, max_queue_size: int = 1000, max_group_size: int = 64,
+                 reply_cache_size: int = 1024, worked_cache_size: int = 1024):
+        self.store = store
+        self.max_group_size = max(1, max_group_size)
+        self.reply_cache_size = max(1, reply_cache_size)
+        self.worked_cache_size = max(1, worked_cache_size)
+        self._queue: "queue.Queue[Optional[_Write]]" = queue.Queue(maxsize=max_queue_size)
+
+        # Room id -> its state (None if it is not stored) and when it was read
+        now = time.monotonic()
+        self._rooms: Dict[str, Tuple[Optional[RoomState], float]] = {
+            roomid: (room, now) for roomid, room in store.get_rooms().items()
+        }
+        self._last_message_types = store.get_last_message_types()
+        self._last_message_type = store.get_last_message_type()
+
+        # LRU cache in front of the `replies` table: event id -> the reply
+        self._replies: "OrderedDict[str, Reply]" = OrderedDict()
+        # LRU cache of handled events in front of the `events` table. Only handled events are
+        # kept, another bot instance sharing the database may handle the others at any time.
+        self._worked_events: "OrderedDict[str, None]" = OrderedDict()
+        # The last message stored through this facade, per room and overall
+        self._last_messages: Dict[str, StoredMessage] = {}
+        self._last_message: Optional[StoredMessage] = None
+
+        self._writer = threading.Thread(target=self._write_loop, name="storage-writer", daemon=True)
+        self._writer.start()
+
+    async def _enqueue(self, func: Callable[..., Any], *args, wait: bool = False) -> Any:
+        """Queue a write for the writer thread.
+
+        Args:
+            wait: Wait until the write was committed and return its result.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future() if wait else None
+        item = (func, args, future)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            logger.warning("Storage write queue is full, waiting for the writer")
+            await loop.run_in_executor(None, self._queue.put, item)
+        if future is not None:
+            return await future
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            group = [item]
+            stop = False
+            while len(group) < self.max_group_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                group.append(item)
+
+            self._commit(group)
+            if stop:
+                return
+
+    def _commit(self, group: List[_Write]) -> None:
+        """Apply a group of writes in one transaction"""
+        results = []
+        try:
+            with self.store.transaction():
+                results = [self._apply(func, args) for func, args, _ in group]
+        except Exception:
+            # The rollback undid the database writes of the group, but not the ones that never
+            # were part of the transaction (the message log). Every write is safe to repeat.
+            logger.exception(f"Could not commit {len(group)} writes at once, retrying them one by one")
+            results = [self._apply(func, args) for func, args, _ in group]
+
+        for (_, _, future), result in zip(group, results):
+            if future is not None:
+                future.get_loop().call_soon_threadsafe(self._resolve, future, result)
+        logger.debug(f"Committed {len(group)} writes")
+
+    @staticmethod
+    def _apply(func: Callable[..., Any], args: tuple) -> Any:
+        try:
+            return func(*args)
+        except Exception as e:
+            logger.exception(f"Storage write {func.__name__} failed")
+            return e
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result: Any) -> None:
+        if future.done():
+            return
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+    async def flush(self) -> None:
+        """Wait until every write queued so far is committed"""
+        await self._enqueue(lambda: None, wait=True)
+
+    async def close(self) -> None:
+        """Commit all queued writes, stop the writer thread and close the storage"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._queue.put, None)
+        await loop.run_in_executor(None, self._writer.join)
+        await loop.run_in_executor(None, self.store.close)
+
+    async def store_message(self, roomid: str, message: str, sender: str, timestamp: int, sent_type: str,
+                            tokens: List[str]) -> StoredMessage:
+        """Queue a message for storage.
+
+        Returns:
+            The record of the message, to refer to it in later writes.
+        """
+        record = StoredMessage(roomid, sent_type)
+        self._last_messages[roomid] = self._last_message = record
+        self._last_message_types[roomid] = sent_type
+        self._last_message_type = sent_type
+        await self._enqueue(self._store_message, record, message, sender, timestamp, tokens)
+        return record
+
+    def _store_message(self, record: StoredMessage, message: str, sender: str, timestamp: int, tokens: List[str]) -> None:
+        if record.message_id is not None and self.store.has_message(record.message_id):
+            # Kept from a group that failed to commit, e.g. appended to the message log
+            return
+        record.message_id = self.store.store_message(record.roomid, message, sender, timestamp, record.type, tokens)
+
+    async def change_message_type(self, record: StoredMessage, sent_type: str) -> None:
+        """Correct the type of exactly this message"""
+        record.type = sent_type
+        if self._last_messages.get(record.roomid) is record:
+            self._last_message_types[record.roomid] = sent_type
+        if self._last_message is record:
+            self._last_message_type = sent_type
+        await self._enqueue(self._change_message_type, record, sent_type)
+
+    def _change_message_type(self, record: StoredMessage, sent_type: str) -> None:
+        if record.message_id is None:
+            logger.warning(f"Cannot change the type of a message of {record.roomid} that was not stored")
+            return
+        self.store.change_message_type(record.message_id, sent_type)
+
+    async def register_reply(self, roomid: str, event_id: str, record: Optional[StoredMessage] = None) -> None:
+        """Remember an event the bot sent, and the message it replies to, see `get_reply`"""
+        self._cache_reply(event_id, Reply(roomid, record))
+        await self._enqueue(self._store_reply, roomid, event_id, record)
+
+    def _store_reply(self, roomid: str, event_id: str, record: Optional[StoredMessage]) -> None:
+        self.store.store_reply(event_id, roomid, record.message_id if record is not None else None)
+
+    def _cache_reply(self, event_id: str, reply: Reply) -> None:
+        self._replies[event_id] = reply
+        self._replies.move_to_end(event_id)
+        if len(self._replies) > self.reply_cache_size:
+            self._replies.popitem(last=False)
+
+    async def get_reply(self, roomid: str, event_id: str) -> Optional[Reply]:
+        """The event the bot sent in the room with this id, None if the bot did not send it.
+
+        Recent events are answered from memory, others from the `replies` table.
+        """
+        reply = self._replies.get(event_id)
+        if reply is not None:
+            self._replies.move_to_end(event_id)
+        else:
+            stored = await self.store.run_async(self.store.get_reply, event_id)
+            if stored is None:
+                return None
+            record = None
+            if stored.message_id is not None:
+                record = StoredMessage(stored.roomid, stored.type)
+                record.message_id = stored.message_id
+            reply = Reply(stored.roomid, record)
+            self._cache_reply(event_id, reply)
+        return reply if reply.roomid == roomid else None
+
+    async def change_last_message_type(self, sent_type: str, room_id: str) -> None:
+        self._last_message_types[room_id] = sent_type
+        self._last_message_type = sent_type
+        if room_id in self._last_messages:
+            self._last_messages[room_id].type = sent_type
+        await self._enqueue(self.store.change_last_message_type, sent_type, room_id)
+
+    def get_last_message_type(self, roomid: Optional[str] = None) -> Optional[str]:
+        """The type of the last message of a room, or of all rooms"""
+        if roomid is not None:
+            return self._last_message_types.get(roomid)
+        return self._last_message_type
+
+    async def _get_room(self, roomid: str) -> Optional[RoomState]:
+        """The state of a room, from memory unless it is not cached or the cache expired.
+
+        The room is read by the writer thread, after the writes queued before. Rooms
+        changed by this instance are therefore never read back in an older state.
+        """
+        room, read_at = self._rooms.get(roomid, (None, None))
+        if read_at is not None and time.monotonic() - read_at < self.store.room_cache_ttl:
+            return room
+        room = await self._enqueue(self.store.load_room, roomid, wait=True)
+        self._rooms[roomid] = (room, time.monotonic())
+        return room
+
+    async def store_new_room(self, roomid: str, timestamp: int) -> bool:
+        """Stores a new room. Waits for the database, as only it knows about rooms
+        that were stored by another bot instance.
+
+        Returns:
+            bool: True, if the room did not exist before and was succesfully added, else false
+        """
+        if await self._get_room(roomid) is not None:
+            return False
+        stored, room = await self._enqueue(self._store_new_room, roomid, timestamp, wait=True)
+        self._rooms[roomid] = (room, time.monotonic())
+        return stored is True
+
+    def _store_new_room(self, roomid: str, timestamp: int) -> Tuple[bool, Optional[RoomState]]:
+        return self.store.store_new_room(roomid, timestamp), self.store.get_room(roomid)
+
+    async def store_new_event(self, eventid: str, worked: bool) -> None:
+        if worked:
+            self._cache_worked(eventid)
+        await self._enqueue(self.store.store_new_event, eventid, worked)
+
+    def _cache_worked(self, eventid: str) -> None:
+        self._worked_events[eventid] = None
+        self._worked_events.move_to_end(eventid)
+        if len(self._worked_events) > self.worked_cache_size:
+            self._worked_events.popitem(last=False)
+
+    async def set_room_recording(self, roomid: str) -> None:
+        room, read_at = self._rooms.get(roomid, (None, None))
+        if room is not None:
+            self._rooms[roomid] = (room._replace(recording=True), read_at)
+        await self._enqueue(self.store.set_room_recording, roomid)
+
+    async def get_room_recording(self, roomid: str) -> bool:
+        room = await self._get_room(roomid)
+        return room is not None and room.recording
+
+    async def get_room_timestamp(self, roomid: str) -> int:
+        room = await self._get_room(roomid)
+        return room.timestamp if room is not None else 0
+
+    async def get_event_worked(self, eventid: str) -> bool:
+        """Whether a reaction to the event was already handled.
+
+        Recently handled events are answered from memory, others from the `events` table.
+        """
+        if eventid in self._worked_events:
+            self._worked_events.move_to_end(eventid)
+            return True
+        if not await self.store.run_async(self.store.get_event_worked, eventid):
+            return False
+        self._cache_worked(eventid)
+        return True
+
+    async def delete_room(self, roomid: str) -> None:
+        self._rooms[roomid] = (None, time.monotonic())
+        self._replies = OrderedDict((k, v) for k, v in self._replies.items() if v.roomid != roomid)
+        self._last_messages.pop(roomid, None)
+        await self._enqueue(self.store.delete_room, roomid)
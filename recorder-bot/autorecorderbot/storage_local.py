@@ -1,9 +1,15 @@
-import re
+import asyncio
+import functools
+import json
+import os
 import logging
-from sqlite3.dbapi2 import Error
-from typing import Any, Dict, List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
 
-from tinydb import TinyDB, Query
+from autorecorderbot.message_log import MessageLog
 
 # The latest migration version of the database.
 #
@@ -12,11 +18,29 @@ from tinydb import TinyDB, Query
 # the version specified here.
 #
 # When a migration is performed, the `migration_version` table should be incremented.
-latest_migration_version = 0
+latest_migration_version = 2
 
 logger = logging.getLogger(__name__)
 
 
+class RoomState(NamedTuple):
+    """A row of the `rooms` table"""
+    joined: bool
+    recording: bool
+    timestamp: int
+
+
+class StoredReply(NamedTuple):
+    """An event the bot sent, from the `replies` table.
+
+    Replies to a classified message carry the id and the current type of that message,
+    other events (e.g. the greeting in a new room) have None for both.
+    """
+    roomid: str
+    message_id: Optional[int]
+    type: Optional[str]
+
+
 class Storage:
     def __init__(self, database_config: Dict[str, str]):
         """Setup the database.
@@ -29,47 +53,171 @@ class Storage:
                 * type: A string, one of "sqlite" or "postgres".
                 * connection_string: A string, featuring a connection string that
                     be fed to each respective db library's `connect` method.
+                * message_path: Optional path of the TinyDB message file that older
+                    versions of the bot wrote. It is imported into the `messages`
+                    table once, when migrating the database to v1.
+                * pool_size: Optional maximum number of postgres connections, which is
+                    also the number of threads serving `run_async`. Defaults to 4.
+                    SQLite always uses a single connection.
+                * room_cache_ttl: Optional seconds a cached room is used before it is
+                    read from the database again. Defaults to 60.
+                * message_log: Optional path of an append-only `MessageLog`. If set,
+                    messages are stored there instead of in the `messages` table.
+                * message_log_compact_interval: Optional seconds between compaction
+                    checks of the message log. Defaults to 3600.
         """
-        self.conn = self._get_database_connection(
-            database_config["type"], database_config["connection_string"]
-        )
-        self.cursor = self.conn.cursor()
         self.db_type = database_config["type"]
-
-        self.messages = TinyDB(database_config["message_path"])
+        self.pool_size = int(database_config.get("pool_size") or 4)
+        room_cache_ttl = database_config.get("room_cache_ttl")
+        self.room_cache_ttl = float(60 if room_cache_ttl is None else room_cache_ttl)
+        # The DB-API module of the backend, for backend-neutral exception handling
+        self.db = self._get_database_module(self.db_type)
+        # Holds the connection of a thread while it is inside `transaction`
+        self._local = threading.local()
+        self._connect(database_config["connection_string"])
+
+        self.message_path = database_config.get("message_path")
+
+        # Messages go to the append-only log instead of the database, if one is configured
+        self.message_log = None
+        if database_config.get("message_log"):
+            self.message_log = MessageLog(
+                database_config["message_log"],
+                compact_interval=float(database_config.get("message_log_compact_interval") or 3600),
+            )
 
         # Try to check the current migration version
         migration_level = 0
         try:
-            self._execute("SELECT version FROM migration_version")
-            row = self.cursor.fetchone()
-            migration_level = row[0]
+            migration_level = self._execute("SELECT version FROM migration_version")[0][0]
         except Exception:
             self._initial_setup()
         finally:
             if migration_level < latest_migration_version:
                 self._run_migrations(migration_level)
 
+        # Cache of the `rooms` table: room id -> its state (None if it is not stored) and when
+        # it was read. Other bot instances sharing the database change rooms as well, so
+        # rooms missing from the cache or read more than `room_cache_ttl` ago are read again.
+        self._rooms: Dict[str, Tuple[Optional[RoomState], float]] = {}
+        self._load_rooms()
+
+        # Threads that run storage calls for the asyncio event loop, see `run_async`
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.pool_size if self.db_type == "postgres" else 1,
+            thread_name_prefix="storage",
+        )
+
         logger.info(f"Database initialization of type '{self.db_type}' complete")
 
-    def _get_database_connection(
-        self, database_type: str, connection_string: str
-    ) -> Any:
-        """Creates and returns a connection to the database"""
+    @staticmethod
+    def _get_database_module(database_type: str) -> Any:
+        """Imports and returns the DB-API module of the database backend"""
         if database_type == "sqlite":
             import sqlite3
 
-            # Initialize a connection to the database, with autocommit on
-            return sqlite3.connect(connection_string, isolation_level=None)
+            return sqlite3
         elif database_type == "postgres":
             import psycopg2
 
-            conn = psycopg2.connect(connection_string)
+            return psycopg2
+        raise ValueError(f"Unknown database type '{database_type}'")
+
+    def _connect(self, connection_string: str) -> None:
+        """Open the sqlite connection or the postgres connection pool"""
+        self.conn = None
+        self._pool = None
+        if self.db_type == "sqlite":
+            # Initialize a connection to the database, with autocommit on. It is shared
+            # between threads, `_lock` serializes its use.
+            self.conn = self.db.connect(connection_string, isolation_level=None, check_same_thread=False)
+            self._lock = threading.RLock()
+        else:
+            from psycopg2.pool import ThreadedConnectionPool
+
+            self._pool = ThreadedConnectionPool(1, self.pool_size, connection_string)
+            # Limits checkouts to the pool size, ThreadedConnectionPool raises instead of waiting
+            self._pool_slots = threading.BoundedSemaphore(self.pool_size)
+
+    @contextmanager
+    def _connection(self) -> Iterator[Any]:
+        """Borrow a database connection for the duration of the block"""
+        pinned = getattr(self._local, "conn", None)
+        if pinned is not None:
+            yield pinned
+            return
+
+        if self._pool is None:
+            with self._lock:
+                yield self.conn
+            return
+
+        with self._pool_slots:
+            conn = self._pool.getconn()
+            try:
+                # Autocommit on
+                conn.autocommit = True
+                yield conn
+            finally:
+                self._pool.putconn(conn)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Run every statement of the current thread inside the block in one transaction.
+
+        Used to commit a group of writes at once. A statement that fails inside the
+        transaction is rolled back on its own and does not abort the others.
+        """
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            self._local.conn = conn
+            try:
+                cursor.execute("BEGIN")
+                yield
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            finally:
+                self._local.conn = None
+                cursor.close()
+
+    def _run_statement(self, cursor: Any, query: str, params: tuple = ()) -> None:
+        """Execute a single statement on the cursor.
+
+        Postgres aborts the whole transaction on any error, so inside `transaction` every
+        statement gets its own savepoint. SQLite only rolls back the failing statement.
+        """
+        if self.db_type != "postgres" or getattr(self._local, "conn", None) is None:
+            cursor.execute(query, params)
+            return
+
+        cursor.execute("SAVEPOINT statement")
+        try:
+            cursor.execute(query, params)
+        except self.db.DatabaseError:
+            cursor.execute("ROLLBACK TO SAVEPOINT statement")
+            raise
+        cursor.execute("RELEASE SAVEPOINT statement")
+
+    def close(self) -> None:
+        """Close all database connections"""
+        self._executor.shutdown(wait=True)
+        if self.message_log is not None:
+            self.message_log.close()
+        if self._pool is not None:
+            self._pool.closeall()
+        else:
+            self.conn.close()
 
-            # Autocommit on
-            conn.set_isolation_level(0)
+    async def run_async(self, func: Callable[..., Any], *args) -> Any:
+        """Run a (blocking) storage method on the storage threads instead of the event loop.
 
-            return conn
+        Example:
+            `await store.run_async(store.store_message, roomid, ...)`
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
 
     def _initial_setup(self) -> None:
         """Initial setup of the database"""
@@ -130,78 +278,269 @@ class Storage:
         """
         logger.debug("Checking for necessary database migrations...")
 
-        # if current_migration_version < 1:
-        #    logger.info("Migrating the database from v0 to v1...")
-        #
-        #    # Add new table, delete old ones, etc.
-        #
-        #    # Update the stored migration version
-        #    self._execute("UPDATE migration_version SET version = 1")
-        #
-        #    logger.info("Database migrated to v1")
-
-    def _execute(self, *args) -> None:
+        if current_migration_version < 1:
+            logger.info("Migrating the database from v0 to v1...")
+
+            # Either the table is created and all messages imported, or nothing changes and the
+            # migration starts over on the next start
+            with self.transaction():
+                # Messages moved from the TinyDB JSON file into the database
+                id_column = "SERIAL PRIMARY KEY" if self.db_type == "postgres" else "INTEGER PRIMARY KEY"
+                self._execute(
+                    f"""
+                    CREATE TABLE messages (
+                        id {id_column},
+                        roomid TEXT NOT NULL,
+                        message TEXT,
+                        sender TEXT,
+                        timestamp BIGINT,
+                        type TEXT,
+                        tokens TEXT
+                    )
+                """
+                )
+
+                # The last message of a room is found by walking this index backwards
+                self._execute("CREATE INDEX messages_roomid_id ON messages (roomid, id)")
+
+                self._import_tinydb_messages()
+
+                # Update the stored migration version
+                self._execute("UPDATE migration_version SET version = 1")
+
+            logger.info("Database migrated to v1")
+
+        if current_migration_version < 2:
+            logger.info("Migrating the database from v1 to v2...")
+
+            # The events the bot sent, so reactions to them are recognized and refer to
+            # their message without asking the homeserver
+            self._execute(
+                """
+                CREATE TABLE replies (
+                    eventid TEXT PRIMARY KEY,
+                    roomid TEXT NOT NULL,
+                    message_id BIGINT
+                )
+            """
+            )
+            self._execute("CREATE INDEX replies_roomid ON replies (roomid)")
+
+            # Update the stored migration version
+            self._execute("UPDATE migration_version SET version = 2")
+
+            logger.info("Database migrated to v2")
+
+    def _import_tinydb_messages(self) -> None:
+        """Copy the messages of the TinyDB file at `message_path` into the `messages` table.
+
+        The file is left untouched, but is not written to anymore.
+        """
+        if not self.message_path or not os.path.isfile(self.message_path):
+            return
+
+        with open(self.message_path) as message_file:
+            tables = json.load(message_file)
+        # TinyDB stores documents by their (stringified, increasing) doc id
+        documents = tables.get("_default", {})
+        doc_ids = sorted(documents, key=int)
+
+        logger.info(f"Importing {len(doc_ids)} messages from {self.message_path}...")
+        rows = (
+            (doc["roomid"], doc["message"], doc["sender"], doc["timestamp"], doc["type"], doc["tokens"])
+            for doc in (documents[doc_id] for doc_id in doc_ids)
+        )
+        if self.message_log is not None:
+            # The log is not part of the transaction, a log that has messages already holds the import
+            if self.message_log.last_message_id() is None:
+                for row in rows:
+                    self.message_log.store_message(*row)
+        else:
+            self._executemany(
+                """
+                INSERT INTO messages (roomid, message, sender, timestamp, type, tokens)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """,
+                ((*row[:5], json.dumps(row[5], ensure_ascii=False)) for row in rows),
+            )
+        logger.info(f"{self.message_path} was imported into the database and is no longer used")
+
+    def _execute(self, *args) -> List[tuple]:
         """A wrapper around cursor.execute that transforms placeholder ?'s to %s for postgres.
 
         This allows for the support of queries that are compatible with both postgres and sqlite.
 
         Args:
             args: Arguments passed to cursor.execute.
+
+        Returns:
+            The rows returned by the query, an empty list for statements without results.
         """
         if self.db_type == "postgres":
-            self.cursor.execute(args[0].replace("?", "%s"), *args[1:])
-        else:
-            self.cursor.execute(*args)
+            args = (args[0].replace("?", "%s"),) + args[1:]
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                self._run_statement(cursor, *args)
+                return cursor.fetchall() if cursor.description is not None else []
+            finally:
+                cursor.close()
+
+    def _executemany(self, query: str, rows: Iterable[tuple]) -> None:
+        """Run a statement once for every row of parameters, see `_execute`"""
+        if self.db_type == "postgres":
+            query = query.replace("?", "%s")
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.executemany(query, rows)
+            finally:
+                cursor.close()
+
+    def _insert(self, query: str, params: tuple) -> int:
+        """Run an INSERT into a table with an `id` primary key and return the new id"""
+        if self.db_type == "postgres":
+            return self._execute(query + " RETURNING id", params)[0][0]
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                self._run_statement(cursor, query, params)
+                return cursor.lastrowid
+            finally:
+                cursor.close()
 
     def _get_room_info(self, roomid: str) -> List:
-        if self.db_type == "sqlite":
-            import sqlite3
-        else:
-            raise NotImplementedError
         try:
-            return self.cursor.execute(
+            return self._execute(
                 """
                 SELECT roomid, joined, recording, timestamp
                     FROM rooms
-                    WHERE roomid='{}'
-            """.format(roomid)
-            ).fetchall()
-
-            return recording == 1
-        except sqlite3.DatabaseError as dbe:
+                    WHERE roomid=?
+            """,
+                (roomid,),
+            )
+        except self.db.DatabaseError as dbe:
             logger.warning(f"Could not get info about room {roomid}")
+            logger.debug(f"{dbe}")
 
-    def store_message(self, roomid: str, message: str, sender: str, timestamp: int, sent_type: str, tokens: List[str]):
-        self.messages.insert({
-            "roomid": roomid,
-            "message": message,
-            "sender": sender,
-            "timestamp": timestamp,
-            "type": sent_type,
-            "tokens": tokens,
-        })
+    def _load_rooms(self) -> None:
+        """Fill the room cache from the `rooms` table"""
+        rows = self._execute("SELECT roomid, joined, recording, timestamp FROM rooms")
+        now = time.monotonic()
+        self._rooms = {
+            roomid: (RoomState(joined == 1, recording == 1, int(timestamp or 0)), now)
+            for roomid, joined, recording, timestamp in rows
+        }
+        logger.debug(f"Loaded {len(self._rooms)} rooms into the room cache")
+
+    def _insert_message(self, roomid: str, message: str, sender: str, timestamp: int, sent_type: str, tokens: List[str]) -> int:
+        if self.message_log is not None:
+            return self.message_log.store_message(roomid, message, sender, timestamp, sent_type, tokens)
+        return self._insert(
+            """
+            INSERT INTO messages (roomid, message, sender, timestamp, type, tokens)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """,
+            (roomid, message, sender, timestamp, sent_type, json.dumps(tokens, ensure_ascii=False)),
+        )
+
+    def store_message(self, roomid: str, message: str, sender: str, timestamp: int, sent_type: str, tokens: List[str]) -> int:
+        """Stores a message together with its predicted labels.
+
+        Returns:
+            int: The id of the stored message
+        """
+        return self._insert_message(roomid, message, sender, timestamp, sent_type, tokens)
 
     def change_last_message_type(self, sent_type: str, room_id: str):
-        Room = Query()
         logger.debug(f"Room ID: {room_id}")
-        room_msgs = self.messages.search(Room.roomid == room_id)
-        logger.debug(f"{room_msgs}")
-        latest_msg = sorted(room_msgs, key=lambda e: e.doc_id)[len(room_msgs) - 1]
-        latest_msg['type'] = sent_type
-        Room = Query()
-        self.messages.update({"type": sent_type}, (Room.timestamp == latest_msg["timestamp"]) & (Room.sender == latest_msg["sender"]))
+        if self.message_log is not None:
+            last_id = self.message_log.last_message_id(room_id)
+            if last_id is not None:
+                self.message_log.update_type(last_id, sent_type)
+            return
+        self._execute(
+            """
+            UPDATE messages
+                SET type=?
+                WHERE id=(SELECT MAX(id) FROM messages WHERE roomid=?)
+        """,
+            (sent_type, room_id),
+        )
+
+    def change_message_type(self, message_id: int, sent_type: str) -> None:
+        """Correct the type of the message with the given id"""
+        if self.message_log is not None:
+            self.message_log.update_type(message_id, sent_type)
+            return
+        self._execute("UPDATE messages SET type=? WHERE id=?", (sent_type, message_id))
+
+    def _get_message_type(self, message_id: int) -> Optional[str]:
+        if self.message_log is not None:
+            return self.message_log.get_type(message_id)
+        rows = self._execute("SELECT type FROM messages WHERE id=?", (message_id,))
+        return rows[0][0] if rows else None
+
+    def has_message(self, message_id: int) -> bool:
+        """Whether a message with this id is stored"""
+        return self._get_message_type(message_id) is not None
+
+    def store_reply(self, eventid: str, roomid: str, message_id: Optional[int] = None) -> None:
+        """Stores an event the bot sent, with the id of the message it replies to"""
+        try:
+            self._execute(
+                """
+                INSERT INTO replies (eventid, roomid, message_id)
+                VALUES (?, ?, ?)
+            """,
+                (eventid, roomid, message_id),
+            )
+        except self.db.IntegrityError:
+            logger.debug(f"Reply {eventid} already stored, ignoring")
+
+    def get_reply(self, eventid: str) -> Optional[StoredReply]:
+        """The event the bot sent with this id, None if the bot did not send it"""
+        rows = self._execute("SELECT roomid, message_id FROM replies WHERE eventid=?", (eventid,))
+        if not rows:
+            return None
+        roomid, message_id = rows[0]
+        sent_type = self._get_message_type(message_id) if message_id is not None else None
+        return StoredReply(roomid, message_id, sent_type)
 
     def get_last_message_type(self):
-        return self.messages.get(doc_id=len(self.messages))["type"]
+        if self.message_log is not None:
+            last_id = self.message_log.last_message_id()
+            return self.message_log.get_type(last_id) if last_id is not None else None
+        rows = self._execute("SELECT type FROM messages ORDER BY id DESC LIMIT 1")
+        return rows[0][0] if rows else None
+
+    def get_last_message_types(self) -> Dict[str, str]:
+        """The type of the last message of every room"""
+        if self.message_log is not None:
+            return self.message_log.get_last_message_types()
+        rows = self._execute(
+            """
+            SELECT roomid, type
+                FROM messages
+                WHERE id IN (SELECT MAX(id) FROM messages GROUP BY roomid)
+        """
+        )
+        return dict(rows)
 
     def get_last_message_with_type(self, room_id: str, searched_type: str):
-        Room = Query()
-        room_msgs = self.messages.search(Room.roomid == room_id)
-        all_messages = sorted(room_msgs, key=lambda e: e.doc_id, reverse = True)
-        for msg in all_messages:
-            if msg["type"] == searched_type:
-                return msg["message"]
-        return ""
+        if self.message_log is not None:
+            return self.message_log.get_last_message_with_type(room_id, searched_type)
+        rows = self._execute(
+            """
+            SELECT message
+                FROM messages
+                WHERE roomid=? AND type=?
+                ORDER BY id DESC
+                LIMIT 1
+        """,
+            (room_id, searched_type),
+        )
+        return rows[0][0] if rows else ""
 
     def store_new_room(self, roomid: str, timestamp: int) -> bool:
         """Stores a new room in the database.
@@ -210,115 +549,141 @@ class Storage:
             roomid (str): The room id
             timestamp (int): The timestamp the bot joined this room
 
-        Raises:
-            NotImplementedError: Raised if anything else than sqlite3 is chosen as a database
-
         Returns:
             bool: True, if the room did not exist before and was succesfully added, else false
         """
-        if self.db_type == "sqlite":
-            import sqlite3
-        else:
-            raise NotImplementedError
         try:
             self._execute(
                 """
                 INSERT INTO rooms (roomid, joined, recording, timestamp)
-                VALUES ('{}', 1, 0, {})
-            """.format(roomid, timestamp)
+                VALUES (?, 1, 0, ?)
+            """,
+                (roomid, timestamp),
             )
+            self._cache_room(roomid, RoomState(True, False, timestamp))
             logger.info("Stored new room in DB")
             return True
-        except sqlite3.IntegrityError:
+        except self.db.IntegrityError:
             logger.debug("Room already stored, ignoring")
+            # Possibly stored by someone else, e.g. another bot instance sharing the database
+            self.load_room(roomid)
             return False
-        except sqlite3.DatabaseError as e:
-            import pdb; pdb.set_trace()
+        except self.db.DatabaseError as e:
             logger.warning(f"Could not store room {roomid}")
+            logger.debug(f"{e}")
             return False
 
     def store_new_event(self, eventid: str, worked: bool) -> None:
-        if self.db_type == "sqlite":
-            import sqlite3
-        else:
-            raise NotImplementedError
         try:
             self._execute(
                 """
                 INSERT INTO events (eventid, worked)
-                VALUES ('{}', {})
-            """.format(eventid, int(worked))
+                VALUES (?, ?)
+            """,
+                (eventid, int(worked)),
             )
-        except sqlite3.DatabaseError as e:
+        except self.db.DatabaseError as e:
             logger.warning(f"Could not  store new event {eventid}")
             logger.debug(f"{e}")
 
     def set_room_recording(self, roomid: str) -> None:
-        if self.db_type == "sqlite":
-            import sqlite3
-        else:
-            raise NotImplementedError
         try:
             self._execute(
                 """
                 UPDATE rooms
                     SET recording=1
-                    WHERE roomid='{}'
-            """.format(roomid)
+                    WHERE roomid=?
+            """,
+                (roomid,),
             )
-        except sqlite3.DatabaseError as e:
+            room = self._rooms.get(roomid, (None, 0.0))[0]
+            if room is not None:
+                self._cache_room(roomid, room._replace(recording=True))
+        except self.db.DatabaseError as e:
             logger.warning(f"Could not set the room {roomid} to recording")
             logger.debug(f"{e}")
 
     def get_room_recording(self, roomid: str) -> bool:
-        try:
-            return int(self._get_room_info(roomid)[0][2]) == 1
-        except (IndexError, TypeError):
+        """Whether messages in the room are recorded. Served from the room cache."""
+        room = self.get_room(roomid)
+        if room is None:
             logger.warning(f"Room {roomid} does not exist in DB")
-            return 0
+            return False
+        return room.recording
 
     def get_room_timestamp(self, roomid: str) -> int:
-        try:
-            return int(self._get_room_info(roomid)[0][3])
-        except (IndexError, TypeError):
+        """The timestamp the bot joined the room. Served from the room cache."""
+        room = self.get_room(roomid)
+        if room is None:
             logger.warning(f"Room {roomid} does not exist in DB")
             return 0
+        return room.timestamp
+
+    def get_room(self, roomid: str) -> Optional[RoomState]:
+        """The state of a room, None if it is not stored. Served from the room cache, unless
+        the room is not cached or was read more than `room_cache_ttl` seconds ago."""
+        room, read_at = self._rooms.get(roomid, (None, None))
+        if read_at is None or time.monotonic() - read_at >= self.room_cache_ttl:
+            return self.load_room(roomid)
+        return room
+
+    def load_room(self, roomid: str) -> Optional[RoomState]:
+        """Read the state of a room from the database into the room cache.
+
+        Returns:
+            The state, None if the room is not stored. If the database cannot be read,
+            the cached state.
+        """
+        rows = self._get_room_info(roomid)
+        if rows is None:
+            return self._rooms.get(roomid, (None, 0.0))[0]
+        room = None
+        for _, joined, recording, timestamp in rows:
+            room = RoomState(joined == 1, recording == 1, int(timestamp or 0))
+        self._cache_room(roomid, room)
+        return room
+
+    def _cache_room(self, roomid: str, room: Optional[RoomState]) -> None:
+        self._rooms[roomid] = (room, time.monotonic())
+
+    def get_rooms(self) -> Dict[str, RoomState]:
+        """The cached state of all rooms"""
+        return {roomid: room for roomid, (room, _) in self._rooms.items() if room is not None}
+
+    def get_worked_events(self) -> Set[str]:
+        """The ids of all events that were already acted upon"""
+        return {eventid for (eventid,) in self._execute("SELECT eventid FROM events WHERE worked=1")}
 
     def get_event_worked(self, eventid: str) -> bool:
-        if self.db_type == "sqlite":
-            import sqlite3
-        else:
-            raise NotImplementedError
         try:
-            results = self.cursor.execute(
+            results = self._execute(
                 """
                 SELECT eventid, worked
                     FROM events
-                    WHERE eventid='{}'
-            """.format(eventid)
-            ).fetchall()
+                    WHERE eventid=?
+            """,
+                (eventid,),
+            )
 
             if len(results) == 0:
                 return False
             if results[0][1] == 0:
                 return False
             return True
-        except sqlite3.DatabaseError as dbe:
+        except self.db.DatabaseError as dbe:
             logger.warning(f"Could not get info about event {eventid}")
             logger.debug(f"{dbe}")
 
     def delete_room(self, roomid: str) -> None:
-        if self.db_type == "sqlite":
-            import sqlite3
-        else:
-            raise NotImplementedError
-
         try:
             self._execute(
                 """
                 DELETE FROM rooms
-                    WHERE roomid='{}'
-            """.format(roomid)
+                    WHERE roomid=?
+            """,
+                (roomid,),
             )
-        except sqlite3.DatabaseError:
+            self._execute("DELETE FROM replies WHERE roomid=?", (roomid,))
+            self._cache_room(roomid, None)
+        except self.db.DatabaseError:
             logger.warning(f"Could not delete the room {roomid}")
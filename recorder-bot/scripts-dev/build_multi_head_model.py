@@ -0,0 +1,37 @@
+"""
+This script combines the sentence and token classification models into one checkpoint
+that runs a single shared encoder for both tasks (intelligence.multi_head_model_path).
+Please use it like this:
+python build_multi_head_model.py [SEQUENCE_MODEL] [TOKEN_MODEL] [OUTFOLDER] [--encoder sequence|token]
+                                 [--samples FILE] [--min-agreement SHARE]
+
+Only one of the two fine-tuned encoders is kept, so the combined model is compared with
+the separate models on sample messages (one per line of FILE) first. Nothing is written
+unless they agree, which needs models fine-tuned jointly on a shared encoder.
+"""
+
+import argparse
+import logging
+
+from autorecorderbot.intelligence import build_multi_head_model
+
+logging.basicConfig(level=logging.INFO)
+
+parser = argparse.ArgumentParser(description="Build a shared-encoder checkpoint from the two bot models.")
+parser.add_argument("sequence_model", help="Directory of the sentence classification model")
+parser.add_argument("token_model", help="Directory of the token classification model")
+parser.add_argument("outfolder", help="Directory to write the combined model to")
+parser.add_argument("--encoder", choices=["sequence", "token"], default="sequence",
+                    help="Which of the two fine-tuned encoders to keep")
+parser.add_argument("--samples", default=None, help="File of messages to compare the models on, one per line")
+parser.add_argument("--min-agreement", type=float, default=1.0,
+                    help="Share of the sample messages the combined model has to predict like the separate models")
+args = parser.parse_args()
+
+samples = None
+if args.samples:
+    with open(args.samples, encoding="utf-8") as f:
+        samples = [line.strip() for line in f if line.strip()]
+
+build_multi_head_model(args.sequence_model, args.token_model, args.outfolder, encoder_source=args.encoder,
+                       sample_sentences=samples, min_agreement=args.min_agreement)
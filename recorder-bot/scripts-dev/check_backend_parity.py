@@ -0,0 +1,75 @@
+"""
+This script checks that the quantized and ONNX Runtime backends predict the same labels
+as the fp32 pytorch model on the test split of the TexPrax dataset.
+Please use it like this:
+python check_backend_parity.py [MODEL_DIR] [--backends torch-int8 onnxruntime] [--min-agreement 0.99]
+
+It exits with status 1 if any backend agrees with the fp32 model on fewer labels than required.
+Requires the `datasets` package.
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+from datasets import load_dataset
+
+from autorecorderbot.intelligence import Prediction, load_predictor
+
+logging.basicConfig(level=logging.INFO)
+
+
+def labels_of(result):
+    """Flatten the output of any predictor into its sentence and token labels"""
+    if isinstance(result, Prediction):
+        return [result.sentence_label], result.token_labels
+    if isinstance(result, tuple):
+        return [], result[1]
+    return [result], []
+
+
+def predict_all(predictor, sentences, batch_size):
+    results = []
+    start = time.perf_counter()
+    for i in range(0, len(sentences), batch_size):
+        results.extend(predictor.predict_batch(sentences[i:i + batch_size]))
+    return results, time.perf_counter() - start
+
+
+parser = argparse.ArgumentParser(description="Compare backend predictions against the fp32 model.")
+parser.add_argument("model_dir", help="Bot model directory (sequence, token or multi-head model)")
+parser.add_argument("--backends", nargs="+", default=["torch-int8", "onnxruntime"],
+                    choices=["torch-int8", "onnxruntime"], help="Backends to compare")
+parser.add_argument("--batch-size", type=int, default=32)
+parser.add_argument("--min-agreement", type=float, default=0.99,
+                    help="Minimal share of labels that must match the fp32 model")
+args = parser.parse_args()
+
+sentences = load_dataset("UKPLab/TexPrax", "sentence_cl", split="test")["sentence"]
+reference, reference_time = predict_all(load_predictor(args.model_dir, backend="torch"), sentences, args.batch_size)
+print(f"torch: {len(sentences)} sentences in {reference_time:.2f}s")
+
+failed = False
+for backend in args.backends:
+    results, elapsed = predict_all(load_predictor(args.model_dir, backend=backend), sentences, args.batch_size)
+
+    same_sentences = total_sentences = same_tokens = total_tokens = 0
+    for expected, actual in zip(reference, results):
+        expected_sentence, expected_tokens = labels_of(expected)
+        actual_sentence, actual_tokens = labels_of(actual)
+        same_sentences += sum(e == a for e, a in zip(expected_sentence, actual_sentence))
+        total_sentences += len(expected_sentence)
+        same_tokens += sum(e == a for e, a in zip(expected_tokens, actual_tokens))
+        total_tokens += len(expected_tokens)
+
+    print(f"{backend}: {len(sentences)} sentences in {elapsed:.2f}s ({reference_time / elapsed:.2f}x)")
+    for name, same, total in (("sentence", same_sentences, total_sentences), ("token", same_tokens, total_tokens)):
+        if total == 0:
+            continue
+        agreement = same / total
+        print(f"  {name} label agreement: {agreement:.4f} ({same}/{total})")
+        if agreement < args.min_agreement:
+            failed = True
+
+sys.exit(1 if failed else 0)
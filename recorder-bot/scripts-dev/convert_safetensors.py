@@ -0,0 +1,38 @@
+"""
+This script converts the pytorch_model.bin weights of bot models to model.safetensors.
+The bot memory-maps safetensors files, so all bot processes and inference workers on a
+host share one copy of the weights. The pytorch_model.bin files are kept.
+Please use it like this: python convert_safetensors.py [MODEL_DIR] [MODEL_DIR ...]
+"""
+
+import logging
+import sys
+from pathlib import Path
+
+import torch
+
+from autorecorderbot.intelligence import PYTORCH_FILE, SAFETENSORS_FILE, mmap_safetensors, save_safetensors
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if len(sys.argv) < 2:
+    print("""Error: Please use this script like this:\n
+             python convert_safetensors.py [MODEL_DIR] [MODEL_DIR ...]
+          """)
+    sys.exit(1)
+
+for model_dir in sys.argv[1:]:
+    model_dir = Path(model_dir)
+    state_dict = torch.load(Path.joinpath(model_dir, PYTORCH_FILE), map_location='cpu')
+    output_path = Path.joinpath(model_dir, SAFETENSORS_FILE)
+    save_safetensors(state_dict, output_path)
+
+    # Make sure the bot reads back exactly what was written
+    converted = mmap_safetensors(output_path)
+    for name, tensor in state_dict.items():
+        if not torch.equal(tensor, converted[name]):
+            output_path.unlink()
+            logger.error(f"{name} differs after the conversion, removed {output_path}")
+            sys.exit(1)
+    logger.info(f"Wrote {len(converted)} tensors to {output_path}")
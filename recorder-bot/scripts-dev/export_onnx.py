@@ -0,0 +1,21 @@
+"""
+This script exports bot models to ONNX for the onnxruntime inference backend.
+The graph is written as model.onnx into each model directory.
+Please use it like this: python export_onnx.py [MODEL_DIR] [MODEL_DIR ...]
+"""
+
+import logging
+import sys
+
+from autorecorderbot.intelligence import load_predictor
+
+logging.basicConfig(level=logging.INFO)
+
+if len(sys.argv) < 2:
+    print("""Error: Please use this script like this:\n
+             python export_onnx.py [MODEL_DIR] [MODEL_DIR ...]
+          """)
+    sys.exit(1)
+
+for model_dir in sys.argv[1:]:
+    load_predictor(model_dir, backend="torch").export_onnx()
@@ -1,32 +1,244 @@
 """
-This script extracts the messages for a given room from the message storage json.
-Please use it like this: python extract_messages.py [INFILE] [ROOM_ID] [OUTFILE]
+This script splits the messages of the message storage into one file per room.
+Please use it like this:
+python extract_messages.py [INFILE] [OUTFOLDER] [--format json|jsonl|parquet] [--room ROOM_ID ...] [--since TIME] [--until TIME]
+
+INFILE is the TinyDB messages.json of older bot versions or the SQLite database of the bot.
+It is read once, message by message, and every message is appended to the file of its room
+right away, so archives of any size are split in bounded memory. TIME is a timestamp in
+milliseconds (as stored by the bot) or an ISO date like 2022-06-01 or 2022-06-01T12:00.
+Parquet output requires the `pyarrow` package. Every room becomes a Parquet dataset, a
+folder of files that pyarrow and pandas read as one table. Messages are buffered before
+they are written, at most --max-buffered-rows of all rooms together.
 """
 
-import sys
+import argparse
 import json
+import logging
+import os
+import shutil
+import sqlite3
+from collections import OrderedDict
+from datetime import datetime
 from pathlib import Path
-from tinydb import TinyDB, where
-
-if len(sys.argv) != 3:
-    print("""Error: Please use this script like this:\n
-             python extract_messages.py [INFILE] [OUTFOLDER]
-          """)
-    sys.exit(1)
-
-INFILE, OUTFOLDER = sys.argv[1:]
-OUTFOLDER = Path(OUTFOLDER)
-
-db = TinyDB(INFILE)
-
-room_ids = []
-for entry in db:
-    if entry["roomid"] not in room_ids:
-        room_ids.append(entry["roomid"])
-
-for room_id in room_ids:
-    results = db.search(where("roomid") == room_id)
-    for r in results:
-        del r["roomid"]
-    with open(OUTFOLDER.joinpath(f"{room_id.split(':')[0]}.json"), "w") as room_file:
-        room_file.write(json.dumps(results))
+
+from autorecorderbot.message_archive import detect_format, iter_tinydb_documents
+
+logging.basicConfig(level=logging.INFO)
+
+# Messages buffered per room before they are written as one Parquet file
+PARQUET_ROW_GROUP_SIZE = 10000
+
+
+class RowBudget:
+    """Caps the messages buffered by all Parquet writers together.
+
+    Once `max_rows` messages are buffered, the writers with the largest buffers write
+    them out until at most half of `max_rows` remain, so many small rooms cannot keep
+    most of the archive in memory.
+    """
+
+    def __init__(self, max_rows: int):
+        self.max_rows = max(1, max_rows)
+        self.buffered = 0
+        self.writers = set()
+
+    def add(self, writer):
+        """Count a message `writer` buffered, and write out the largest buffers if needed"""
+        self.writers.add(writer)
+        self.buffered += 1
+        if self.buffered < self.max_rows:
+            return
+        for largest in sorted(self.writers, key=lambda w: len(w.rows), reverse=True):
+            if self.buffered <= self.max_rows // 2:
+                break
+            largest.flush()
+
+    def release(self, writer, rows: int):
+        """Forget `rows` messages that `writer` wrote out"""
+        self.buffered -= rows
+        self.writers.discard(writer)
+
+
+class FilePool:
+    """Keeps at most `max_open` room files open, closing the least recently used one.
+
+    Files are truncated when first opened and appended to when reopened.
+    """
+
+    def __init__(self, max_open: int):
+        self.max_open = max_open
+        self.files = OrderedDict()
+        self.created = set()
+
+    def get(self, path):
+        f = self.files.get(path)
+        if f is not None:
+            self.files.move_to_end(path)
+            return f
+        if len(self.files) >= self.max_open:
+            _, oldest = self.files.popitem(last=False)
+            oldest.close()
+        f = open(path, "a" if path in self.created else "w", encoding="utf-8")
+        self.created.add(path)
+        self.files[path] = f
+        return f
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+
+class JsonLinesWriter:
+    extension = ".jsonl"
+
+    def __init__(self, pool, path, budget):
+        self.pool = pool
+        self.path = path
+
+    def write(self, record):
+        self.pool.get(self.path).write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def close(self):
+        pass
+
+
+class JsonArrayWriter(JsonLinesWriter):
+    """Writes the JSON array of the room, in the format of earlier versions of this script"""
+    extension = ".json"
+
+    def __init__(self, pool, path, budget):
+        super().__init__(pool, path, budget)
+        self.empty = True
+
+    def write(self, record):
+        self.pool.get(self.path).write(("[" if self.empty else ", ") + json.dumps(record))
+        self.empty = False
+
+    def close(self):
+        self.pool.get(self.path).write("[]" if self.empty else "]")
+
+
+class ParquetWriter:
+    """Writes the room as a folder of Parquet files, one per PARQUET_ROW_GROUP_SIZE messages,
+    or fewer when the `RowBudget` is used up. Every file is closed right after it is
+    written, no file stays open between writes."""
+    extension = ".parquet"
+
+    def __init__(self, pool, path, budget):
+        self.path = path
+        self.budget = budget
+        self.rows = []
+        self.parts = 0
+
+    def write(self, record):
+        self.rows.append(record)
+        self.budget.add(self)
+        if len(self.rows) >= PARQUET_ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered messages as the next file of the room"""
+        if self.parts == 0:
+            # Replace the output of an earlier run
+            if os.path.isdir(self.path):
+                shutil.rmtree(self.path)
+            elif os.path.exists(self.path):
+                os.remove(self.path)
+            os.makedirs(self.path)
+        self._write_part(os.path.join(self.path, f"part-{self.parts:05d}.parquet"))
+        self.parts += 1
+        self.budget.release(self, len(self.rows))
+        self.rows = []
+
+    def _write_part(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([
+            ("message", pa.string()),
+            ("sender", pa.string()),
+            ("timestamp", pa.int64()),
+            ("type", pa.string()),
+            ("tokens", pa.list_(pa.string())),
+        ])
+        columns = {name: [row.get(name) for row in self.rows] for name in schema.names}
+        pq.write_table(pa.Table.from_pydict(columns, schema=schema), path)
+
+    def close(self):
+        if self.rows or not self.parts:
+            self.flush()
+
+
+WRITERS = {"json": JsonArrayWriter, "jsonl": JsonLinesWriter, "parquet": ParquetWriter}
+
+
+def parse_time(value):
+    """Milliseconds since the epoch of a timestamp or an ISO date"""
+    if value.isdigit():
+        return int(value)
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+def read_records(path):
+    """Stream the messages of a TinyDB file or a bot database, with their room"""
+    if detect_format(path) == "sqlite":
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            query = "SELECT roomid, message, sender, timestamp, type, tokens FROM messages ORDER BY id"
+            for roomid, message, sender, timestamp, sent_type, tokens in conn.execute(query):
+                yield {"roomid": roomid, "message": message, "sender": sender, "timestamp": timestamp,
+                       "type": sent_type, "tokens": json.loads(tokens) if tokens else []}
+        finally:
+            conn.close()
+    else:
+        for _, document in iter_tinydb_documents(path):
+            yield document
+
+
+# Tests import this file for its writers, only running it exports
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split the message storage into one file per room.")
+    parser.add_argument("infile", help="TinyDB messages.json or bot database")
+    parser.add_argument("outfolder", help="Folder to write the room files to")
+    parser.add_argument("--format", choices=sorted(WRITERS), default="json", help="Format of the room files")
+    parser.add_argument("--room", action="append", default=None, help="Only export this room, can be repeated")
+    parser.add_argument("--since", type=parse_time, default=None, help="Only export messages from this time on")
+    parser.add_argument("--until", type=parse_time, default=None, help="Only export messages before this time")
+    parser.add_argument("--max-open-files", type=int, default=64, help="Room files kept open at the same time")
+    parser.add_argument("--max-buffered-rows", type=int, default=10 * PARQUET_ROW_GROUP_SIZE,
+                        help="Messages buffered for Parquet files of all rooms together")
+    args = parser.parse_args()
+
+    outfolder = Path(args.outfolder)
+    os.makedirs(outfolder, exist_ok=True)
+    rooms = set(args.room) if args.room else None
+    pool = FilePool(args.max_open_files)
+    budget = RowBudget(args.max_buffered_rows)
+    writers = {}
+    exported = 0
+
+    try:
+        for record in read_records(args.infile):
+            room_id = record.pop("roomid")
+            if rooms is not None and room_id not in rooms:
+                continue
+            timestamp = record.get("timestamp") or 0
+            if (args.since is not None and timestamp < args.since) or (args.until is not None and timestamp >= args.until):
+                continue
+
+            writer = writers.get(room_id)
+            if writer is None:
+                writer_class = WRITERS[args.format]
+                writer = writers[room_id] = writer_class(
+                    pool, outfolder.joinpath(f"{room_id.split(':')[0]}{writer_class.extension}"), budget
+                )
+            writer.write(record)
+            exported += 1
+    finally:
+        for writer in writers.values():
+            writer.close()
+        pool.close()
+
+    logging.info(f"Exported {exported} messages of {len(writers)} rooms to {outfolder}")
@@ -0,0 +1,73 @@
+"""
+This script measures the memory of several processes that load the same bot model, like
+several bots or inference workers on one host. Every process reports its resident set
+size (RSS) and proportional set size (PSS, shared pages split between the processes)
+before loading the model, after loading it and after a first prediction, all while the
+other processes are alive.
+Run it before and after converting the model with convert_safetensors.py to see how much
+memory the shared, memory-mapped weights save.
+Please use it like this:
+python measure_memory.py [MODEL_DIR] [--processes 4] [--backend torch]
+
+Linux only, the numbers are read from /proc/self/smaps_rollup.
+"""
+
+import argparse
+import multiprocessing
+
+# Fields of /proc/self/smaps_rollup that are reported, in kB
+FIELDS = ("Rss", "Pss", "Shared_Clean", "Private_Dirty")
+
+
+def read_memory():
+    memory = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in FIELDS:
+                memory[name] = int(value.split()[0]) / 1024
+    return memory
+
+
+def measure(model_dir, backend, barrier, results):
+    from autorecorderbot.intelligence import load_predictor
+
+    phases = [("start", read_memory())]
+    predictor = load_predictor(model_dir, backend=backend)
+    barrier.wait()
+    phases.append(("loaded", read_memory()))
+    predictor.predict_batch(["Die Maschine steht still."])
+    barrier.wait()
+    phases.append(("predicted", read_memory()))
+    results.put((multiprocessing.current_process().name, phases))
+    # Stay alive until everybody measured, so the shared pages are split between all processes
+    barrier.wait()
+
+
+# Spawned processes import this file again, only the parent measures
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the memory of processes sharing one model.")
+    parser.add_argument("model_dir", help="Bot model directory (sequence, token or multi-head model)")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--backend", default="torch", choices=["torch", "torch-int8", "onnxruntime"])
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(args.processes)
+    results = context.Queue()
+    processes = [context.Process(target=measure, args=(args.model_dir, args.backend, barrier, results))
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    reports = sorted(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+
+    print(f"{'process':<12} {'phase':<10} " + " ".join(f"{field + ' MB':>18}" for field in FIELDS))
+    totals = {}
+    for name, phases in reports:
+        for phase, memory in phases:
+            print(f"{name:<12} {phase:<10} " + " ".join(f"{memory[field]:>18.1f}" for field in FIELDS))
+            totals[phase] = totals.get(phase, 0) + memory["Pss"]
+    for phase, pss in totals.items():
+        print(f"Total PSS of all processes {phase}: {pss:.1f} MB")
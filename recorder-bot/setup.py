@@ -34,9 +34,11 @@ setup(
         "matrix-nio[e2e]>=0.10.0",
         "Markdown>=3.1.1",
         "PyYAML>=5.1.2",
+        "safetensors>=0.3.1",
     ],
     extras_require={
         "postgres": ["psycopg2>=2.8.5"],
+        "onnx": ["onnx>=1.12.0", "onnxruntime>=1.13.1"],
         "dev": [
             "isort==5.0.4",
             "flake8==3.8.3",
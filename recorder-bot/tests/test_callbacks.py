@@ -5,7 +5,7 @@ import nio
 
 from autorecorderbot.chat_functions import send_text_to_room
 from autorecorderbot.callbacks import Callbacks
-from autorecorderbot.storage import Storage
+from autorecorderbot.storage_async import AsyncStorage
 
 from tests.utils import make_awaitable, run_coroutine
 
@@ -16,14 +16,23 @@ class CallbacksTestCase(unittest.TestCase):
         self.fake_client = Mock(spec=nio.AsyncClient)
         self.fake_client.user = "@fake_user:example.com"
 
-        self.fake_storage = Mock(spec=Storage)
+        self.fake_storage = Mock(spec=AsyncStorage)
 
         # We don't spec config, as it doesn't currently have well defined attributes
         self.fake_config = Mock()
         self.fake_config.sequence_model_path = "/home/lorenz/UKP/TexPrax/sequence_classification_model"
         self.fake_config.token_model_path = "/home/lorenz/UKP/TexPrax/token_classification_model"
+        self.fake_config.multi_head_model_path = None
+        self.fake_config.inference_backend = "torch"
+        self.fake_config.inference_max_batch_size = 16
+        self.fake_config.inference_max_wait_ms = 10
+        self.fake_config.inference_cache_size = 0
+        self.fake_config.inference_worker_processes = 0
+        self.fake_config.inference_server_url = None
+        self.fake_config.inference_cache_path = None
         self.fake_config.command_prefix = "!"
         self.fake_config.user_id = "@fake_user:example.com"
+        self.fake_config.max_concurrent_sends = 4
 
         self.callbacks = Callbacks(
             self.fake_client, self.fake_storage, self.fake_config
@@ -106,6 +115,52 @@ class CallbacksTestCase(unittest.TestCase):
         # Make sure the bot tries to store something to the teamboard
         self.fake_storage.store_new_event.assert_called_once()
 
+    def test_reaction_to_an_unregistered_event(self):
+        """Events the bot sent before replies were stored are looked up on the homeserver"""
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+
+        self.fake_storage.get_reply.return_value = None
+        self.fake_storage.get_event_worked.return_value = False
+        get_event_response = nio.RoomGetEventResponse()
+        get_event_response.event = nio.Event({"sender": "@fake_user:example.com",
+                                              "event_id": "fake_id",
+                                              "origin_server_ts": 123456789})
+        get_event_response.event.sender = "@fake_user:example.com"
+        self.fake_client.room_get_event.return_value = make_awaitable(get_event_response)
+
+        fake_reaction_event = Mock(spec=nio.UnknownEvent)
+        fake_reaction_event.sender = "@some_other_fake_user:example.com"
+        fake_reaction_event.source = {"content": {"m.relates_to": {"key": "Problem"}}}
+
+        run_coroutine(self.callbacks._reaction(fake_room, fake_reaction_event, "fake_id"))
+
+        self.fake_storage.register_reply.assert_called_once_with("!abcdefg:example.com", "fake_id")
+        self.fake_storage.change_last_message_type.assert_called_once_with("Problem", "!abcdefg:example.com")
+        self.fake_storage.store_new_event.assert_called_once()
+
+    def test_reaction_to_an_event_of_someone_else(self):
+        """Reactions to events the bot did not send are ignored"""
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+
+        self.fake_storage.get_reply.return_value = None
+        get_event_response = nio.RoomGetEventResponse()
+        get_event_response.event = nio.Event({"sender": "@some_other_fake_user:example.com",
+                                              "event_id": "fake_id",
+                                              "origin_server_ts": 123456789})
+        get_event_response.event.sender = "@some_other_fake_user:example.com"
+        self.fake_client.room_get_event.return_value = make_awaitable(get_event_response)
+
+        fake_reaction_event = Mock(spec=nio.UnknownEvent)
+        fake_reaction_event.sender = "@some_other_fake_user:example.com"
+        fake_reaction_event.source = {"content": {"m.relates_to": {"key": "Problem"}}}
+
+        run_coroutine(self.callbacks._reaction(fake_room, fake_reaction_event, "fake_id"))
+
+        self.fake_storage.register_reply.assert_not_called()
+        self.fake_storage.store_new_event.assert_not_called()
+
 
 
 if __name__ == "__main__":
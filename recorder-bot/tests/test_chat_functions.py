@@ -0,0 +1,60 @@
+import asyncio
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from autorecorderbot.chat_functions import react_to_event_concurrently
+
+from tests.utils import run_coroutine
+
+
+class ChatFunctionsTestCase(unittest.TestCase):
+    def test_react_to_event_concurrently(self):
+        """All reactions are sent, but never more than max_concurrency at once"""
+        fake_client = Mock(spec=nio.AsyncClient)
+        in_flight = []
+        max_in_flight = []
+
+        async def fake_room_send(room_id, message_type, content, ignore_unverified_devices):
+            in_flight.append(content["m.relates_to"]["key"])
+            max_in_flight.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(content["m.relates_to"]["key"])
+            return content["m.relates_to"]["key"]
+
+        fake_client.room_send.side_effect = fake_room_send
+
+        results = run_coroutine(
+            react_to_event_concurrently(
+                fake_client, "!abcdefg:example.com", "$event", ["a", "b", "c", "d", "e"], max_concurrency=2
+            )
+        )
+
+        self.assertEqual(results, ["a", "b", "c", "d", "e"])
+        self.assertEqual(max(max_in_flight), 2)
+
+    def test_first_reaction_is_sent_first(self):
+        """The first reaction is completed before any other one is sent"""
+        fake_client = Mock(spec=nio.AsyncClient)
+        sent = []
+
+        async def fake_room_send(room_id, message_type, content, ignore_unverified_devices):
+            key = content["m.relates_to"]["key"]
+            # The first reaction takes longest, the others would overtake it if sent together
+            await asyncio.sleep(0.02 if key == "yes" else 0)
+            sent.append(key)
+            return key
+
+        fake_client.room_send.side_effect = fake_room_send
+
+        results = run_coroutine(
+            react_to_event_concurrently(fake_client, "!abcdefg:example.com", "$event", ["yes", "b", "c"])
+        )
+
+        self.assertEqual(results, ["yes", "b", "c"])
+        self.assertEqual(sent[0], "yes")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts-dev", "extract_messages.py")
+spec = importlib.util.spec_from_file_location("extract_messages", SCRIPT)
+extract_messages = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(extract_messages)
+
+
+class RecordingParquetWriter(extract_messages.ParquetWriter):
+    """ParquetWriter that keeps the rows of every file instead of writing them with pyarrow"""
+
+    def __init__(self, pool, path, budget):
+        super().__init__(pool, path, budget)
+        self.parts_written = []
+
+    def _write_part(self, path):
+        self.parts_written.append((os.path.basename(path), [row["message"] for row in self.rows]))
+
+
+class RowBudgetTestCase(unittest.TestCase):
+    def test_buffered_rows_are_capped_across_rooms(self):
+        """With many small rooms, the rows buffered by all writers together stay within the cap"""
+        budget = extract_messages.RowBudget(50)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writers = [RecordingParquetWriter(None, os.path.join(tmpdir, f"room{i}.parquet"), budget)
+                       for i in range(200)]
+            for n in range(2000):
+                # Rooms of different sizes: room 0 gets a message every other time
+                writer = writers[0] if n % 2 else writers[n % len(writers)]
+                writer.write({"message": str(n)})
+                buffered = sum(len(w.rows) for w in writers)
+                self.assertEqual(budget.buffered, buffered)
+                self.assertLess(buffered, budget.max_rows)
+            # The largest buffer is written out first
+            self.assertGreater(len(writers[0].parts_written), 0)
+
+            for writer in writers:
+                writer.close()
+            self.assertEqual(budget.buffered, 0)
+
+        written = sorted(int(message) for w in writers for _, rows in w.parts_written for message in rows)
+        self.assertEqual(written, list(range(2000)))
+        for writer in writers:
+            names = [name for name, _ in writer.parts_written]
+            self.assertEqual(names, [f"part-{i:05d}.parquet" for i in range(len(names))])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+from aiohttp.test_utils import AioHTTPTestCase
+
+from autorecorderbot.inference_server import InferenceServer
+from autorecorderbot.intelligence import HEADS, InferenceEngine, Prediction
+
+
+class FakePredictor:
+    """Predicts the requested heads and records them"""
+
+    def __init__(self):
+        self.heads = []
+
+    def predict_batch(self, sentences, heads=HEADS):
+        self.heads.append(heads)
+        return [Prediction(
+            "Problem" if "sentence" in heads else None,
+            s.split() if "token" in heads else None,
+            ["B-Maschine"] + ["O"] * (len(s.split()) - 1) if "token" in heads else None,
+        ) for s in sentences]
+
+
+class InferenceServerTestCase(AioHTTPTestCase):
+    async def get_application(self):
+        self.predictor = FakePredictor()
+        return InferenceServer(InferenceEngine(self.predictor, max_wait_ms=1)).app
+
+    async def test_classify(self):
+        """Only the sentence head is run"""
+        response = await self.client.post("/classify", json={"sentences": ["Maschine steht", "Presse kaputt"]})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.json(), {"labels": ["Problem", "Problem"]})
+        self.assertEqual(self.predictor.heads, [("sentence",)])
+
+    async def test_tag(self):
+        """Only the token head is run"""
+        response = await self.client.post("/tag", json={"sentences": ["Maschine steht"]})
+        self.assertEqual(await response.json(),
+                         {"results": [{"tokens": ["Maschine", "steht"], "labels": ["B-Maschine", "O"]}]})
+        self.assertEqual(self.predictor.heads, [("token",)])
+
+    async def test_invalid_request(self):
+        response = await self.client.post("/classify", json={"sentence": "Maschine steht"})
+        self.assertEqual(response.status, 400)
+
+    async def test_metrics(self):
+        """Every prediction request is counted in the latency histogram of its endpoint"""
+        await self.client.post("/predict", json={"sentences": ["Maschine steht"]})
+        response = await self.client.get("/metrics")
+        text = await response.text()
+        self.assertIn('inference_request_seconds_count{endpoint="/predict"} 1', text)
+        self.assertIn('inference_request_seconds_bucket{endpoint="/predict",le="+Inf"} 1', text)
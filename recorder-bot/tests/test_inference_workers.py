@@ -0,0 +1,49 @@
+import os
+import unittest
+
+import torch
+
+from autorecorderbot.inference_workers import PooledPredictor
+
+
+class EchoPredictor:
+    """Stand-in for a predictor: the "logits" of a message are its length, and the process
+    that computed them"""
+
+    def __init__(self, load_model: bool = True) -> None:
+        self.loaded = load_model
+
+    def encode(self, sentences):
+        input_ids = torch.tensor([[len(sentence)] for sentence in sentences])
+        return {'input_ids': input_ids, 'attention_mask': torch.ones_like(input_ids)}
+
+    def forward(self, encoded):
+        if not self.loaded:
+            raise AssertionError("ran the model in the parent process")
+        rows = encoded['input_ids'].shape[0]
+        return encoded['input_ids'] * 2, torch.full((rows,), os.getpid())
+
+    def decode(self, encoded, logits):
+        doubled, pids = logits
+        return list(zip(doubled[:, 0].tolist(), pids.tolist()))
+
+
+class PooledPredictorTestCase(unittest.TestCase):
+    def test_results_and_shutdown(self):
+        """Every message gets its own result, computed across all workers, and close stops them"""
+        pool = PooledPredictor(EchoPredictor, processes=2)
+        try:
+            sentences = ["a", "bb", "ccc", "dddd", "eeeee"]
+            results = pool.predict_batch(sentences)
+            self.assertEqual([doubled for doubled, _ in results], [2 * len(s) for s in sentences])
+            workers = {pid for _, pid in results}
+            self.assertEqual(len(workers), 2)
+            self.assertNotIn(os.getpid(), workers)
+            self.assertEqual(pool.predict("ab")[0], 4)
+        finally:
+            pool.close()
+        self.assertFalse(any(worker.process.is_alive() for worker in pool._workers))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,375 @@
+import asyncio
+import importlib.util
+import json
+import os
+import struct
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+import torch
+
+from autorecorderbot.errors import InferenceError
+from autorecorderbot.intelligence import (
+    HEADS,
+    PARITY_SENTENCES,
+    InferenceEngine,
+    MultiHeadPredictor,
+    Prediction,
+    PredictionCache,
+    SentenceClassPredictor,
+    _build_with_weights,
+    build_multi_head_model,
+    load_joint_predictor,
+    mmap_safetensors,
+    save_safetensors,
+)
+
+from tests.utils import run_coroutine
+
+
+class FakePredictor:
+    """Records every batch it is asked to predict, and the heads asked for"""
+
+    def __init__(self):
+        self.batches = []
+        self.heads = []
+
+    def predict_batch(self, sentences, heads=HEADS):
+        self.batches.append(list(sentences))
+        self.heads.append(heads)
+        return [Prediction(s.upper() if "sentence" in heads else None, s.split(), ["O"] * len(s.split()))
+                for s in sentences]
+
+
+# Vocabulary, labels and messages of the tiny test models
+WORDS = ["Maschine", "steht", "Sensor", "defekt", "erledigt"]
+LABELS = ["O", "Problem", "Ursache", "Lösung"]
+TAGS = ["O", "B-Maschine", "I-Maschine"]
+SENTENCES = ["Maschine steht", "Sensor defekt erledigt"]
+
+
+def make_tiny_models(directory: str, shared_encoder: bool = True):
+    """Write randomly initialized sentence and token models in the layout the bot loads.
+
+    Args:
+        shared_encoder: Give both models the same encoder weights, as if they were
+            fine-tuned jointly. Otherwise each model gets its own random encoder.
+
+    Returns:
+        The directories of the sentence and the token model.
+    """
+    from transformers import BertConfig, BertForSequenceClassification, BertForTokenClassification, BertTokenizer
+
+    # Tokenizer and architecture of the base model, both predictors point to it
+    base_path = os.path.join(directory, "base")
+    vocab_path = os.path.join(directory, "vocab.txt")
+    with open(vocab_path, "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + WORDS))
+    BertTokenizer(vocab_path, do_lower_case=False).save_pretrained(base_path)
+    BertConfig(vocab_size=len(WORDS) + 5, hidden_size=16, num_hidden_layers=1, num_attention_heads=2,
+               intermediate_size=32).save_pretrained(base_path)
+
+    torch.manual_seed(0)
+    sequence_path = os.path.join(directory, "sequence")
+    sequence_config = BertConfig.from_pretrained(base_path, id2label=dict(enumerate(LABELS)))
+    sequence_model = BertForSequenceClassification(sequence_config)
+    sequence_model.save_pretrained(sequence_path)
+    config_path = os.path.join(sequence_path, "config.json")
+    with open(config_path) as f:
+        model_config = json.load(f)
+    model_config["_name_or_path"] = base_path
+    with open(config_path, "w") as f:
+        json.dump(model_config, f)
+
+    token_path = os.path.join(directory, "token")
+    os.makedirs(token_path)
+    token_model = BertForTokenClassification(BertConfig.from_pretrained(base_path, num_labels=len(TAGS)))
+    if shared_encoder:
+        # The token model has no pooler
+        token_model.bert.load_state_dict(sequence_model.bert.state_dict(), strict=False)
+    torch.save(token_model.state_dict(), os.path.join(token_path, "pytorch_model.bin"))
+    with open(os.path.join(token_path, "config.json"), "w") as f:
+        json.dump({"base_model": base_path, "id2tag": {str(i): tag for i, tag in enumerate(TAGS)},
+                   "unique_tags": TAGS}, f)
+    return sequence_path, token_path
+
+
+class InferenceEngineTestCase(unittest.TestCase):
+    def test_predictions_match_messages(self):
+        """Every caller gets the prediction for its own message"""
+        predictor = FakePredictor()
+        engine = InferenceEngine(predictor, max_batch_size=8, max_wait_ms=5)
+
+        async def run():
+            results = await asyncio.gather(*(engine.predict(f"msg {i}") for i in range(5)))
+            await engine.close()
+            return results
+
+        results = run_coroutine(run())
+        self.assertEqual([r.sentence_label for r in results], [f"MSG {i}" for i in range(5)])
+
+    def test_batches_are_bounded(self):
+        """Concurrent messages are grouped, but never beyond max_batch_size"""
+        predictor = FakePredictor()
+        engine = InferenceEngine(predictor, max_batch_size=4, max_wait_ms=50)
+
+        async def run():
+            await asyncio.gather(*(engine.predict(f"msg {i}") for i in range(6)))
+            await engine.close()
+
+        run_coroutine(run())
+        self.assertEqual([len(b) for b in predictor.batches], [4, 2])
+
+    def test_errors_reach_callers(self):
+        """A failing batch fails the futures of its messages instead of hanging"""
+
+        class BrokenPredictor:
+            def predict_batch(self, sentences):
+                raise RuntimeError("model exploded")
+
+        engine = InferenceEngine(BrokenPredictor(), max_wait_ms=1)
+
+        async def run():
+            try:
+                with self.assertRaises(InferenceError):
+                    await engine.predict("msg")
+            finally:
+                await engine.close()
+
+        run_coroutine(run())
+
+    def test_messages_wait_for_lazy_loading(self):
+        """Messages submitted while the models load are predicted once they are ready"""
+        predictor = FakePredictor()
+        loaded = threading.Event()
+
+        def load():
+            loaded.wait(1)
+            return predictor
+
+        engine = InferenceEngine(max_wait_ms=1, predictor_factory=load)
+
+        async def run():
+            engine.start()
+            pending = asyncio.gather(*(engine.predict(f"msg {i}") for i in range(3)))
+            await asyncio.sleep(0.01)
+            self.assertFalse(engine.ready)
+            loaded.set()
+            results = await pending
+            await engine.close()
+            return results
+
+        results = run_coroutine(run())
+        self.assertTrue(engine.ready)
+        self.assertEqual([r.sentence_label for r in results], ["MSG 0", "MSG 1", "MSG 2"])
+
+    def test_cache_skips_the_model(self):
+        """Repeated messages are answered from the cache, duplicates in a batch run once"""
+        predictor = FakePredictor()
+        cache = PredictionCache(max_size=8)
+        engine = InferenceEngine(predictor, max_wait_ms=5, cache=cache)
+
+        async def run():
+            first = await asyncio.gather(engine.predict("Maschine steht"), engine.predict("Maschine steht"))
+            second = await engine.predict("  Maschine   steht ")
+            await engine.close()
+            return first + [second]
+
+        results = run_coroutine(run())
+        self.assertEqual(predictor.batches, [["Maschine steht"]])
+        self.assertEqual({r.sentence_label for r in results}, {"MASCHINE STEHT"})
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_heads_are_batched_separately(self):
+        """Messages are run once per set of heads, only predictions of all heads are cached"""
+        predictor = FakePredictor()
+        cache = PredictionCache(max_size=8)
+        engine = InferenceEngine(predictor, max_wait_ms=5, cache=cache)
+
+        async def run():
+            partial, full = await asyncio.gather(engine.predict("Maschine steht", heads=("token",)),
+                                                 engine.predict("Maschine steht"))
+            cached = await engine.predict("Maschine steht", heads=("token",))
+            await engine.close()
+            return partial, full, cached
+
+        partial, full, cached = run_coroutine(run())
+        self.assertEqual(sorted(predictor.heads), [("sentence", "token"), ("token",)])
+        self.assertIsNone(partial.sentence_label)
+        self.assertEqual(cached, full)
+        self.assertEqual(len(cache), 1)
+
+
+class PredictionCacheTestCase(unittest.TestCase):
+    def test_least_recently_used_is_dropped(self):
+        cache = PredictionCache(max_size=2)
+        cache.put("a", Prediction("A", [], []))
+        cache.put("b", Prediction("B", [], []))
+        cache.get("a")
+        cache.put("c", Prediction("C", [], []))
+
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(len(cache), 2)
+
+    def test_persisted_per_revision(self):
+        """The cache survives a restart, but not a change of the models"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.json")
+            cache = PredictionCache(revision="v1", path=path)
+            cache.put("erledigt", Prediction("Lösung", ["erledigt"], ["O"]))
+            cache.save()
+
+            self.assertEqual(PredictionCache(revision="v1", path=path).get("erledigt"),
+                             Prediction("Lösung", ["erledigt"], ["O"]))
+            self.assertIsNone(PredictionCache(revision="v2", path=path).get("erledigt"))
+
+
+class MultiHeadPredictorTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.sequence_path, cls.token_path = make_tiny_models(cls.tmpdir.name)
+        cls.multi_head_path = os.path.join(cls.tmpdir.name, "multi-head")
+        build_multi_head_model(cls.sequence_path, cls.token_path, cls.multi_head_path)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.tmpdir.cleanup()
+
+    def assert_valid(self, predictions):
+        self.assertEqual(len(predictions), len(SENTENCES))
+        for sentence, prediction in zip(SENTENCES, predictions):
+            self.assertIn(prediction.sentence_label, LABELS)
+            self.assertEqual(prediction.tokens, sentence.split())
+            self.assertEqual(len(prediction.token_labels), len(prediction.tokens))
+            self.assertLessEqual(set(prediction.token_labels), set(TAGS))
+
+    def test_heads(self):
+        """Both heads run on one encoder pass, the sentence head keeps the sentence model's output"""
+        predictor = MultiHeadPredictor(self.multi_head_path)
+        encoded = predictor.encode(SENTENCES)
+        with torch.no_grad():
+            sequence_logits, token_logits = predictor.forward(encoded)
+            expected = SentenceClassPredictor(self.sequence_path).forward(encoded)
+
+        self.assertEqual(tuple(sequence_logits.shape), (len(SENTENCES), len(LABELS)))
+        self.assertEqual(tuple(token_logits.shape), (*encoded["input_ids"].shape, len(TAGS)))
+        self.assertTrue(torch.allclose(sequence_logits, expected, atol=1e-5))
+        self.assert_valid(predictor.predict_batch(SENTENCES))
+
+    def test_joint_predictor_skips_unused_models(self):
+        """A JointPredictor only runs the model of the requested head"""
+        predictor = load_joint_predictor(self.sequence_path, self.token_path)
+        full = predictor.predict_batch(SENTENCES)
+        self.assert_valid(full)
+
+        predictor.token_predictor.model = None
+        sentence_only = predictor.predict_batch(SENTENCES, heads=("sentence",))
+        self.assertEqual([p.sentence_label for p in sentence_only], [p.sentence_label for p in full])
+        self.assertEqual({(p.tokens, p.token_labels) for p in sentence_only}, {(None, None)})
+
+    def test_int8_backend(self):
+        """The int8 backend quantizes the linear layers and still predicts every message"""
+        predictor = MultiHeadPredictor(self.multi_head_path, backend="torch-int8")
+        self.assertIsInstance(predictor.model.sequence_head, torch.ao.nn.quantized.dynamic.Linear)
+        self.assert_valid(predictor.predict_batch(SENTENCES))
+
+    def test_encoders_must_agree(self):
+        """Models with different encoders are not combined, nothing is written"""
+        with tempfile.TemporaryDirectory() as tmp:
+            sequence_path, token_path = make_tiny_models(tmp, shared_encoder=False)
+            model_path = os.path.join(tmp, "multi-head")
+            with self.assertRaises(InferenceError):
+                build_multi_head_model(sequence_path, token_path, model_path,
+                                       sample_sentences=list(PARITY_SENTENCES) + SENTENCES)
+            self.assertFalse(os.path.exists(model_path))
+
+    def test_encoder_source(self):
+        """With a shared encoder, keeping the token model's encoder predicts the same"""
+        with tempfile.TemporaryDirectory() as tmp:
+            model_path = os.path.join(tmp, "multi-head")
+            build_multi_head_model(self.sequence_path, self.token_path, model_path, encoder_source="token")
+            predictions = MultiHeadPredictor(model_path).predict_batch(SENTENCES)
+        self.assertEqual(predictions, MultiHeadPredictor(self.multi_head_path).predict_batch(SENTENCES))
+
+    @unittest.skipUnless(importlib.util.find_spec("onnxruntime"), "onnxruntime is not installed")
+    def test_onnxruntime_backend(self):
+        """The exported graph predicts the same labels as the torch model"""
+        with tempfile.TemporaryDirectory() as tmp:
+            model_path = os.path.join(tmp, "multi-head")
+            build_multi_head_model(self.sequence_path, self.token_path, model_path)
+            predictor = MultiHeadPredictor(model_path)
+            predictor.export_onnx()
+
+            expected = predictor.predict_batch(SENTENCES)
+            predictions = MultiHeadPredictor(model_path, backend="onnxruntime").predict_batch(SENTENCES)
+        self.assertEqual(predictions, expected)
+
+
+class SafetensorsTestCase(unittest.TestCase):
+    def test_mmap_safetensors(self):
+        """Tensors are read from a safetensors file in place and can be used like loaded ones"""
+        weight = torch.arange(6, dtype=torch.float32).reshape(2, 3)
+        ids = torch.tensor([1, 2, 3], dtype=torch.int64)
+        header = json.dumps({
+            "__metadata__": {"format": "pt"},
+            "weight": {"dtype": "F32", "shape": [2, 3], "data_offsets": [0, 24]},
+            "ids": {"dtype": "I64", "shape": [3], "data_offsets": [24, 48]},
+        }).encode()
+        header += b" " * (-len(header) % 8)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "model.safetensors")
+            with open(path, "wb") as f:
+                f.write(struct.pack("<Q", len(header)) + header)
+                f.write(weight.numpy().tobytes() + ids.numpy().tobytes())
+
+            tensors = mmap_safetensors(path)
+            self.assertTrue(torch.equal(tensors["weight"], weight))
+            self.assertTrue(torch.equal(tensors["ids"], ids))
+            self.assertNotIn("__metadata__", tensors)
+
+
+class BuildWithWeightsTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.model_path = Path(self.tmpdir.name)
+        torch.manual_seed(0)
+        self.weights = torch.nn.Linear(3, 2).state_dict()
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def build(self) -> torch.nn.Module:
+        return _build_with_weights(lambda: torch.nn.Linear(3, 2), self.model_path)
+
+    def assert_weights(self, model: torch.nn.Module, weights) -> None:
+        for name, tensor in model.state_dict().items():
+            self.assertTrue(torch.equal(tensor, weights[name]), name)
+
+    def test_safetensors_are_preferred(self):
+        """A safetensors file wins over the pytorch checkpoint next to it"""
+        save_safetensors(self.weights, self.model_path / "model.safetensors")
+        torch.save({name: torch.zeros_like(t) for name, t in self.weights.items()}, self.model_path / "pytorch_model.bin")
+
+        self.assert_weights(self.build(), self.weights)
+
+    def test_pytorch_checkpoints(self):
+        """Without safetensors, zip checkpoints are memory-mapped and legacy ones read"""
+        for legacy in (False, True):
+            with self.subTest(legacy=legacy):
+                torch.save(self.weights, self.model_path / "pytorch_model.bin",
+                           _use_new_zipfile_serialization=not legacy)
+                self.assert_weights(self.build(), self.weights)
+
+    def test_missing_weights(self):
+        torch.save({"weight": self.weights["weight"]}, self.model_path / "pytorch_model.bin")
+        with self.assertRaises(InferenceError):
+            self.build()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from autorecorderbot.message_archive import (
+    ArchivedMessage,
+    ResumableOutput,
+    _JsonStream,
+    detect_format,
+    iter_tinydb_documents,
+    read_archive,
+)
+
+
+class MessageArchiveTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.tmpdir.name, name)
+
+    def write(self, name: str, content: str) -> str:
+        with open(self.path(name), "w", encoding="utf-8") as f:
+            f.write(content)
+        return self.path(name)
+
+    def test_json_stream_reads_values_split_across_chunks(self):
+        """Values and numbers cut by a chunk boundary are decoded whole"""
+        stream = _JsonStream(io.StringIO(' [ {"a": "Sensor \\u00fc defekt"}, 12345 , [1, 2], "x" ] '), chunk_size=3)
+        values = [stream.value() for _ in stream.elements()]
+        self.assertEqual(values, [{"a": "Sensor ü defekt"}, 12345, [1, 2], "x"])
+
+    def test_tinydb_documents_are_streamed(self):
+        """Other tables are skipped, the documents of the table come in file order"""
+        path = self.write("messages.json", json.dumps({
+            "other": {"1": {"x": 1}},
+            "_default": {
+                "1": {"roomid": "!a:example.com", "message": "Maschine steht", "sender": "@u:example.com",
+                      "timestamp": 1, "type": "Problem", "tokens": []},
+                "2": {"roomid": "!b:example.com", "message": "Hallo", "sender": "@v:example.com",
+                      "timestamp": 2, "type": "O", "tokens": []},
+            },
+        }))
+        self.assertEqual([doc_id for doc_id, _ in iter_tinydb_documents(path, chunk_size=7)], ["1", "2"])
+        self.assertEqual(list(read_archive(path)), [
+            ArchivedMessage("1", "!a:example.com", "Maschine steht", "@u:example.com", 1),
+            ArchivedMessage("2", "!b:example.com", "Hallo", "@v:example.com", 2),
+        ])
+
+    def test_formats(self):
+        """Room exports take the room from the file name, every format yields the same records"""
+        export = self.write("!room.json", json.dumps([{"message": "Hallo", "sender": "@u:example.com", "timestamp": 5}]))
+        lines = self.write("messages.jsonl", '{"roomid": "!room", "message": "Hallo", "sender": "@u:example.com", "timestamp": 5}\n\n')
+        table = self.write("messages.csv", "roomid,message,sender,timestamp\n!room,Hallo,@u:example.com,5\n")
+
+        database = self.path("bot.db")
+        conn = sqlite3.connect(database)
+        conn.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY, roomid TEXT, message TEXT, sender TEXT, timestamp BIGINT)")
+        conn.execute("INSERT INTO messages (roomid, message, sender, timestamp) VALUES ('!room', 'Hallo', '@u:example.com', 5)")
+        conn.commit()
+        conn.close()
+
+        self.assertEqual([detect_format(p) for p in (export, lines, table, database)],
+                         ["room-export", "jsonl", "csv", "sqlite"])
+        for path in (export, lines, table, database):
+            (record,) = list(read_archive(path))
+            self.assertEqual(record[1:], ("!room", "Hallo", "@u:example.com", 5))
+
+    def test_resumable_output_continues_after_checkpoint(self):
+        """Rows written after the last checkpoint are dropped, a new revision starts over"""
+        path = self.path("labels.jsonl")
+        output = ResumableOutput(path, "messages.json", "rev1")
+        output.write([{"n": 1}, {"n": 2}], records=3)
+        # Interrupted in the middle of the next batch
+        output._file.write(b'{"n": 3')
+        output._file.flush()
+        output.close()
+
+        output = ResumableOutput(path, "messages.json", "rev1")
+        self.assertEqual(output.done, 3)
+        output.write([{"n": 3}], records=1)
+        output.close()
+        with open(path) as f:
+            self.assertEqual([json.loads(line)["n"] for line in f], [1, 2, 3])
+
+        output = ResumableOutput(path, "messages.json", "rev2")
+        self.assertEqual(output.done, 0)
+        output.close()
+        self.assertEqual(os.path.getsize(path), 0)
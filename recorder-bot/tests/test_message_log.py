@@ -0,0 +1,115 @@
+import json
+import os
+import tempfile
+import unittest
+
+from autorecorderbot.message_log import MessageLog
+from autorecorderbot.storage_local import Storage
+
+
+class MessageLogTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "messages.log")
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def open_log(self, **kwargs) -> MessageLog:
+        return MessageLog(self.path, compact_interval=0, **kwargs)
+
+    def fill(self, log: MessageLog) -> None:
+        log.store_message("!a:example.com", "Maschine steht", "@u:example.com", 1, "Problem", [])
+        log.store_message("!b:example.com", "Hallo", "@u:example.com", 2, "O", [])
+        last = log.store_message("!a:example.com", "Sensor defekt", "@u:example.com", 3, "O", ["Sensor: B-X"])
+        log.update_type(last, "Ursache")
+
+    def assert_filled(self, log: MessageLog) -> None:
+        self.assertEqual(log.get_last_message_types(), {"!a:example.com": "Ursache", "!b:example.com": "O"})
+        self.assertEqual(log.get_last_message_with_type("!a:example.com", "Ursache"), "Sensor defekt")
+        self.assertEqual(log.get_last_message_with_type("!a:example.com", "Problem"), "Maschine steht")
+        self.assertEqual(log.get_last_message_with_type("!b:example.com", "Problem"), "")
+        self.assertEqual(log.last_message_id(), 3)
+
+    def test_updates_are_appended(self):
+        """Type corrections are update records, earlier records stay as they were"""
+        log = self.open_log()
+        self.fill(log)
+        self.assert_filled(log)
+        log.close()
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 4)
+
+    def test_recovery_replays_records_after_the_index(self):
+        """Records the index does not cover are replayed, a torn last record is dropped"""
+        log = self.open_log(index_interval=2)
+        self.fill(log)
+        # Crash: no close, and half a record at the end
+        log._file.write(b'{"op": "insert", "id": 4, "roo')
+        log._file.flush()
+
+        log = self.open_log()
+        self.assert_filled(log)
+        self.assertEqual(log.store_message("!a:example.com", "Neu", "@u:example.com", 4, "O", []), 4)
+        log.close()
+
+    def test_checkpoints_hold_only_new_records(self):
+        """Between full writes, the index only grows by the entries of the latest records"""
+        log = self.open_log(index_interval=2)
+        self.fill(log)
+        log.store_message("!b:example.com", "Neu", "@u:example.com", 4, "O", [])
+        log.store_message("!b:example.com", "Noch neuer", "@u:example.com", 5, "O", [])
+        with open(f"{self.path}.index") as f:
+            snapshot, *checkpoints = [json.loads(line) for line in f]
+        self.assertEqual(len(checkpoints), 2)
+        self.assertEqual([message_id for message_id, *_ in checkpoints[-1]["added"]], [4, 5])
+        self.assertEqual(checkpoints[-1]["size"], os.path.getsize(self.path))
+
+        # Crash: the checkpoints cover the whole log, nothing has to be replayed
+        log = self.open_log()
+        self.assertEqual(log.last_message_id("!b:example.com"), 5)
+        self.assertEqual(log.get_last_message_types()["!a:example.com"], "Ursache")
+        log.close()
+
+    def test_broken_index_is_rebuilt(self):
+        log = self.open_log()
+        self.fill(log)
+        log.close()
+        with open(f"{self.path}.index", "w") as f:
+            f.write("{")
+
+        self.assert_filled(self.open_log())
+
+    def test_compaction(self):
+        """Compaction drops superseded records and keeps every message with its current type"""
+        log = self.open_log(compact_ratio=0.2)
+        self.fill(log)
+        self.assertTrue(log._needs_compaction())
+        log.compact()
+        self.assert_filled(log)
+        log.close()
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+        self.assert_filled(self.open_log())
+
+    def test_storage_uses_the_log(self):
+        """With a message log configured, Storage keeps messages out of the database"""
+        store = Storage({
+            "type": "sqlite",
+            "connection_string": os.path.join(self.tmpdir.name, "bot.db"),
+            "message_log": self.path,
+        })
+        store.store_message("!a:example.com", "Maschine steht", "@u:example.com", 1, "Problem", [])
+        store.store_message("!b:example.com", "Hallo", "@u:example.com", 2, "O", [])
+        store.change_last_message_type("Ursache", "!b:example.com")
+
+        self.assertEqual(store.get_last_message_types(), {"!a:example.com": "Problem", "!b:example.com": "Ursache"})
+        self.assertEqual(store.get_last_message_type(), "Ursache")
+        self.assertEqual(store.get_last_message_with_type("!a:example.com", "Problem"), "Maschine steht")
+        self.assertEqual(store._execute("SELECT COUNT(*) FROM messages")[0][0], 0)
+        store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
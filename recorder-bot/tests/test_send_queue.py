@@ -0,0 +1,82 @@
+import asyncio
+import time
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from autorecorderbot.chat_functions import react_to_event
+from autorecorderbot.send_queue import SendScheduler, get_send_scheduler
+
+from tests.utils import run_coroutine
+
+
+class SendQueueTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.sent = []
+
+        async def fake_room_send(room_id, message_type, content, ignore_unverified_devices):
+            self.sent.append((room_id, content))
+            await asyncio.sleep(0.01)
+            return nio.RoomSendResponse(f"$sent{len(self.sent)}", room_id)
+
+        self.fake_client.room_send.side_effect = fake_room_send
+
+    def test_install(self):
+        """Installing a scheduler routes the chat functions through it"""
+        self.assertIsNone(get_send_scheduler(self.fake_client))
+        scheduler = SendScheduler(self.fake_client).install()
+        self.assertIs(get_send_scheduler(self.fake_client), scheduler)
+
+    def test_identical_reactions_are_coalesced(self):
+        """The same reaction to the same event is only sent once while it is queued"""
+        SendScheduler(self.fake_client).install()
+
+        async def react_twice():
+            return await asyncio.gather(
+                react_to_event(self.fake_client, "!room:example.com", "$event", "👍"),
+                react_to_event(self.fake_client, "!room:example.com", "$event", "👍"),
+                react_to_event(self.fake_client, "!room:example.com", "$event", "👎"),
+            )
+
+        first, second, third = run_coroutine(react_twice())
+
+        self.assertEqual(len(self.sent), 2)
+        self.assertIs(first, second)
+        self.assertIsNot(first, third)
+
+    def test_superseded_events_are_not_sent(self):
+        """Reactions to a superseded event resolve to None without being sent"""
+        scheduler = SendScheduler(self.fake_client).install()
+        scheduler.supersede("$event")
+
+        result = run_coroutine(react_to_event(self.fake_client, "!room:example.com", "$event", "👍"))
+
+        self.assertIsNone(result)
+        self.assertEqual(self.sent, [])
+
+    def test_retry_after(self):
+        """A rate limited event is sent again once the server allows it"""
+        responses = [
+            nio.RoomSendError("Too many requests", "M_LIMIT_EXCEEDED", retry_after_ms=50),
+            nio.RoomSendResponse("$sent", "!room:example.com"),
+        ]
+        send_times = []
+
+        async def fake_room_send(room_id, message_type, content, ignore_unverified_devices):
+            send_times.append(time.monotonic())
+            return responses.pop(0)
+
+        self.fake_client.room_send.side_effect = fake_room_send
+        scheduler = SendScheduler(self.fake_client, max_retries=1)
+
+        result = run_coroutine(scheduler.send("!room:example.com", "m.room.message", {"body": "hi"}))
+
+        self.assertIsInstance(result, nio.RoomSendResponse)
+        self.assertEqual(len(send_times), 2)
+        self.assertGreaterEqual(send_times[1] - send_times[0], 0.05)
+
+
+if __name__ == "__main__":
+    unittest.main()
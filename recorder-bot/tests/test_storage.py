@@ -0,0 +1,139 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from autorecorderbot.storage_local import Storage
+
+from tests.utils import run_coroutine
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.database_config = {
+            "type": "sqlite",
+            "connection_string": os.path.join(self.tmpdir.name, "bot.db"),
+            "message_path": os.path.join(self.tmpdir.name, "messages.json"),
+        }
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_last_message_is_per_room(self):
+        """Type corrections only change the last message of the given room"""
+        store = Storage(self.database_config)
+        store.store_message("!a:example.com", "Maschine steht", "@u:example.com", 1, "Problem", [])
+        store.store_message("!b:example.com", "Hallo", "@u:example.com", 2, "O", [])
+        store.store_message("!a:example.com", "Sensor defekt", "@u:example.com", 3, "O", [])
+
+        store.change_last_message_type("Ursache", "!a:example.com")
+
+        self.assertEqual(store.get_last_message_with_type("!a:example.com", "Ursache"), "Sensor defekt")
+        self.assertEqual(store.get_last_message_with_type("!a:example.com", "Problem"), "Maschine steht")
+        self.assertEqual(store.get_last_message_with_type("!b:example.com", "Ursache"), "")
+        self.assertEqual(store.get_last_message_type(), "Ursache")
+
+    def test_tinydb_messages_are_migrated(self):
+        """Messages of the old TinyDB file are imported once, in doc id order"""
+        documents = {
+            "2": {"roomid": "!a:example.com", "message": "second", "sender": "@u:example.com",
+                  "timestamp": 2, "type": "Lösung", "tokens": ["x: B-X"]},
+            "1": {"roomid": "!a:example.com", "message": "first", "sender": "@u:example.com",
+                  "timestamp": 1, "type": "Problem", "tokens": []},
+        }
+        with open(self.database_config["message_path"], "w") as message_file:
+            json.dump({"_default": documents}, message_file)
+
+        store = Storage(self.database_config)
+        self.assertEqual(store.get_last_message_type(), "Lösung")
+        self.assertEqual(store.get_last_message_with_type("!a:example.com", "Problem"), "first")
+
+        # Opening the database again must not import the file a second time
+        Storage(self.database_config)
+        self.assertEqual(store._execute("SELECT COUNT(*) FROM messages")[0][0], 2)
+
+    def test_interrupted_import_is_rolled_back(self):
+        """A failing import leaves the database at v0, the next start migrates it again"""
+        documents = {
+            "1": {"roomid": "!a:example.com", "message": "first", "sender": "@u:example.com",
+                  "timestamp": 1, "type": "Problem", "tokens": []},
+            "2": {"roomid": "!a:example.com", "message": "broken"},
+        }
+        with open(self.database_config["message_path"], "w") as message_file:
+            json.dump({"_default": documents}, message_file)
+        with self.assertRaises(KeyError):
+            Storage(self.database_config)
+
+        documents["2"].update(sender="@u:example.com", timestamp=2, type="Lösung", tokens=[])
+        with open(self.database_config["message_path"], "w") as message_file:
+            json.dump({"_default": documents}, message_file)
+        store = Storage(self.database_config)
+        self.assertEqual(store._execute("SELECT version FROM migration_version")[0][0], 2)
+        self.assertEqual(store._execute("SELECT COUNT(*) FROM messages")[0][0], 2)
+
+    def test_room_state_is_cached(self):
+        """Room state is answered from memory and kept in sync with every room write"""
+        store = Storage(self.database_config)
+        self.assertTrue(store.store_new_room("!a:example.com", 1000))
+        self.assertFalse(store.store_new_room("!a:example.com", 2000))
+        self.assertFalse(store.get_room_recording("!a:example.com"))
+        self.assertFalse(store.get_room_recording("!unknown:example.com"))
+
+        store.set_room_recording("!a:example.com")
+        # Any query from here on fails the test
+        store._execute = Mock(side_effect=AssertionError("queried the database"))
+        self.assertTrue(store.get_room_recording("!a:example.com"))
+        self.assertEqual(store.get_room_timestamp("!a:example.com"), 1000)
+        self.assertFalse(store.get_room_recording("!unknown:example.com"))
+
+    def test_rooms_of_other_instances_are_read_again(self):
+        """Rooms another instance stored, changed or deleted are noticed once the cache expired"""
+        store = Storage(self.database_config)
+        other = Storage(self.database_config)
+        other.store_new_room("!a:example.com", 1000)
+        self.assertEqual(store.get_room_timestamp("!a:example.com"), 1000)
+
+        other.set_room_recording("!a:example.com")
+        self.assertFalse(store.get_room_recording("!a:example.com"))
+        store.room_cache_ttl = 0
+        self.assertTrue(store.get_room_recording("!a:example.com"))
+        other.delete_room("!a:example.com")
+        self.assertFalse(store.get_room_recording("!a:example.com"))
+
+    def test_room_cache_survives_restart(self):
+        """The room cache is filled from the database on startup, deleted rooms are dropped"""
+        store = Storage(self.database_config)
+        store.store_new_room("!a:example.com", 1000)
+        store.store_new_room("!b:example.com", 2000)
+        store.set_room_recording("!a:example.com")
+        store.delete_room("!b:example.com")
+        self.assertEqual(store.get_room_timestamp("!b:example.com"), 0)
+
+        store = Storage(self.database_config)
+        self.assertTrue(store.get_room_recording("!a:example.com"))
+        self.assertEqual(store.get_room_timestamp("!b:example.com"), 0)
+
+    def test_room_ids_are_bound_parameters(self):
+        """Quotes in room ids are stored verbatim instead of breaking the query"""
+        store = Storage(self.database_config)
+        roomid = "!it's'); DROP TABLE rooms; --:example.com"
+        self.assertTrue(store.store_new_room(roomid, 1000))
+        store.set_room_recording(roomid)
+        self.assertEqual(store._get_room_info(roomid)[0][2], 1)
+
+    def test_run_async(self):
+        """Storage methods can be awaited, running on the storage thread"""
+        store = Storage(self.database_config)
+
+        async def run():
+            return await store.run_async(store.store_new_room, "!a:example.com", 1000)
+
+        self.assertTrue(run_coroutine(run()))
+        self.assertEqual(store.get_room_timestamp("!a:example.com"), 1000)
+        store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,233 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from autorecorderbot.storage_async import AsyncStorage
+from autorecorderbot.storage_local import Storage
+
+from tests.utils import run_coroutine
+
+
+class AsyncStorageTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.database_config = {
+            "type": "sqlite",
+            "connection_string": os.path.join(self.tmpdir.name, "bot.db"),
+        }
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_writes_reach_the_database(self):
+        """Queued writes are committed and visible to a fresh Storage"""
+        store = AsyncStorage(Storage(self.database_config))
+
+        async def run():
+            self.assertTrue(await store.store_new_room("!a:example.com", 1000))
+            self.assertFalse(await store.store_new_room("!a:example.com", 2000))
+            await store.set_room_recording("!a:example.com")
+            await store.store_message("!a:example.com", "Maschine steht", "@u:example.com", 1, "O", [])
+            await store.change_last_message_type("Problem", "!a:example.com")
+            await store.store_new_event("$event", True)
+            await store.close()
+
+        run_coroutine(run())
+
+        reopened = Storage(self.database_config)
+        self.assertTrue(reopened.get_room_recording("!a:example.com"))
+        self.assertEqual(reopened.get_last_message_type(), "Problem")
+        self.assertTrue(reopened.get_event_worked("$event"))
+
+    def test_reactions_correct_exactly_their_message(self):
+        """A reply maps to its message, corrections do not touch later messages or other rooms"""
+        store = AsyncStorage(Storage(self.database_config))
+
+        async def run():
+            first = await store.store_message("!a:example.com", "Maschine steht", "@u:example.com", 1, "O", [])
+            await store.register_reply("!a:example.com", "$reply1", first)
+            second = await store.store_message("!a:example.com", "Hallo", "@u:example.com", 2, "O", [])
+            await store.register_reply("!a:example.com", "$reply2", second)
+            await store.store_message("!b:example.com", "Sensor defekt", "@u:example.com", 3, "Ursache", [])
+
+            self.assertIs((await store.get_reply("!a:example.com", "$reply1")).message, first)
+            self.assertIsNone(await store.get_reply("!b:example.com", "$reply1"))
+            await store.change_message_type((await store.get_reply("!a:example.com", "$reply1")).message, "Problem")
+            self.assertEqual(store.get_last_message_type("!a:example.com"), "O")
+            self.assertEqual(store.get_last_message_type(), "Ursache")
+            await store.close()
+            self.assertIsNotNone(first.message_id)
+
+        run_coroutine(run())
+
+        reopened = Storage(self.database_config)
+        self.assertEqual(reopened.get_last_message_with_type("!a:example.com", "Problem"), "Maschine steht")
+        self.assertEqual(reopened.get_last_message_types(), {"!a:example.com": "O", "!b:example.com": "Ursache"})
+
+    def test_replies_are_persisted(self):
+        """Replies that left the cache, or were sent before a restart, are read from the database"""
+        store = AsyncStorage(Storage(self.database_config), reply_cache_size=1)
+
+        async def run():
+            message = await store.store_message("!a:example.com", "Maschine steht", "@u:example.com", 1, "O", [])
+            await store.register_reply("!a:example.com", "$reply", message)
+            await store.register_reply("!a:example.com", "$hello")
+            await store.change_message_type(message, "Problem")
+            await store.flush()
+
+            reply = await store.get_reply("!a:example.com", "$reply")
+            self.assertEqual((reply.message.message_id, reply.message.type), (message.message_id, "Problem"))
+            await store.close()
+
+        run_coroutine(run())
+
+        reopened = AsyncStorage(Storage(self.database_config))
+
+        async def check():
+            self.assertEqual((await reopened.get_reply("!a:example.com", "$reply")).message.type, "Problem")
+            self.assertIsNone((await reopened.get_reply("!a:example.com", "$hello")).message)
+            self.assertIsNone(await reopened.get_reply("!a:example.com", "$someone-else"))
+            await reopened.close()
+
+        run_coroutine(check())
+
+    def test_reads_are_served_from_memory(self):
+        """Reads reflect queued writes right away, without waiting for the writer"""
+        storage = Storage(self.database_config)
+        storage.store_new_room("!a:example.com", 1000)
+        store = AsyncStorage(storage)
+
+        async def run():
+            with patch.object(storage, "_execute", side_effect=AssertionError("queried the database")):
+                self.assertFalse(await store.get_room_recording("!a:example.com"))
+            await store.set_room_recording("!a:example.com")
+            await store.store_new_event("$event", True)
+            await store.store_message("!a:example.com", "Sensor defekt", "@u:example.com", 1, "Ursache", [])
+            with patch.object(storage, "_execute", side_effect=AssertionError("queried the database")):
+                self.assertTrue(await store.get_room_recording("!a:example.com"))
+                self.assertTrue(await store.get_event_worked("$event"))
+                self.assertEqual(store.get_last_message_type(), "Ursache")
+            await store.close()
+
+        run_coroutine(run())
+
+    def test_rooms_of_other_instances_are_read_again(self):
+        """Rooms another instance stored, changed or deleted are noticed once the cache expired"""
+        store = AsyncStorage(Storage(self.database_config))
+        other = AsyncStorage(Storage({**self.database_config, "room_cache_ttl": 0}))
+
+        async def run():
+            self.assertTrue(await other.store_new_room("!a:example.com", 1000))
+            await other.flush()
+            self.assertEqual(await store.get_room_timestamp("!a:example.com"), 1000)
+            self.assertFalse(await store.get_room_recording("!a:example.com"))
+
+            await other.set_room_recording("!a:example.com")
+            await other.flush()
+            self.assertFalse(await store.get_room_recording("!a:example.com"))
+            store.store.room_cache_ttl = 0
+            self.assertTrue(await store.get_room_recording("!a:example.com"))
+
+            await other.delete_room("!a:example.com")
+            await other.flush()
+            self.assertFalse(await store.get_room_recording("!a:example.com"))
+            self.assertTrue(await store.store_new_room("!a:example.com", 2000))
+            self.assertEqual(await other.get_room_timestamp("!a:example.com"), 2000)
+            await store.close()
+            await other.close()
+
+        run_coroutine(run())
+
+    def test_worked_events_are_cached_in_front_of_the_database(self):
+        """Only recently handled events are kept in memory, the others are read from the database"""
+        storage = Storage(self.database_config)
+        storage.store_new_event("$before", True)
+        storage.store_new_event("$failed", False)
+        store = AsyncStorage(storage, worked_cache_size=2)
+
+        async def run():
+            self.assertEqual(len(store._worked_events), 0)
+            for i in range(5):
+                await store.store_new_event(f"$event{i}", True)
+            await store.flush()
+            self.assertEqual(list(store._worked_events), ["$event3", "$event4"])
+
+            self.assertTrue(await store.get_event_worked("$event0"))
+            self.assertTrue(await store.get_event_worked("$before"))
+            self.assertFalse(await store.get_event_worked("$failed"))
+            self.assertFalse(await store.get_event_worked("$unknown"))
+            self.assertEqual(list(store._worked_events), ["$event0", "$before"])
+            await store.close()
+
+        run_coroutine(run())
+
+    def test_writes_are_grouped(self):
+        """Writes queued while the writer is busy are committed in one transaction"""
+        storage = Storage(self.database_config)
+        store = AsyncStorage(storage, max_group_size=64)
+        transactions = []
+        original = storage.transaction
+
+        def counting_transaction():
+            transactions.append(1)
+            return original()
+
+        async def run():
+            # Keep the writer busy with a first write, then pile up more
+            with patch.object(storage, "transaction", side_effect=counting_transaction):
+                with storage._lock:
+                    for i in range(20):
+                        await store.store_new_event(f"$event{i}", True)
+                await store.flush()
+            await store.close()
+
+        run_coroutine(run())
+        self.assertLessEqual(len(transactions), 2)
+        self.assertEqual(len(Storage(self.database_config).get_worked_events()), 20)
+
+    def test_failed_commit_does_not_repeat_log_writes(self):
+        """Messages already appended to the message log are not appended again by the retry"""
+        storage = Storage({**self.database_config, "message_log": os.path.join(self.tmpdir.name, "messages.log"),
+                           "message_log_compact_interval": 0})
+        store = AsyncStorage(storage)
+        original = storage.transaction
+
+        @contextmanager
+        def failing_transaction():
+            with original():
+                yield
+                raise sqlite3.OperationalError("disk I/O error")
+
+        async def run():
+            with patch.object(storage, "transaction", side_effect=failing_transaction):
+                first = await store.store_message("!a:example.com", "Maschine steht", "@u:example.com", 1, "O", [])
+                await store.store_new_event("$event", True)
+                await store.flush()
+            await store.store_message("!a:example.com", "Sensor defekt", "@u:example.com", 2, "O", [])
+            await store.close()
+            return first
+
+        first = run_coroutine(run())
+        self.assertEqual(first.message_id, 1)
+        self.assertEqual(storage.message_log.last_message_id(), 2)
+        self.assertTrue(Storage(self.database_config).get_event_worked("$event"))
+
+    def test_new_rooms_are_read_by_the_writer(self):
+        """Storing a room does not copy the room table on the event loop"""
+        storage = Storage(self.database_config)
+        store = AsyncStorage(storage)
+
+        async def run():
+            with patch.object(storage, "get_rooms", side_effect=AssertionError("copied all rooms")):
+                self.assertTrue(await store.store_new_room("!a:example.com", 1000))
+            self.assertEqual(await store.get_room_timestamp("!a:example.com"), 1000)
+            await store.close()
+
+        run_coroutine(run())
+
+
+if __name__ == "__main__":
+    unittest.main()